@@ -8,34 +8,36 @@ from LetItFlow import sc_utils
 
 
 def pass_id_clusters(c1, c2, nn):
-    for clu_id in range(c1.max() + 1):
-        # TODO - DISTANCE threshold?
-        matched = c2[nn[0, :, 0][c1 == clu_id]]
-
-        matched_ids = torch.unique(matched)
-
-        # TODO - time matching across full sequence?
-        # TODO - check it properly
-
-        # match only itself
-        if len(matched_ids) == 1 and matched_ids[0] == clu_id:
-            continue
-
-        matched_ids = matched_ids[matched_ids != -1]
-
-        if len(matched_ids) == 0:
-            continue
-
-        if clu_id <= torch.min(matched_ids):
-            chosen_id = clu_id
-        else:
-            chosen_id = torch.min(matched_ids)
-
-        c1[c1 == clu_id] = chosen_id
-
-        for m_id in matched_ids:
-            c2[c2 == m_id] = chosen_id
+    """
+    Merge the clusters of c1 with the clusters of c2 their points are matched to.
 
+    Every point of c1 links its cluster to the cluster of its nearest neighbor
+    in c2 (ids are shared by both frames, -1 is noise and never merged). The
+    connected components of these links are found by min-label propagation
+    with pointer jumping, and both c1 and c2 (in place) take the smallest id
+    of their component.
+    """
+    src = c1
+    dst = c2[nn[0, :, 0]]
+    valid = (src >= 0) & (dst >= 0)
+    src, dst = src[valid].long(), dst[valid].long()
+    if src.numel() == 0:
+        return c1
+
+    num_ids = int(max(c1.max(), c2.max())) + 1
+    label = torch.arange(num_ids, device=c1.device)
+    while True:
+        edge_min = torch.minimum(label[src], label[dst])
+        new_label = label.scatter_reduce(0, src, edge_min, reduce="amin")
+        new_label = new_label.scatter_reduce(0, dst, edge_min, reduce="amin")
+        new_label = new_label[new_label]
+        if torch.equal(new_label, label):
+            break
+        label = new_label
+
+    label = label.to(c1.dtype)
+    c1.copy_(torch.where(c1 >= 0, label[c1.clamp(min=0).long()], c1))
+    c2.copy_(torch.where(c2 >= 0, label[c2.clamp(min=0).long()], c2))
     return c1
 
 
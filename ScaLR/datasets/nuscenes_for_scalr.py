@@ -25,6 +25,7 @@ from nuscenes.nuscenes import NuScenes
 from nuscenes.utils.geometry_utils import view_points
 from nuscenes.utils.data_classes import LidarPointCloud
 from nuscenes.utils.geometry_utils import transform_matrix
+from utils.flow_store import Flow_reader
 
 # For normalizing intensities
 MEAN_INT = 18.742355
@@ -68,6 +69,9 @@ class NuScenesSemSeg(PCDataset):
 
         self.nusc = NuScenes(version="v1.0-trainval", dataroot=self.rootdir, verbose=self.verbose)
 
+        # Precomputed scene flow
+        self.flow_reader = Flow_reader(os.path.join(self.rootdir, "flow"))
+
         # For normalizing intensities
         self.mean_int = MEAN_INT
         self.std_int = STD_INT
@@ -126,6 +130,13 @@ class NuScenesSemSeg(PCDataset):
 
         return pc, labels, self.list_frames[index][2]
 
+    def get_frame_id(self, index):
+        return self.list_frames[index][0]
+
+    def get_scene_id(self, index):
+        sample_data = self.nusc.get('sample_data', self.list_frames[index][2])
+        return self.nusc.get('sample', sample_data['sample_token'])['scene_token']
+
     def get_ego_motion_from_token(self, token):
         try:
             sample_data = self.nusc.get('sample_data', token)
@@ -190,13 +201,7 @@ class NuScenesSemSeg(PCDataset):
         if sample["next"] == "":
             flow = None
         else:
-            filename = scene["name"] + "_" + str(sample["token"]) + "_" + str(sample["next"]) + ".npz"
-            try:
-                flow = np.load(
-                    os.path.join(self.rootdir, "flow", filename), allow_pickle=True
-                )["flow"]
-            except FileNotFoundError:
-                flow = None
+            flow = self.flow_reader.read(scene["name"], sample["token"], sample["next"])
 
         return flow
 
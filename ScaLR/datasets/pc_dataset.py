@@ -12,12 +12,75 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+
 import torch
 import numpy as np
 import ScaLR.utils.transforms as tr
 from torch.utils.data import Dataset
 from scipy.spatial import cKDTree as KDTree
 
+# Names of the outputs of PCDataset.__getitem__
+OUTPUT_FIELDS = (
+    "feat",
+    "labels",
+    "cell_ind",
+    "neighbors_emb",
+    "upsample",
+    "filename",
+    "ego_motion",
+    "scene",
+    "sample",
+    "instance",
+    "flow",
+)
+# Fields stored in the cache, used as file names. Labels and scene flow are
+# read again on every access, "source" (original point of each preprocessed
+# point) gathers the flow.
+CACHE_FIELDS = (
+    "feat",
+    "cell_ind",
+    "neighbors_emb",
+    "upsample",
+    "filename",
+    "ego_motion",
+    "scene",
+    "sample",
+    "source",
+)
+# Increase when the preprocessing changes to invalidate existing caches
+CACHE_VERSION = 3
+
+
+def voxel_upsample(inverse, where, kdtree, pc_orig):
+    """
+    Map every point of the original point cloud to a point of the voxelized and
+    cropped point cloud.
+
+    Points are mapped to the point kept for their voxel. Only points whose voxel
+    was cropped out of the field of view are mapped to the nearest kept point.
+
+    Args:
+        inverse (np.ndarray): Voxel of each original point of shape (N,).
+        where (np.ndarray): Mask of the voxels kept by cropping of shape (M,).
+        kdtree (KDTree): KDTree of the voxelized and cropped points.
+        pc_orig (np.ndarray): Original point cloud of shape (N, C).
+
+    Returns:
+        np.ndarray: Index of the voxelized and cropped point of each original point.
+    """
+    kept = np.full(where.shape[0], -1, dtype=np.int64)
+    kept[where] = np.arange(np.count_nonzero(where))
+    upsample = kept[inverse]
+    cropped = upsample < 0
+    if cropped.any():
+        _, upsample[cropped] = kdtree.query(pc_orig[cropped, :3], k=1)
+    return upsample
+
 
 class PCDataset(Dataset):
     def __init__(
@@ -37,6 +100,7 @@ class PCDataset(Dataset):
         ),
         num_neighbors=16,
         verbose=False,
+        cache_dir=None,
     ):
         super().__init__()
 
@@ -85,6 +149,11 @@ class PCDataset(Dataset):
 
         self.verbose = verbose
 
+        # Cache of preprocessed frames, only used when preprocessing is deterministic
+        self.cache_dir = cache_dir
+        self.voxel_size = voxel_size
+        self._cache_key = None
+
     def get_occupied_2d_cells(self, pc):
         """Return mapping between 3D point and corresponding 2D cell"""
         cell_ind = []
@@ -142,10 +211,116 @@ class PCDataset(Dataset):
     def get_scene_flow(self, index):
         raise NotImplementedError
 
+    def get_frame_id(self, index):
+        """Return a string uniquely identifying the frame, used as the cache key"""
+        raise NotImplementedError
+
+    def get_scene_id(self, index):
+        """Return the scene token of the frame without loading it"""
+        raise NotImplementedError
+
     def __len__(self):
         raise NotImplementedError
 
+    def get_cache_path(self, index):
+        """
+        Return the cache directory of a frame, None if the frame cannot be cached.
+
+        Frames are cached only outside of training (no random voxelization or
+        augmentations) for datasets implementing get_frame_id. The path depends on
+        the frame id and on all preprocessing parameters. Labels and scene flow
+        are not cached, they may be regenerated.
+        """
+        if self.cache_dir is None or self.phase in ["train", "trainval"]:
+            return None
+        try:
+            frame_id = self.get_frame_id(index)
+        except NotImplementedError:
+            return None
+
+        if self._cache_key is None:
+            params = (
+                CACHE_VERSION,
+                type(self).__name__,
+                self.phase,
+                self.rootdir,
+                list(self.input_feat),
+                self.voxel_size,
+                self.fov_xyz.tolist(),
+                list(self.dim_proj),
+                [g.tolist() for g in self.grids_shape],
+                self.num_neighbors,
+                getattr(self, "mean_int", None),
+                getattr(self, "std_int", None),
+            )
+            self._cache_key = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+        frame_key = hashlib.sha1(str(frame_id).encode()).hexdigest()
+        return os.path.join(self.cache_dir, self._cache_key, frame_key)
+
+    @staticmethod
+    def read_cache(path):
+        """Read a cached frame, arrays are memory-mapped copy-on-write"""
+        with open(os.path.join(path, "meta.pkl"), "rb") as f:
+            meta = pickle.load(f)
+        return {
+            name: meta[name]
+            if name in meta
+            else np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c")
+            for name in CACHE_FIELDS
+        }
+
+    @staticmethod
+    def write_cache(path, cached):
+        """
+        Write the CACHE_FIELDS of a preprocessed frame to the cache.
+
+        The frame is written to a temporary directory renamed at the end, so
+        concurrent workers and interrupted runs never leave a partial frame.
+        """
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+        meta = {}
+        for name in CACHE_FIELDS:
+            value = cached[name]
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(tmp, f"{name}.npy"), value)
+            else:
+                meta[name] = value
+        with open(os.path.join(tmp, "meta.pkl"), "wb") as f:
+            pickle.dump(meta, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # frame written in the meantime by another worker
+            shutil.rmtree(tmp, ignore_errors=True)
+
     def __getitem__(self, index):
+        path = self.get_cache_path(index)
+        if path is None:
+            return self.preprocess(index)[0]
+        if not os.path.isdir(path):
+            out, source = self.preprocess(index)
+            cached = dict(zip(OUTPUT_FIELDS, out), source=source)
+            self.write_cache(path, cached)
+            return out
+
+        # cached frames are never training frames, labels are at full resolution
+        cached = self.read_cache(path)
+        _, labels_orig, _, pan_instances, flow = self.load_annotations(index)
+        fields = dict(
+            cached,
+            labels=labels_orig,
+            instance=pan_instances,
+            flow=flow[cached["source"]].T[None],
+        )
+        return tuple(fields[name] for name in OUTPUT_FIELDS)
+
+    def load_annotations(self, index):
+        """
+        Load the original point cloud with its labels, panoptic instances and
+        scene flow (zero when not available).
+        """
         # Load original point cloud
         pc_orig, labels_orig, filename = self.load_pc(index)
 
@@ -171,18 +346,35 @@ class PCDataset(Dataset):
         if flow is None:
             flow = np.zeros_like(pc_orig[:, :3])
 
+        return pc_orig, labels_orig, filename, pan_instances, flow
+
+    def preprocess(self, index):
+        """
+        Return the preprocessed frame and the original point of each of its
+        points.
+        """
+        pc_orig, labels_orig, filename, pan_instances, flow = self.load_annotations(
+            index
+        )
+        source = np.arange(pc_orig.shape[0])
+
         # Prepare input feature
         pc_orig = self.prepare_input_features(pc_orig)
 
-        # Voxelization
-        pc, labels, instance, flow = self.downsample(pc_orig, labels_orig, pan_instances, flow)
+        # Voxelization, the flow is gathered through the kept points
+        pc, labels, instance, source, inverse = self.downsample(
+            pc_orig, labels_orig, pan_instances, source, return_inverse=True
+        )
 
         # Augment data
         if self.train_augmentations is not None:
             pc, labels = self.train_augmentations(pc, labels)
 
         # Crop to fov
-        pc, labels, instance, flow = self.crop_to_fov(pc, labels, instance, flow)
+        pc, labels, instance, source, where = self.crop_to_fov(
+            pc, labels, instance, source, return_mask=True
+        )
+        flow = flow[source]
 
         # For each point, get index of corresponding 2D cells on projected grid
         cell_ind = self.get_occupied_2d_cells(pc)
@@ -192,11 +384,12 @@ class PCDataset(Dataset):
         assert pc.shape[0] > self.num_neighbors
         _, neighbors_emb = kdtree.query(pc[:, :3], k=self.num_neighbors + 1)
 
-        # Nearest neighbor interpolation to undo cropping & voxelisation at validation time
+        # Undo cropping & voxelisation at validation time: voxel of each point,
+        # nearest neighbor for cropped points
         if self.phase in ["train", "trainval"]:
             upsample = np.arange(pc.shape[0])
         else:
-            _, upsample = kdtree.query(pc_orig[:, :3], k=1)
+            upsample = voxel_upsample(inverse, where, kdtree, pc_orig)
 
         try:
             ego_motion, scene, sample = self.get_ego_motion(index)
@@ -232,7 +425,7 @@ class PCDataset(Dataset):
             flow.T[None],
         )
 
-        return out
+        return out, source
 
 
 def zero_pad(feat, neighbors_emb, cell_ind, flow, Nmax):
@@ -85,5 +85,11 @@ class PoneSemSeg(PCDataset):
     def get_panoptic_labels(self, index):
         return None, None
 
+    def get_frame_id(self, index):
+        return self.list_frames[index][0]
+
+    def get_scene_id(self, index):
+        return self.list_frames[index][0].split("/")[-1][:-9]
+
     def get_scene_flow(self, index):
         return None
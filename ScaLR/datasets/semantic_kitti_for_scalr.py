@@ -20,6 +20,7 @@ from PIL import Image
 from glob import glob
 from .pc_dataset import PCDataset
 from .im_pc_dataset import ImPcDataset
+from utils.flow_store import Flow_reader
 
 # For normalizing intensities
 MEAN_INT = 0.28613698
@@ -101,6 +102,9 @@ class SemanticKITTISemSeg(PCDataset):
             print("Using original split")
             self.im_idx = np.sort(self.im_idx)
 
+        # Precomputed scene flow
+        self.flow_reader = Flow_reader(os.path.join(self.rootdir, "dataset", "flow"))
+
     def __len__(self):
         return len(self.im_idx)
 
@@ -126,6 +130,12 @@ class SemanticKITTISemSeg(PCDataset):
 
         return pc, labels, self.im_idx[index]
 
+    def get_frame_id(self, index):
+        return self.im_idx[index]
+
+    def get_scene_id(self, index):
+        return self.im_idx[index].split("/")[-3]
+
     def get_ego_motion(self, index):
         pose_file = self.im_idx[index].replace("velodyne", "poses.txt")[:-11]
         poses = np.loadtxt(pose_file).reshape(-1, 3, 4)
@@ -154,17 +164,10 @@ class SemanticKITTISemSeg(PCDataset):
         return ego_motion, scene, sample
 
     def get_scene_flow(self, index):
-        path = self.im_idx[index][:-33]
         sequence = self.im_idx[index][-22:-20]
         frame = self.im_idx[index][-10:-4]
 
-        filename = f"{sequence}_{frame}_{int(frame)+1:06d}.npz"
-        try:
-            scene_flow = np.load(os.path.join(path, "flow", filename))["flow"]
-        except FileNotFoundError:
-            scene_flow = None
-
-        return scene_flow
+        return self.flow_reader.read(sequence, frame, f"{int(frame)+1:06d}")
 
     def get_panoptic_labels(self, index):
         # Extract Label
@@ -16,6 +16,40 @@ import torch
 import numpy as np
 
 
+def unique_voxels(voxels, return_inverse=False):
+    """
+    Find the first point of each occupied voxel.
+
+    Same result as np.unique(voxels, return_index=True, axis=0), but the voxel
+    coordinates are packed in a single int64 key so that a 1D unique replaces
+    the much slower lexicographic sort of rows. Keys are ordered like the rows,
+    hence the voxels are returned in the same order.
+
+    Args:
+        voxels (np.ndarray): Non-negative integer voxel coordinates of shape (N, D).
+        return_inverse (bool): Also return the voxel index of every point.
+
+    Returns:
+        np.ndarray: Index of the first point of each voxel, sorted by voxel.
+        np.ndarray: Voxel index of each point of shape (N,), if return_inverse.
+    """
+    voxels = voxels.astype(np.int64)
+    extent = voxels.max(0) + 1 if voxels.shape[0] > 0 else np.ones(voxels.shape[1], dtype=np.int64)
+    if np.prod(extent.astype(np.float64)) < 2**62:
+        key = np.zeros(voxels.shape[0], dtype=np.int64)
+        for d in range(voxels.shape[1]):
+            key = key * extent[d] + voxels[:, d]
+        axis = None
+    else:
+        # extent too large to pack the coordinates in one key
+        key = voxels
+        axis = 0
+    out = np.unique(key, return_index=True, return_inverse=return_inverse, axis=axis)
+    if return_inverse:
+        return out[1], out[2].reshape(-1)
+    return out[1]
+
+
 class Compose:
     def __init__(self, transformations):
         self.transformations = transformations
@@ -184,11 +218,14 @@ class Voxelize(Transformation):
         self.random = random
         assert voxel_size >= 0
 
-    def __call__(self, pcloud, labels, instance, flow):
+    def __call__(self, pcloud, labels, instance, flow, return_inverse=False):
         pc, labels, instance, flow = super().__call__(pcloud, labels, instance, flow)
         if self.voxel_size <= 0:
+            if return_inverse:
+                return pc, labels, instance, flow, np.arange(pc.shape[0])
             return pc, labels, instance, flow
 
+        permute = None
         if self.random:
             permute = torch.randperm(pc.shape[0])
             pc, labels = pc[permute], None if labels is None else labels[permute]
@@ -197,8 +234,16 @@ class Voxelize(Transformation):
 
         pc_shift = pc[:, self.dims] - pc[:, self.dims].min(0, keepdims=True)
 
-        _, ind = np.unique(
-            (pc_shift / self.voxel_size).astype("int"), return_index=True, axis=0
-        )
-
-        return pc[ind, :], None if labels is None else labels[ind], None if instance is None else instance[ind], None if flow is None else flow[ind]
+        voxels = (pc_shift / self.voxel_size).astype("int")
+        if return_inverse:
+            ind, inverse = unique_voxels(voxels, return_inverse=True)
+        else:
+            ind = unique_voxels(voxels)
+
+        out = (pc[ind, :], None if labels is None else labels[ind], None if instance is None else instance[ind], None if flow is None else flow[ind])
+        if return_inverse:
+            # voxel of each point in the order of the input point cloud
+            if permute is not None:
+                inverse = inverse[np.argsort(np.asarray(permute))]
+            return out + (inverse,)
+        return out
@@ -16,6 +16,40 @@ import torch
 import numpy as np
 
 
+def unique_voxels(voxels, return_inverse=False):
+    """
+    Find the first point of each occupied voxel.
+
+    Same result as np.unique(voxels, return_index=True, axis=0), but the voxel
+    coordinates are packed in a single int64 key so that a 1D unique replaces
+    the much slower lexicographic sort of rows. Keys are ordered like the rows,
+    hence the voxels are returned in the same order.
+
+    Args:
+        voxels (np.ndarray): Non-negative integer voxel coordinates of shape (N, D).
+        return_inverse (bool): Also return the voxel index of every point.
+
+    Returns:
+        np.ndarray: Index of the first point of each voxel, sorted by voxel.
+        np.ndarray: Voxel index of each point of shape (N,), if return_inverse.
+    """
+    voxels = voxels.astype(np.int64)
+    extent = voxels.max(0) + 1 if voxels.shape[0] > 0 else np.ones(voxels.shape[1], dtype=np.int64)
+    if np.prod(extent.astype(np.float64)) < 2**62:
+        key = np.zeros(voxels.shape[0], dtype=np.int64)
+        for d in range(voxels.shape[1]):
+            key = key * extent[d] + voxels[:, d]
+        axis = None
+    else:
+        # extent too large to pack the coordinates in one key
+        key = voxels
+        axis = 0
+    out = np.unique(key, return_index=True, return_inverse=return_inverse, axis=axis)
+    if return_inverse:
+        return out[1], out[2].reshape(-1)
+    return out[1]
+
+
 class Compose:
     def __init__(self, transformations):
         self.transformations = transformations
@@ -148,7 +182,7 @@ class Crop(Transformation):
                 min < max
             ), f"Field of view: min ({min}) < max ({max}) is expected on dimension {i}."
 
-    def __call__(self, pcloud, labels):
+    def __call__(self, pcloud, labels, return_mask=False):
         pc, labels = super().__call__(pcloud, labels)
 
         where = None
@@ -158,6 +192,8 @@ class Crop(Transformation):
             )
             where = temp if where is None else where & temp
 
+        if return_mask:
+            return pc[where], labels[where] if labels is not None else None, where
         return pc[where], labels[where] if labels is not None else None
 
 
@@ -169,19 +205,29 @@ class Voxelize(Transformation):
         self.random = random
         assert voxel_size >= 0
 
-    def __call__(self, pcloud, labels):
+    def __call__(self, pcloud, labels, return_inverse=False):
         pc, labels = super().__call__(pcloud, labels)
         if self.voxel_size <= 0:
+            if return_inverse:
+                return pc, labels, np.arange(pc.shape[0])
             return pc, labels
 
+        permute = None
         if self.random:
             permute = torch.randperm(pc.shape[0])
             pc, labels = pc[permute], labels[permute]
 
         pc_shift = pc[:, self.dims] - pc[:, self.dims].min(0, keepdims=True)
 
-        _, ind = np.unique(
-            (pc_shift / self.voxel_size).astype("int"), return_index=True, axis=0
-        )
-
+        voxels = (pc_shift / self.voxel_size).astype("int")
+        if return_inverse:
+            ind, inverse = unique_voxels(voxels, return_inverse=True)
+        else:
+            ind = unique_voxels(voxels)
+
+        if return_inverse:
+            # voxel of each point in the order of the input point cloud
+            if permute is not None:
+                inverse = inverse[np.argsort(np.asarray(permute))]
+            return pc[ind, :], None if labels is None else labels[ind], inverse
         return pc[ind, :], None if labels is None else labels[ind]
@@ -0,0 +1,83 @@
+"""
+Speed and parity of the torch DBSCAN backend against sklearn DBSCAN.
+
+Run from the repository root:
+    python -m benchmarks.clustering --num_points 20000 50000 100000
+"""
+
+import time
+import argparse
+
+import torch
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from utils.misc import load_config
+from utils.clustering import Clusterer
+from benchmarks.synthetic import random_boxes, make_sweep
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Clustering benchmark")
+    parser.add_argument(
+        "--num_points", type=int, nargs="+", default=[20000, 50000, 100000]
+    )
+    parser.add_argument("--num_objects", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--epsilon", type=float, default=None)
+    parser.add_argument("--min_samples", type=int, default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def run(clusterer, points, repeats):
+    times = []
+    for _ in range(repeats):
+        if points.is_cuda:
+            torch.cuda.synchronize(points.device)
+        start = time.perf_counter()
+        labels = clusterer.get_semantic_clustering(points)
+        if points.is_cuda:
+            torch.cuda.synchronize(points.device)
+        times.append(time.perf_counter() - start)
+    return labels.cpu().numpy(), np.median(times)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    config = load_config("configs/config.yaml")
+    config["fore_classes"] = config["nuscenes"]["fore_classes"]
+    if args.epsilon is not None:
+        config["clustering"]["epsilon"] = args.epsilon
+    if args.min_samples is not None:
+        config["clustering"]["min_cluster_size"] = args.min_samples
+
+    clusterers = {}
+    for method in ["dbscan", "torch_dbscan"]:
+        config["clustering"]["clustering_method"] = method
+        clusterers[method] = Clusterer(config)
+
+    print(
+        f"epsilon: {config['clustering']['epsilon']}, "
+        f"min_samples: {config['clustering']['min_cluster_size']}, "
+        f"device: {args.device}"
+    )
+    print(f"{'points':>8} | {'dbscan [s]':>10} | {'torch [s]':>10} | {'speedup':>7} | {'ARI':>6}")
+    for num_points in args.num_points:
+        objects = random_boxes(rng, args.num_objects, config["fore_classes"])
+        structures = random_boxes(rng, args.num_objects // 2, [14])
+        pc, sem, _ = make_sweep(rng, num_points, objects, structures, ground_class=10)
+        points = torch.from_numpy(
+            np.concatenate((pc[:, :3], sem[:, None]), axis=1).astype(np.float32)
+        ).to(args.device)
+
+        labels_ref, time_ref = run(clusterers["dbscan"], points.cpu(), args.repeats)
+        labels, time_torch = run(clusterers["torch_dbscan"], points, args.repeats)
+
+        print(
+            f"{num_points:>8} | {time_ref:>10.3f} | {time_torch:>10.3f} | "
+            f"{time_ref / time_torch:>7.2f} | {adjusted_rand_score(labels_ref, labels):>6.3f}"
+        )
@@ -0,0 +1,172 @@
+"""
+Accuracy and time of coarse-to-fine Let It Flow against the full-resolution
+optimization, on consecutive SemanticKITTI frames with ground-truth labels.
+
+SemanticKITTI has no ground-truth flow. The full-resolution flow of
+flow_estimation_lif is the reference, and the ground-truth labels split the
+points into static and moving classes (ids >= 250). The clouds are ego
+compensated, so static points should not move. Reported per setting:
+    epe: mean end-point error to the reference [m]
+    epe_moving: the same, on points of moving classes [m]
+    static: mean flow norm of points of static classes [m]
+    time: optimization time per pair [s]
+    iters: optimizer iterations per pair, summed over the levels
+
+Run from the repository root:
+    python -m benchmarks.flow_multires --path_dataset /data/semantic_kitti \\
+        --voxel_sizes 0.4,0.2 0.5 --refine_iters 50 100
+"""
+
+import json
+import time
+import argparse
+
+import torch
+import numpy as np
+
+from utils.misc import load_config
+from utils.flow import (
+    flow_estimation_lif,
+    flow_estimation_lif_multires,
+    kitti_frames,
+    load_frame,
+)
+
+# First moving class of SemanticKITTI
+MOVING_CLASS = 250
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Coarse-to-fine flow benchmark")
+    parser.add_argument(
+        "--path_dataset", type=str, required=True, help="Path to SemanticKITTI"
+    )
+    parser.add_argument(
+        "--sequence", type=int, default=8, help="Sequence with labels (0-10)"
+    )
+    parser.add_argument("--num_pairs", type=int, default=20)
+    parser.add_argument(
+        "--stride", type=int, default=40, help="Frames between measured pairs"
+    )
+    parser.add_argument(
+        "--voxel_sizes",
+        type=str,
+        nargs="+",
+        default=["0.4,0.2", "0.5", "0.25"],
+        help="Levels of each setting, comma separated voxel sizes, coarse to fine",
+    )
+    parser.add_argument(
+        "--refine_iters",
+        type=int,
+        nargs="+",
+        default=[50, 100],
+        help="Full resolution iterations of each setting",
+    )
+    parser.add_argument(
+        "--gpu", default=None, type=int, help="Set to a number of gpu to use"
+    )
+    parser.add_argument("--output", type=str, default=None, help="Save results as JSON")
+    return parser.parse_args()
+
+
+def kitti_pairs(args):
+    """Source and destination frames of the measured pairs."""
+    frames = kitti_frames(args.path_dataset, args.sequence)
+    starts = range(0, len(frames) - 1, args.stride)
+    return [(frames[i], frames[i + 1]) for i in starts][: args.num_pairs]
+
+
+def run(estimate, config, data, device):
+    """Return the flow, the duration and the iterations of every pair"""
+    results = []
+    for src_points, dst_points, src_labels, dst_labels in data:
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        flow, stats = estimate(
+            config=config,
+            src_points=src_points,
+            dst_points=dst_points,
+            src_labels=src_labels.clone(),
+            dst_labels=dst_labels.clone(),
+            device=device,
+            return_stats=True,
+        )
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        duration = time.perf_counter() - start
+        results.append((flow.reshape(-1, 3), duration, stats["iters"]))
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda" if args.gpu is None else f"cuda:{args.gpu}")
+
+    config = load_config("configs/let-it-flow.yaml")
+    data = []
+    for src, dst in kitti_pairs(args):
+        src_points, src_labels = load_frame(src, "semantic_kitti", device)
+        dst_points, dst_labels = load_frame(dst, "semantic_kitti", device)
+        data.append((src_points, dst_points, src_labels, dst_labels))
+
+    settings = [("full", None, config["iters"], flow_estimation_lif, config)]
+    for voxel_sizes in args.voxel_sizes:
+        sizes = [float(v) for v in voxel_sizes.split(",")]
+        for refine_iters in args.refine_iters:
+            setting_config = dict(config, voxel_sizes=sizes, refine_iters=refine_iters)
+            settings.append(
+                (
+                    "multires",
+                    voxel_sizes,
+                    refine_iters,
+                    flow_estimation_lif_multires,
+                    setting_config,
+                )
+            )
+
+    reference = None
+    results = []
+    print(
+        f"{'mode':>8} | {'voxels':>9} | {'refine':>6} | {'epe':>7} | "
+        f"{'epe_mov':>7} | {'static':>7} | {'time [s]':>8} | {'iters':>6}"
+    )
+    for mode, voxel_sizes, refine_iters, estimate, setting_config in settings:
+        runs = run(estimate, setting_config, data, device)
+        if reference is None:
+            reference = [flow for flow, _, _ in runs]
+
+        epe, epe_moving, static = [], [], []
+        for (flow, _, _), ref, (_, _, src_labels, _) in zip(runs, reference, data):
+            error = (flow - ref).norm(dim=1)
+            moving = src_labels >= MOVING_CLASS
+            # 0 is unlabeled
+            still = (src_labels > 0) & ~moving
+            epe.append(error.mean().item())
+            if moving.any():
+                epe_moving.append(error[moving].mean().item())
+            static.append(flow[still].norm(dim=1).mean().item())
+
+        result = {
+            "mode": mode,
+            "voxel_sizes": voxel_sizes,
+            "refine_iters": refine_iters,
+            "epe": float(np.mean(epe)),
+            "epe_moving": float(np.mean(epe_moving)) if epe_moving else float("nan"),
+            "static": float(np.mean(static)),
+            "time": float(np.mean([t for _, t, _ in runs])),
+            "iters": float(np.mean([n for _, _, n in runs])),
+        }
+        results.append(result)
+        print(
+            f"{mode:>8} | {str(voxel_sizes or '-'):>9} | {refine_iters:>6} | "
+            f"{result['epe']:>7.4f} | {result['epe_moving']:>7.4f} | "
+            f"{result['static']:>7.4f} | {result['time']:>8.2f} | "
+            f"{result['iters']:>6.0f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
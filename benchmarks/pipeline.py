@@ -0,0 +1,198 @@
+"""
+Per-stage latency of PanSegmenter on synthetic sequences.
+
+A randomly initialized Segmenter (or a checkpoint) runs on synthetic sweeps
+with ground, static structures and moving boxes, no dataset is needed. By
+default the semantic prediction of the network is replaced by the synthetic
+ground truth after the backbone, so clustering and association see realistic
+classes even with random weights. Stage times are wall-clock, on a GPU the
+asynchronous kernels are attributed to the stage that first waits for them.
+The save stage includes the background file writes of each frame.
+
+Run from the repository root:
+    python -m benchmarks.pipeline --num_points 30000 60000 --clustering dbscan torch_dbscan
+"""
+
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+import numpy as np
+
+from pan_seg_continuous import PanSegmenter
+from benchmarks.synthetic import make_sequence
+
+# Mean and std of intensities, ground and static structure class of each dataset
+DATASETS = {
+    "nuscenes": (18.742355, 22.04632, 10, 14),
+    "semantic_kitti": (0.28613698, 0.14090556, 8, 12),
+    "pone": (0.391358, 0.151813, 8, 12),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pipeline latency benchmark")
+    parser.add_argument("--dataset", type=str, default="pone", choices=DATASETS)
+    parser.add_argument(
+        "--config_pretrain",
+        type=str,
+        default="ScaLR/configs/pretrain/WI_768_pretrain.yaml",
+        help="Path to config for pretraining",
+    )
+    parser.add_argument(
+        "--pretrained_ckpt",
+        type=str,
+        default=None,
+        help="Path to pretrained ckpt, randomly initialized model if not given",
+    )
+    parser.add_argument("--depth", type=int, default=8, help="Backbone depth")
+    parser.add_argument("--nb_channels", type=int, default=128, help="Backbone width")
+    parser.add_argument(
+        "--num_points", type=int, nargs="+", default=[30000, 60000, 120000]
+    )
+    parser.add_argument(
+        "--clustering", type=str, nargs="+", default=["dbscan", "torch_dbscan"]
+    )
+    parser.add_argument(
+        "--association",
+        type=str,
+        nargs="+",
+        default=["short", "long"],
+        choices=["short", "long"],
+    )
+    parser.add_argument("--frames", type=int, default=30, help="Frames per run")
+    parser.add_argument("--warmup", type=int, default=3, help="Frames not measured")
+    parser.add_argument("--num_objects", type=int, default=20)
+    parser.add_argument(
+        "--network_semantics",
+        action="store_true",
+        default=False,
+        help="Use the semantic prediction of the network instead of the ground truth",
+    )
+    parser.add_argument(
+        "--gpu", default=None, type=int, help="Set to a number of gpu to use"
+    )
+    parser.add_argument(
+        "--save_path",
+        type=str,
+        default=None,
+        help="Where to write predictions, a temporary directory if not given",
+    )
+    parser.add_argument("--output", type=str, default=None, help="Save results as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def build_segmenter(args, clustering, association, save_path):
+    mean_int, std_int = DATASETS[args.dataset][:2]
+    seg_args = argparse.Namespace(
+        dataset=args.dataset,
+        config_pretrain=args.config_pretrain,
+        pretrained_ckpt=args.pretrained_ckpt,
+        gpu=args.gpu,
+        save_path=save_path,
+        save_format="label",
+        clustering=clustering,
+        short=association == "short",
+        verbose=False,
+        mean_int=mean_int,
+        std_int=std_int,
+    )
+    # same weights for every run
+    torch.manual_seed(args.seed)
+    return PanSegmenter(
+        seg_args,
+        model_overrides={"depth": args.depth, "nb_channels": args.nb_channels},
+    )
+
+
+def run(args, segmenter, num_points):
+    """Return the duration of every stage of every measured frame"""
+    rng = np.random.default_rng(args.seed)
+    ground_class, static_class = DATASETS[args.dataset][2:]
+    sequence = make_sequence(
+        rng,
+        args.frames + args.warmup,
+        num_points,
+        segmenter.config["fore_classes"],
+        ground_class,
+        static_class,
+        num_objects=args.num_objects,
+    )
+
+    times = []
+    for i, (points, sem, _) in enumerate(sequence):
+        scene_name = f"synthetic_{num_points}"
+        frame = {
+            "points": points,
+            "ego": np.eye(4, dtype=np.float32),
+            "scene": {"name": scene_name, "token": scene_name},
+            "sample": f"{i:06d}.bin",
+        }
+        data = segmenter._preprocess(frame)
+        data = segmenter._segment(data)
+        if not args.network_semantics:
+            out = torch.zeros_like(data["out"])
+            out[data["upsample"]] = torch.from_numpy(sem).to(out.device)
+            data["out"] = out
+        segmenter._postprocess(data)
+        # files are written in background threads, the save stage waits for them
+        start = time.time()
+        if segmenter.writer is not None:
+            segmenter.writer.flush()
+        data["times"][PanSegmenter.STAGES.index("save")] += time.time() - start
+        if i >= args.warmup:
+            times.append(data["times"])
+
+    return np.array(times)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    save_dir = None
+    if args.save_path is None:
+        save_dir = tempfile.TemporaryDirectory()
+        args.save_path = save_dir.name
+
+    results = []
+    print(
+        f"{'clustering':>12} | {'assoc':>5} | {'points':>7} | {'stage':>11} | "
+        f"{'p50 [ms]':>9} | {'p95 [ms]':>9} | {'p99 [ms]':>9} | {'fps':>7}"
+    )
+    for clustering in args.clustering:
+        for association in args.association:
+            segmenter = build_segmenter(args, clustering, association, args.save_path)
+            for num_points in args.num_points:
+                times = run(args, segmenter, num_points)
+                stages = list(PanSegmenter.STAGES) + ["total"]
+                times = np.concatenate((times, times.sum(1, keepdims=True)), axis=1)
+                for stage, t in zip(stages, times.T * 1e3):
+                    p50, p95, p99 = np.percentile(t, [50, 95, 99])
+                    fps = 1e3 / t.mean()
+                    results.append(
+                        {
+                            "clustering": clustering,
+                            "association": association,
+                            "num_points": num_points,
+                            "stage": stage,
+                            "p50_ms": p50,
+                            "p95_ms": p95,
+                            "p99_ms": p99,
+                            "fps": fps,
+                        }
+                    )
+                    print(
+                        f"{clustering:>12} | {association:>5} | {num_points:>7} | "
+                        f"{stage:>11} | {p50:>9.1f} | {p95:>9.1f} | {p99:>9.1f} | "
+                        f"{fps:>7.1f}"
+                    )
+            segmenter.close()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if save_dir is not None:
+        save_dir.cleanup()
@@ -0,0 +1,162 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+
+def random_boxes(
+    rng: np.random.Generator,
+    num_boxes: int,
+    classes: List[int],
+    radius: float = 40.0,
+) -> np.ndarray:
+    """
+    Sample random boxes standing on the ground.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        num_boxes (int): Number of boxes.
+        classes (List[int]): Classes to sample the box class from.
+        radius (float): Maximum distance of the box center from the sensor.
+
+    Returns:
+        np.ndarray: Boxes of shape (num_boxes, 7) - center xyz, size xyz, class.
+    """
+    dist = rng.uniform(5.0, radius, num_boxes)
+    angle = rng.uniform(-np.pi, np.pi, num_boxes)
+    size = rng.uniform((0.5, 0.5, 1.0), (6.0, 2.5, 3.0), (num_boxes, 3))
+    center = np.stack(
+        (dist * np.cos(angle), dist * np.sin(angle), size[:, 2] / 2 - 1.8), axis=1
+    )
+    cls = rng.choice(classes, num_boxes)
+    return np.concatenate((center, size, cls[:, None]), axis=1)
+
+
+def sample_boxes(
+    rng: np.random.Generator, boxes: np.ndarray, num_points: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sample points on the surface of boxes, the number of points of a box is
+    proportional to its surface.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: xyz of shape (num_points, 3),
+            class and index of the box of each point.
+    """
+    size = boxes[:, 3:6]
+    area = 2 * (size[:, 0] * size[:, 1] + size[:, 0] * size[:, 2] + size[:, 1] * size[:, 2])
+    box_id = rng.choice(boxes.shape[0], num_points, p=area / area.sum())
+
+    # random point in the box pushed to the closest face
+    local = rng.uniform(-0.5, 0.5, (num_points, 3))
+    face = np.abs(local).argmax(axis=1)
+    local[np.arange(num_points), face] = np.sign(local[np.arange(num_points), face]) * 0.5
+
+    xyz = boxes[box_id, :3] + local * size[box_id]
+    return xyz, boxes[box_id, 6].astype(np.int64), box_id
+
+
+def make_sweep(
+    rng: np.random.Generator,
+    num_points: int,
+    objects: np.ndarray,
+    structures: np.ndarray,
+    ground_class: int,
+    object_ratio: float = 0.2,
+    structure_ratio: float = 0.2,
+    radius: float = 50.0,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generate a synthetic lidar sweep with ground, static structures and objects.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        num_points (int): Number of points of the sweep.
+        objects (np.ndarray): Foreground objects of shape (M, 7), see random_boxes.
+        structures (np.ndarray): Static structures of shape (S, 7), see random_boxes.
+        ground_class (int): Class of the ground points.
+        object_ratio (float): Ratio of points sampled on objects.
+        structure_ratio (float): Ratio of points sampled on static structures.
+        radius (float): Radius of the ground disk.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            - Points of shape (N, 4) - xyz + intensity.
+            - Semantic class of each point of shape (N,).
+            - Instance id of each point of shape (N,), 0 for ground and structures,
+              index of the object + 1 otherwise.
+    """
+    num_obj = int(num_points * object_ratio) if objects.shape[0] > 0 else 0
+    num_struct = int(num_points * structure_ratio) if structures.shape[0] > 0 else 0
+    num_ground = num_points - num_obj - num_struct
+
+    # ground -- denser close to the sensor, as in a real sweep
+    dist = rng.uniform(2.0, radius, num_ground)
+    angle = rng.uniform(-np.pi, np.pi, num_ground)
+    ground = np.stack(
+        (
+            dist * np.cos(angle),
+            dist * np.sin(angle),
+            rng.normal(-1.8, 0.03, num_ground),
+        ),
+        axis=1,
+    )
+    xyz, sem, inst = [ground], [np.full(num_ground, ground_class)], [np.zeros(num_ground)]
+
+    if num_struct > 0:
+        pts, cls, _ = sample_boxes(rng, structures, num_struct)
+        xyz.append(pts)
+        sem.append(cls)
+        inst.append(np.zeros(num_struct))
+    if num_obj > 0:
+        pts, cls, box_id = sample_boxes(rng, objects, num_obj)
+        xyz.append(pts)
+        sem.append(cls)
+        inst.append(box_id + 1)
+
+    xyz = np.concatenate(xyz).astype(np.float32)
+    intensity = rng.uniform(0.0, 1.0, (xyz.shape[0], 1)).astype(np.float32)
+    return (
+        np.concatenate((xyz, intensity), axis=1),
+        np.concatenate(sem).astype(np.int64),
+        np.concatenate(inst).astype(np.int64),
+    )
+
+
+def make_sequence(
+    rng: np.random.Generator,
+    num_frames: int,
+    num_points: int,
+    fore_classes: List[int],
+    ground_class: int,
+    static_class: int,
+    num_objects: int = 20,
+    num_structures: int = 10,
+    max_speed: float = 10.0,
+    dt: float = 0.1,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Generate a sequence of sweeps with static structures and objects moving at
+    constant velocity, seen from a static sensor.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        num_frames (int): Number of sweeps.
+        num_points (int): Number of points of each sweep.
+        fore_classes (List[int]): Classes of the moving objects.
+        ground_class (int): Class of the ground points.
+        static_class (int): Class of the static structures.
+        num_objects (int): Number of moving objects.
+        num_structures (int): Number of static structures.
+        max_speed (float): Maximum speed of the objects in m/s.
+        dt (float): Time between two sweeps in seconds.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Sweep as returned by make_sweep.
+    """
+    objects = random_boxes(rng, num_objects, fore_classes)
+    structures = random_boxes(rng, num_structures, [static_class])
+    velocity = rng.uniform(-max_speed, max_speed, (num_objects, 2))
+
+    for _ in range(num_frames):
+        yield make_sweep(rng, num_points, objects, structures, ground_class)
+        objects[:, :2] += velocity * dt
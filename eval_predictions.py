@@ -0,0 +1,110 @@
+import os
+import argparse
+
+import numpy as np
+
+from utils.eval import EvalPQ4D
+from utils.archive import open_predictions
+from utils.dataloaders import get_datasets
+from utils.misc import get_frame_name, load_config, process_configs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Evaluate saved 4D panoptic predictions offline"
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="nuscenes",
+        choices=["nuscenes", "semantic_kitti"],
+        help="Dataset name",
+    )
+    parser.add_argument(
+        "--path_dataset", type=str, required=True, help="Path to dataset"
+    )
+    parser.add_argument(
+        "--predictions",
+        type=str,
+        required=True,
+        help="Save path of pan_seg_main.py, .label files or archives",
+    )
+    parser.add_argument(
+        "--config_pretrain",
+        type=str,
+        default="ScaLR/configs/pretrain/WI_768_pretrain.yaml",
+        help="Path to config for pretraining",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", default=False, help="Verbose debug messages"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # Only the validation split has labels, frames are not preprocessed
+    args.eval = True
+    args.test = False
+    args.clustering = None
+    args.short = False
+    args.cache_dir = None
+
+    config_panseg = load_config("configs/config.yaml")
+    config_pretrain = load_config(args.config_pretrain)
+    config_model = load_config(config_panseg[args.dataset]["config_downstream"])
+    process_configs(args, config_panseg, config_pretrain, config_model)
+
+    dataset = get_datasets(config_model, args)
+    evaluator = EvalPQ4D(
+        config_model["classif"]["nb_class"], config_panseg["ignore_classes"]
+    )
+
+    # Saved SemanticKITTI predictions use the original label ids
+    if args.dataset == "semantic_kitti":
+        sem_kitti = load_config("configs/semantic-kitti.yaml")
+        mapper = np.vectorize(sem_kitti["learning_map"].__getitem__)
+
+    readers = {}
+    missing = 0
+    for index in range(len(dataset)):
+        _, labels, filename = dataset.load_pc(index)
+        sem_labels, instance_labels = dataset.get_panoptic_labels(index)
+        if sem_labels is not None:
+            labels = sem_labels
+        _, scene, _ = dataset.get_ego_motion(index)
+
+        if scene["name"] not in readers:
+            scene_dir = os.path.join(args.predictions, scene["name"])
+            readers[scene["name"]] = (
+                open_predictions(scene_dir) if os.path.isdir(scene_dir) else None
+            )
+        reader = readers[scene["name"]]
+
+        name = get_frame_name(filename)
+        if reader is None or name not in reader:
+            missing += 1
+            continue
+        pred_sem, pred_inst = reader.read(name)
+        if args.dataset == "semantic_kitti":
+            pred_sem = mapper(pred_sem) - 1
+
+        evaluator.update(
+            scene["token"],
+            pred_sem.astype(np.int64),
+            pred_inst.astype(np.int64),
+            labels,
+            instance_labels,
+        )
+
+        if (index + 1) % 100 == 0 and args.verbose:
+            print(f"{index + 1} / {len(dataset)} frames evaluated")
+
+    if missing > 0:
+        print(f"Predictions of {missing} frames not found")
+
+    LSTQ, AQ_ovr, AQ, AQ_p, AQ_r, iou, iou_mean, iou_p, iou_r = evaluator.compute()
+    print(f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\nAQ: {AQ},\nAQ_p: {AQ_p},\nAQ_r: {AQ_r}")
+    print(f"iou: {iou},\niou_mean: {iou_mean},\niou_p: {iou_p},\niou_r: {iou_r}")
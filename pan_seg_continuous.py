@@ -1,6 +1,8 @@
 import os
 import time
 import argparse
+from dataclasses import dataclass
+from typing import Optional
 
 import torch
 import numpy as np
@@ -9,11 +11,16 @@ from scipy.spatial import KDTree
 from WaffleIron.waffleiron import Segmenter
 import WaffleIron.utils.transforms as tr
 
+from ScaLR.datasets.pc_dataset import zero_pad, voxel_upsample
+
+from utils import tracing
+from utils.archive import Archive_writer
+from utils.pipeline import pipeline, micro_batches
 from utils.clustering import Clusterer
 from utils.association import association, long_association
 from utils.misc import (
     Obj_cache,
-    save_data,
+    Prediction_writer,
     process_configs,
     print_config_cont,
     load_config,
@@ -21,8 +28,28 @@ from utils.misc import (
 )
 
 
+@dataclass
+class Stream_state:
+    """Tracking state of one input stream."""
+
+    obj_cache: Obj_cache
+    prev_ind: Optional[torch.Tensor] = None
+    prev_scene: Optional[dict] = None
+    prev_points: Optional[torch.Tensor] = None
+
+
 class PanSegmenter:
-    def __init__(self, args):
+    # Stages timed in data["times"], in order
+    STAGES = ("preprocess", "backbone", "clustering", "association", "save")
+
+    def __init__(self, args, model_overrides=None):
+        """
+        Args:
+            args (argparse.Namespace): The arguments passed to the script.
+            model_overrides (dict, optional): Values replacing the "waffleiron"
+                section of the model config, e.g. depth or nb_channels.
+                Without args.pretrained_ckpt the model is randomly initialized.
+        """
         self.args = args
 
         # Set device
@@ -44,12 +71,20 @@ class PanSegmenter:
         config_model = load_config(config_panseg[args.dataset]["config_downstream"])
 
         process_configs(args, config_panseg, config_pretrain, config_model)
+        if model_overrides is not None:
+            config_model["waffleiron"].update(model_overrides)
         self.config_msg = print_config_cont(args, config_panseg)
         if args.save_path is not None:
             if not os.path.exists(args.save_path):
                 os.makedirs(args.save_path)
             with open(f"{args.save_path}/config.txt", "w") as f:
                 f.write(self.config_msg)
+            sink = None
+            if args.save_format == "archive":
+                sink = Archive_writer(args.save_path)
+            self.writer = Prediction_writer(args.save_path, sink=sink)
+        else:
+            self.writer = None
 
         self.config = config_panseg
 
@@ -111,28 +146,35 @@ class PanSegmenter:
         )
 
         # Load pretrained model
-        ckpt = torch.load(args.pretrained_ckpt, map_location="cpu", weights_only=True)
-        ckpt = ckpt["net"]
-        new_ckpt = {}
-        for k in ckpt.keys():
-            if k.startswith("module"):
-                new_ckpt[k[len("module.") :]] = ckpt[k]
-            else:
-                new_ckpt[k] = ckpt[k]
+        if args.pretrained_ckpt is not None:
+            ckpt = torch.load(
+                args.pretrained_ckpt, map_location="cpu", weights_only=True
+            )
+            ckpt = ckpt["net"]
+            new_ckpt = {}
+            for k in ckpt.keys():
+                if k.startswith("module"):
+                    new_ckpt[k[len("module.") :]] = ckpt[k]
+                else:
+                    new_ckpt[k] = ckpt[k]
+            self.model.load_state_dict(new_ckpt)
 
         # Set model to evaluation mode
-        self.model.load_state_dict(new_ckpt)
         self.model = self.model.to(device)
         if torch.cuda.is_available():
             self.model.compile()
         self.model.eval()
 
         # Initialize
-        self.prev_ind = None
-        self.prev_scene = None
-        self.prev_points = None
+        self.num_classes = config_model["classif"]["nb_class"]
         self.clusterer = Clusterer(config_panseg)
-        self.obj_cache = Obj_cache(config_model["classif"]["nb_class"])
+        self.streams = {}
+
+    def _get_stream(self, stream_id):
+        """Return the tracking state of a stream, create it for a new stream"""
+        if stream_id not in self.streams:
+            self.streams[stream_id] = Stream_state(Obj_cache(self.num_classes))
+        return self.streams[stream_id]
 
     def _get_occupied_2d_cells(self, pc):
         """Return mapping between 3D point and corresponding 2D cell"""
@@ -179,15 +221,18 @@ class PanSegmenter:
                 raise ValueError(f"Unknown feature: {type}")
         return np.concatenate(pc, 1)
 
+    @tracing.traced("preprocess")
     def _preprocess(self, data):
+        start = time.time()
+
         # Prepare input feature
         pc_orig = self._prepare_input_features(data["points"])
 
         # Voxelization
-        pc, _ = self._downsample(pc_orig, None)
+        pc, _, inverse = self._downsample(pc_orig, None, return_inverse=True)
 
         # Crop to fov
-        pc, _ = self._crop_to_fov(pc, None)
+        pc, _, where = self._crop_to_fov(pc, None, return_mask=True)
         feat = pc[:, 3:].T
 
         # For each point, get index of corresponding 2D cells on projected grid
@@ -198,47 +243,80 @@ class PanSegmenter:
         assert pc.shape[0] > self.num_neighbors
         _, neighbors_emb = kdtree.query(pc[:, :3], k=self.num_neighbors + 1)
 
-        # Nearest neighbor interpolation to undo cropping & voxelisation
-        _, upsample = kdtree.query(pc_orig[:, :3], k=1)
+        # Undo cropping & voxelisation: voxel of each point, nearest neighbor for cropped points
+        upsample = voxel_upsample(inverse, where, kdtree, pc_orig)
 
+        # network inputs stay on host until batched in _segment_batch
         out = {
-            "feat": torch.from_numpy(feat[None]).to(self.device),
-            "neighbors_emb": torch.from_numpy(neighbors_emb.T[None]).to(self.device),
-            "cell_ind": torch.from_numpy(cell_ind[None]).to(self.device),
-            "occupied_cells": torch.ones(feat.shape[-1]).unsqueeze(0).to(self.device),
+            "feat": feat[None],
+            "neighbors_emb": neighbors_emb.T[None],
+            "cell_ind": cell_ind[None],
             "upsample": torch.from_numpy(upsample).to(self.device),
             "ego": torch.from_numpy(data["ego"]).to(self.device),
             "scene": data["scene"],
             "sample": data["sample"],
+            "stream": data.get("stream"),
+            "times": [time.time() - start],
         }
 
         return out
 
-    def __call__(self, data):
-        times = [time.time()]
+    @tracing.traced("backbone")
+    def _segment_batch(self, batch):
+        """Run the network once on a list of preprocessed frames"""
+        start = time.time()
+
+        # zero-pad frames to the largest one and stack them along batch dimension
+        num_points = [data["feat"].shape[-1] for data in batch]
+        feat, neighbors_emb, cell_ind, occupied_cells = [], [], [], []
+        for data, n in zip(batch, num_points):
+            padded = zero_pad(
+                data["feat"],
+                data["neighbors_emb"],
+                data["cell_ind"],
+                np.zeros((1, 0, n)),
+                max(num_points),
+            )
+            feat.append(padded[0])
+            neighbors_emb.append(padded[1])
+            cell_ind.append(padded[2])
+            occupied_cells.append(padded[3])
 
         # network inputs
-        data = self._preprocess(data)
         net_inputs = (
-            data["feat"],
-            data["cell_ind"],
-            data["occupied_cells"],
-            data["neighbors_emb"],
+            torch.from_numpy(np.vstack(feat)).float().to(self.device),
+            torch.from_numpy(np.vstack(cell_ind)).long().to(self.device),
+            torch.from_numpy(np.vstack(occupied_cells)).float().to(self.device),
+            torch.from_numpy(np.vstack(neighbors_emb)).long().to(self.device),
         )
-        times.append(time.time())
 
         # get semantic class prediction
         with torch.inference_mode():
             out, tokens = self.model(*net_inputs)
-        out = out[0].argmax(dim=0)
-        times.append(time.time())
+
+        # hand the unpadded results back to each frame
+        duration = time.time() - start
+        for i, (data, n) in enumerate(zip(batch, num_points)):
+            data["feat"] = net_inputs[0][i : i + 1, :, :n]
+            data["out"] = out[i, :, :n].argmax(dim=0)
+            data["tokens"] = tokens[i : i + 1, :, :n]
+            data["times"].append(duration)
+        return batch
+
+    def _segment(self, data):
+        return self._segment_batch([data])[0]
+
+    @tracing.traced("instance_prep")
+    def _cluster(self, data):
+        start = time.time()
 
         # upsample to original resolution
-        out_upsample = out[data["upsample"]]
+        with tracing.span("upsample"):
+            out_upsample = data["out"][data["upsample"]]
 
-        # get instance prediction
-        src_points = data["feat"][0, 1:4, data["upsample"]].T
-        src_features = tokens[0, :, data["upsample"]].T
+            # get instance prediction
+            src_points = data["feat"][0, 1:4, data["upsample"]].T
+            src_features = data["tokens"][0, :, data["upsample"]].T
 
         # ego motion compensation
         src_points_ego = transform_pointcloud(src_points, data["ego"])
@@ -251,74 +329,137 @@ class PanSegmenter:
         src_labels = self.clusterer.get_semantic_clustering(src_points)
 
         # create data - ego compensated xyz + features + semantic class + cluster id
-        src_points = torch.cat(
+        data["src_points"] = torch.cat(
             (src_points_ego, src_features, src_pred, src_labels.unsqueeze(1)), axis=1
         )
-        times.append(time.time())
+        data["src_pred"] = src_pred
+
+        data["times"].append(time.time() - start)
+        return data
+
+    @tracing.traced("associate")
+    def _associate(self, data):
+        start = time.time()
+        src_points = data["src_points"]
+        state = self._get_stream(data["stream"])
 
         # associate -- set temporally consistent instance id
         ind_src = None
         if (
-            self.prev_scene is None
-            or not self.prev_scene["token"] == data["scene"]["token"]
+            state.prev_scene is None
+            or not state.prev_scene["token"] == data["scene"]["token"]
         ):
-            self.prev_ind = None
-            self.obj_cache.reset()
-            self.prev_points = torch.zeros_like(src_points)
+            state.prev_ind = None
+            state.obj_cache.reset()
+            state.prev_points = torch.zeros_like(src_points)
 
         if self.config["association"]["use_long"]:
             _, ind_src = long_association(
-                self.prev_points,
+                state.prev_points,
                 src_points,
                 self.config,
-                self.prev_ind,
-                self.obj_cache,
+                state.prev_ind,
+                state.obj_cache,
                 None,
             )
         else:
             _, ind_src = association(
-                self.prev_points,
+                state.prev_points,
                 src_points,
                 self.config,
-                self.prev_ind,
-                self.obj_cache,
+                state.prev_ind,
+                state.obj_cache,
                 None,
             )
-        self.prev_ind = ind_src
-        self.obj_cache.max_id = int(
-            max(self.obj_cache.max_id, self.prev_ind.max(), ind_src.max())
+        state.prev_ind = ind_src
+        state.obj_cache.max_id = int(
+            max(state.obj_cache.max_id, state.prev_ind.max(), ind_src.max())
         )
 
-        self.prev_points = src_points
-        self.prev_scene = data["scene"]
-        times.append(time.time())
+        state.prev_points = src_points
+        state.prev_scene = data["scene"]
+        data["ind_src"] = ind_src
 
-        if self.args.verbose:
-            print(
-                f"Total time: {times[-1] - times[0]:.2f} s\n"
-                f"  SemSeg data prep: {times[1] - times[0]:.2f} | "
-                f"Semantic segmentation: {times[2] - times[1]:.2f} | "
-                f"InsSeg data prep: {times[3] - times[2]:.2f} | "
-                f"Instance association: {times[4] - times[3]:.2f} | "
-            )
+        data["times"].append(time.time() - start)
+        return data
+
+    @tracing.traced("save")
+    def _save(self, data):
+        start = time.time()
 
-        src_pred = src_pred.cpu().numpy().squeeze()
-        ind_src = ind_src.cpu().numpy()
+        src_pred = data["src_pred"].cpu().numpy().squeeze()
+        ind_src = data["ind_src"].cpu().numpy()
 
         # save segmentation files
-        if self.args.save_path is not None:
+        if self.writer is not None:
             if self.args.dataset == "semantic_kitti":
                 src_pred = self.mapper(src_pred)
-            save_data(
-                self.args.save_path,
-                data["scene"]["name"],
-                data["sample"],
-                src_pred,
-                ind_src,
+            self.writer.write(data["scene"]["name"], data["sample"], src_pred, ind_src)
+
+        times = data["times"]
+        times.append(time.time() - start)
+        if self.args.verbose:
+            print(
+                f"Total time: {sum(times):.2f} s\n"
+                f"  SemSeg data prep: {times[0]:.2f} | "
+                f"Semantic segmentation: {times[1]:.2f} | "
+                f"InsSeg data prep: {times[2]:.2f} | "
+                f"Instance association: {times[3]:.2f} | "
+                f"Save: {times[4]:.2f} | "
             )
 
         return src_pred, ind_src
 
+    def _postprocess(self, data):
+        return self._save(self._associate(self._cluster(data)))
+
+    def _postprocess_batch(self, batch):
+        return [self._postprocess(data) for data in batch]
+
+    def __call__(self, data):
+        data = self._preprocess(data)
+        data = self._segment(data)
+        return self._postprocess(data)
+
+    def stream(self, frames, queue_size=2, batch_size=1):
+        """
+        Pipelined version of __call__ over a sequence of frames.
+
+        Preprocessing, the network and the instance stages (clustering,
+        association and saving) run in separate threads connected by bounded
+        queues, i.e. frame t+1 is preprocessed and frame t-1 associated while
+        frame t is in the network. Frames are processed in order, so the
+        tracking state is the same as with sequential calls.
+
+        Frames may come from several streams (e.g. several lidars), given by
+        the optional "stream" key of the frame. Each stream keeps its own
+        tracking state, and up to batch_size preprocessed frames that are
+        already waiting, from any streams, are zero-padded into one forward
+        pass of the network. The network never waits for a full batch.
+
+        Args:
+            frames (Iterable[dict]): Frames as accepted by __call__.
+            queue_size (int): Maximum number of frames waiting between stages.
+            batch_size (int): Maximum number of frames in one forward pass.
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray]: Semantic and instance prediction of
+                each frame, in the input order.
+        """
+        frames = pipeline(frames, [self._preprocess], queue_size=queue_size)
+        batches = micro_batches(frames, batch_size, queue_size=queue_size)
+        for batch in pipeline(
+            batches,
+            [self._segment_batch, self._postprocess_batch],
+            queue_size=queue_size,
+        ):
+            yield from batch
+
+    def close(self):
+        """Wait until all segmentation files are written."""
+        if self.writer is not None:
+            self.writer.close()
+
     def __str__(self):
         return f"PanSegmenter({self.config_msg})"
 
@@ -334,8 +475,9 @@ def parse_args():
     parser.add_argument(
         "--path_dataset",
         type=str,
-        help="Path to dataset",
-        default="/mnt/personal/vlkjan6/PONE/val",
+        nargs="+",
+        help="Path to dataset, one input stream per path",
+        default=["/mnt/personal/vlkjan6/PONE/val"],
     )
     parser.add_argument(
         "--config_pretrain",
@@ -363,6 +505,13 @@ def parse_args():
     parser.add_argument(
         "--save_path", type=str, default=None, help="Path to save segmentation files"
     )
+    parser.add_argument(
+        "--save_format",
+        type=str,
+        default="label",
+        choices=["label", "archive"],
+        help="One .label file per frame, or one archive file per scene",
+    )
     parser.add_argument(
         "--clustering", type=str, default=None, help="Clustering method"
     )
@@ -375,10 +524,88 @@ def parse_args():
     parser.add_argument(
         "--verbose", action="store_true", default=False, help="Verbose mode"
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="Overlap preprocessing, inference and association of consecutive frames",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=2,
+        help="Maximum number of frames waiting between pipeline stages",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Save a Chrome trace (JSON) of the run to this path",
+    )
+    parser.add_argument(
+        "--stream_batch",
+        type=int,
+        default=1,
+        help="Maximum number of frames of all streams in one network forward pass",
+    )
 
     return parser.parse_args()
 
 
+def load_frames(args, path_dataset, stream=None):
+    """Yield the frames of path_dataset in the format expected by PanSegmenter."""
+    if args.dataset == "semantic_kitti":
+        poses = np.loadtxt(os.path.join(path_dataset, "../poses.txt")).reshape(
+            -1, 3, 4
+        )
+        pose_0 = np.vstack([poses[0], np.array([0, 0, 0, 1])])
+
+    for i, item in enumerate(sorted(os.listdir(path_dataset))):
+        if args.dataset == "pone":  # load PONE dataset
+            file = np.load(os.path.join(path_dataset, item), allow_pickle=True)
+            scene_name = item.split("/")[-1][:-9]
+            scene = {"name": scene_name, "token": scene_name}
+            data = {
+                "points": file["pcd"],
+                "ego": file["odom"]["transformation"],
+                "scene": scene,
+                "sample": item,
+                "stream": stream,
+            }
+        elif args.dataset == "semantic_kitti":  # load SemanticKITTI dataset
+            pcd = np.fromfile(
+                os.path.join(path_dataset, item), dtype=np.float32
+            ).reshape(-1, 4)
+            pose_t = np.vstack([poses[i], np.array([0, 0, 0, 1])])
+            scene_name = path_dataset.split("/")[-2]
+            scene = {"name": scene_name, "token": scene_name}
+            data = {
+                "points": pcd,
+                "ego": (np.linalg.inv(pose_0) @ pose_t).astype(np.float32),
+                "scene": scene,
+                "sample": item,
+                "stream": stream,
+            }
+        else:
+            raise ValueError(f"Dataset {args.dataset} not available.")
+
+        yield data
+
+
+def interleave_streams(args):
+    """Yield frames of all args.path_dataset round-robin, the stream id is the path index."""
+    streams = [
+        load_frames(args, path, stream=i) for i, path in enumerate(args.path_dataset)
+    ]
+    while streams:
+        for frames in list(streams):
+            data = next(frames, None)
+            if data is None:
+                streams.remove(frames)
+            else:
+                yield data
+
+
 if __name__ == "__main__":
     args = parse_args()
     args.workers = 0
@@ -401,44 +628,28 @@ if __name__ == "__main__":
         args.mean_int = 0.28613698
         args.std_int = 0.14090556
 
+    if args.trace is not None:
+        tracing.enable(torch.cuda.synchronize if torch.cuda.is_available() else None)
+
     # Initialize segmenter
     segmenter = PanSegmenter(args)
 
     try:
-        for i, item in enumerate(sorted(os.listdir(args.path_dataset))):
-            if args.dataset == "pone":  # load PONE dataset
-                file = np.load(os.path.join(args.path_dataset, item), allow_pickle=True)
-                scene_name = item.split("/")[-1][:-9]
-                scene = {"name": scene_name, "token": scene_name}
-                data = {
-                    "points": file["pcd"],
-                    "ego": file["odom"]["transformation"],
-                    "scene": scene,
-                    "sample": item,
-                }
-            elif args.dataset == "semantic_kitti":  # load SemanticKITTI dataset
-                pcd = np.fromfile(
-                    os.path.join(args.path_dataset, item), dtype=np.float32
-                ).reshape(-1, 4)
-                poses = np.loadtxt(
-                    os.path.join(args.path_dataset, "../poses.txt")
-                ).reshape(-1, 3, 4)
-                pose_t = np.vstack([poses[i], np.array([0, 0, 0, 1])])
-                pose_0 = np.vstack([poses[0], np.array([0, 0, 0, 1])])
-                scene_name = args.path_dataset.split("/")[-2]
-                scene = {"name": scene_name, "token": scene_name}
-                data = {
-                    "points": pcd,
-                    "ego": (np.linalg.inv(pose_0) @ pose_t).astype(np.float32),
-                    "scene": scene,
-                    "sample": item,
-                }
-            else:
-                raise ValueError(f"Dataset {args.dataset} not available.")
-
-            # Call segmenter
-            _, _ = segmenter(data)
+        frames = interleave_streams(args)
+        if args.pipeline or args.stream_batch > 1:
+            for _ in segmenter.stream(
+                frames, queue_size=args.queue_size, batch_size=args.stream_batch
+            ):
+                pass
+        else:
+            for data in frames:
+                # Call segmenter
+                _, _ = segmenter(data)
     except KeyboardInterrupt:
         print("Keyboard interrupt, exiting...")
     except Exception as e:
         raise e
+    finally:
+        segmenter.close()
+        if args.trace is not None:
+            tracing.dump(args.trace)
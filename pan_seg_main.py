@@ -1,23 +1,26 @@
 import os
+import sys
 import time
 import argparse
+import tempfile
+import subprocess
 
 import torch
 import numpy as np
 
 from WaffleIron.waffleiron import Segmenter
 
+from utils import tracing
 from utils.eval import EvalPQ4D
 from utils.clustering import Clusterer
-from utils.dataloaders import get_dataloader, get_datasets
-from utils.association import association, long_association
+from utils.dataloaders import get_dataloader, get_datasets, shard_indices
+from utils.archive import Archive_writer
+from utils.streaming import Stream_engine, split_batch
 from utils.misc import (
-    Obj_cache,
-    save_data,
+    Prediction_writer,
     print_config,
     process_configs,
     load_config,
-    transform_pointcloud,
 )
 
 
@@ -95,19 +98,135 @@ def parse_args():
         "--flow", action="store_true", default=False, help="Use flow estimation"
     )
     parser.add_argument("--batch_size", type=int, default=4, help="Batch size")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of data loading workers, frames are still processed in order",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of batches prefetched by each data loading worker",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Save a Chrome trace (JSON) of the run to this path",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache preprocessed frames, reused by later runs",
+    )
+    parser.add_argument(
+        "--save_format",
+        type=str,
+        default="label",
+        choices=["label", "archive"],
+        help="One .label file per frame, or one archive file per scene",
+    )
+    parser.add_argument(
+        "--save_workers",
+        type=int,
+        default=2,
+        help="Number of threads writing segmentation files",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the scenes into shards, each evaluated by its own process",
+    )
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=None,
+        help="Only run this shard, e.g. one shard per node",
+    )
+    parser.add_argument(
+        "--eval_state",
+        type=str,
+        default=None,
+        help="Save the evaluation state to this path, to be merged with --merge",
+    )
+    parser.add_argument(
+        "--merge",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only merge evaluation states saved with --eval_state and report metrics",
+    )
 
     return parser.parse_args()
 
 
+def launch_shards(args, state_dir):
+    """
+    Run every shard in its own process, shards are spread over the visible GPUs.
+
+    Returns:
+        List[str]: Paths of the evaluation states of the shards, in shard order.
+    """
+    num_gpus = torch.cuda.device_count()
+    procs, paths = [], []
+    for shard_id in range(args.num_shards):
+        path = os.path.join(state_dir, f"shard_{shard_id}.pkl")
+        cmd = [sys.executable, *sys.argv]
+        cmd += ["--shard_id", str(shard_id), "--eval_state", path]
+        if args.gpu is None and num_gpus > 0:
+            cmd += ["--gpu", str(shard_id % num_gpus)]
+        procs.append(subprocess.Popen(cmd))
+        paths.append(path)
+
+    failed = [shard_id for shard_id, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed")
+
+    return paths
+
+
+def report(evaluator, config_msg):
+    """Print the final metrics and log them to results/"""
+    LSTQ, AQ_ovr, AQ, AQ_p, AQ_r, iou, iou_mean, iou_p, iou_r = evaluator.compute()
+    print(f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\nAQ: {AQ},\nAQ_p: {AQ_p},\nAQ_r: {AQ_r}")
+    print(f"iou: {iou},\niou_mean: {iou_mean},\niou_p: {iou_p},\niou_r: {iou_r}")
+
+    if np.isnan(LSTQ):
+        return
+
+    with open(
+        time.strftime("results/Log_%Y-%m-%d_%H-%M-%S.out", time.gmtime()), "w"
+    ) as fh:
+        fh.write(f"Config:\n{config_msg}\n\n")
+        fh.write(
+            f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\nAQ: {AQ},\nAQ_p: {AQ_p},\nAQ_r: {AQ_r}\n"
+        )
+        fh.write(
+            f"iou: {iou},\niou_mean: {iou_mean},\niou_p: {iou_p},\niou_r: {iou_r}\n"
+        )
+
+
 if __name__ == "__main__":
     args = parse_args()
-    args.workers = 0
+    if args.workers < 0:
+        raise ValueError("Number of workers must be non-negative")
     if args.batch_size < 1:
         raise ValueError("Batch size must be greater than 0")
-    elif args.batch_size == 1:
-        raise ValueError(
-            "Batch size of 1 is not supported, for batch size of 1 use pan_seg_continuous.py"
-        )
+    if args.num_shards < 1:
+        raise ValueError("Number of shards must be greater than 0")
+    if args.shard_id is not None:
+        if not 0 <= args.shard_id < args.num_shards:
+            raise ValueError(f"Shard id must be in [0, {args.num_shards})")
+        if args.trace is not None:
+            root, ext = os.path.splitext(args.trace)
+            args.trace = f"{root}_shard{args.shard_id}{ext}"
+
+    if args.trace is not None:
+        tracing.enable(torch.cuda.synchronize if torch.cuda.is_available() else None)
 
     # Load config files
     config_panseg = load_config("configs/config.yaml")
@@ -126,6 +245,23 @@ if __name__ == "__main__":
         with open(f"{args.save_path}/config.txt", "w") as f:
             f.write(config_msg)
 
+    evaluator = EvalPQ4D(
+        config_model["classif"]["nb_class"], config_panseg["ignore_classes"]
+    )
+
+    # Merge the evaluation of shards instead of running inference
+    if args.merge is not None:
+        for path in args.merge:
+            evaluator.merge(EvalPQ4D.load(path))
+        report(evaluator, config_msg)
+        exit()
+    if args.num_shards > 1 and args.shard_id is None:
+        with tempfile.TemporaryDirectory() as state_dir:
+            for path in launch_shards(args, state_dir):
+                evaluator.merge(EvalPQ4D.load(path))
+        report(evaluator, config_msg)
+        exit()
+
     # Build network
     model = Segmenter(
         input_channels=config_model["embedding"]["size_input"],
@@ -152,6 +288,9 @@ if __name__ == "__main__":
 
     # Load dataset
     dataset = get_datasets(config_model, args)
+    if args.shard_id is not None:
+        indices = shard_indices(dataset, args.num_shards, args.shard_id)
+        dataset = torch.utils.data.Subset(dataset, indices)
     dataloader = get_dataloader(dataset, args)
 
     # Load pretrained model
@@ -180,224 +319,89 @@ if __name__ == "__main__":
     model.eval()
 
     # Initialize
-    prev_ind = None
-    prev_scene = None
-    prev_points = None
     clusterer = Clusterer(config_panseg)
-    ind_cache = Obj_cache(config_model["classif"]["nb_class"])
-    evaluator = EvalPQ4D(
-        config_model["classif"]["nb_class"], config_panseg["ignore_classes"]
-    )
+    engine = Stream_engine(config_panseg, config_model["classif"]["nb_class"])
+
+    writer = None
+    if args.save_path is not None:
+        sink = None
+        if args.save_format == "archive":
+            sink = Archive_writer(args.save_path)
+        writer = Prediction_writer(
+            args.save_path, workers=args.save_workers, sink=sink
+        )
 
     # For SemanticKITTI initialize inverse mapping
     if args.dataset == "semantic_kitti":
         sem_kitti = load_config("configs/semantic-kitti.yaml")
         mapper = np.vectorize(sem_kitti["learning_map_inv"].__getitem__)
 
-    for i, batch in enumerate(dataloader):
-        # network inputs
-        feat = batch["feat"].to(device)
-        cell_ind = batch["cell_ind"].to(device)
-        occupied_cell = batch["occupied_cells"].to(device)
-        neighbors_emb = batch["neighbors_emb"].to(device)
-        net_inputs = (feat, cell_ind, occupied_cell, neighbors_emb)
-
-        # other variables
-        labels = batch["labels_orig"]
-        inst_lab = batch["instance_labels"]
-        scene_flow = batch["scene_flow"].to(device)
-
-        # get semantic class prediction
-        with torch.inference_mode():
-            out, tokens = model(*net_inputs)
-
-        # upsample to original resolution
-        out_upsample = []
-        batch["upsample"] = [up.to(device) for up in batch["upsample"]]
-        for id_b, closest_point in enumerate(batch["upsample"]):
-            temp = out[id_b, :, closest_point]
-            out_upsample.append(temp.T)
-
-        # get instance prediction
-        s_idx = 0
-        instances = {}
-        predictions = {}
-        batch_size = batch["feat"].shape[0]
-        for src_id, dst_id in zip(range(0, batch_size - 1), range(1, batch_size)):
-            src_points = feat[src_id, 1:4, batch["upsample"][src_id]].T
-            dst_points = feat[dst_id, 1:4, batch["upsample"][dst_id]].T
-
-            src_features = tokens[src_id, :, batch["upsample"][src_id]].T
-            dst_features = tokens[dst_id, :, batch["upsample"][dst_id]].T
-
-            if args.flow:
-                flow = scene_flow[src_id, :, batch["upsample"][src_id]].T
-            else:
-                flow = None
-
-            # ego motion compensation
-            src_points_ego = transform_pointcloud(
-                src_points, batch["ego"][src_id].to(device)
-            )
-            dst_points_ego = transform_pointcloud(
-                dst_points, batch["ego"][dst_id].to(device)
-            )
+    def finish(frame, ind):
+        """Evaluate and save a frame with its final instance ids"""
+        pred = frame.pred.cpu().numpy()
+        ind = ind.cpu().numpy()
+        if not args.test:
+            with tracing.span("evaluation"):
+                evaluator.update(
+                    frame.scene["token"],
+                    pred,
+                    ind,
+                    frame.labels,
+                    frame.instance_labels,
+                )
 
-            # get semantic class
-            if not args.use_gt:
-                src_pred = out_upsample[src_id].argmax(dim=1).unsqueeze(1)
-                dst_pred = out_upsample[dst_id].argmax(dim=1).unsqueeze(1)
-            else:
-                e_idx = s_idx + batch["upsample"][src_id].shape[0]
-                src_pred = labels[s_idx:e_idx].to(device).unsqueeze(1)
-                src_pred[src_pred == 255] = -1
-                dst_pred = labels[
-                    e_idx : e_idx + batch["upsample"][dst_id].shape[0]
-                ].to(device).unsqueeze(1)
-                dst_pred[dst_pred == 255] = -1
-                s_idx = e_idx
-
-            # clustering
-            src_points = torch.cat((src_points, src_pred), axis=1)
-            dst_points = torch.cat((dst_points, dst_pred), axis=1)
-
-            src_labels = clusterer.get_semantic_clustering(src_points)
-            dst_labels = clusterer.get_semantic_clustering(dst_points)
-
-            # create data - ego compensated xyz + features + semantic class + cluster id
-            src_points = torch.cat(
-                (src_points_ego, src_features, src_pred, src_labels.unsqueeze(1)),
-                axis=1,
+        # save segmentation files
+        if writer is not None:
+            if args.dataset == "semantic_kitti":
+                pred = mapper(pred + 1)
+            writer.write(frame.scene["name"], frame.filename, pred, ind)
+
+    i = -1
+    try:
+        for i, batch in enumerate(dataloader):
+            # network inputs
+            batch["feat"] = batch["feat"].to(device)
+            cell_ind = batch["cell_ind"].to(device)
+            occupied_cell = batch["occupied_cells"].to(device)
+            neighbors_emb = batch["neighbors_emb"].to(device)
+            net_inputs = (batch["feat"], cell_ind, occupied_cell, neighbors_emb)
+
+            # get semantic class prediction
+            with torch.inference_mode(), tracing.span("backbone"):
+                out, tokens = model(*net_inputs)
+
+            # upsample to original resolution and cluster each frame
+            with tracing.span("upsample"):
+                batch["upsample"] = [up.to(device) for up in batch["upsample"]]
+                if args.flow:
+                    batch["scene_flow"] = batch["scene_flow"].to(device)
+            frames = split_batch(
+                batch, out, tokens, clusterer, device, args.flow, args.use_gt
             )
-            dst_points = torch.cat(
-                (dst_points_ego, dst_features, dst_pred, dst_labels.unsqueeze(1)),
-                axis=1,
-            )
-
-            # associate -- set temporally consistent instance id
-            ind_src, ind_dst = None, None
-            if prev_scene is not None and src_id == 0:
-                if prev_scene["token"] == batch["scene"][src_id]["token"]:
-                    if config_panseg["association"]["use_long"]:
-                        prev_ind, ind_src = long_association(
-                            prev_points,
-                            src_points,
-                            config_panseg,
-                            prev_ind,
-                            ind_cache,
-                            prev_flow,
-                        )
-                    else:
-                        prev_ind, ind_src = association(
-                            prev_points,
-                            src_points,
-                            config_panseg,
-                            prev_ind,
-                            ind_cache,
-                            prev_flow,
-                        )
-
-                    # save segmentation files
-                    if args.save_path is not None:
-                        preds = prev_points[:, -2].cpu().numpy()
-                        if args.dataset == "semantic_kitti":
-                            preds = mapper(preds + 1)
-                        save_data(
-                            args.save_path,
-                            prev_scene["name"],
-                            prev_filename,
-                            preds,
-                            prev_ind.cpu().numpy(),
-                        )
-                    ind_cache.max_id = int(max(ind_cache.max_id, prev_ind.max(), ind_src.max()))
-                    prev_ind = ind_src
-                else:
-                    prev_ind = None
-                    ind_cache.reset()
-            if batch["scene"][src_id]["token"] == batch["scene"][dst_id]["token"]:
-                if config_panseg["association"]["use_long"]:
-                    ind_src, ind_dst = long_association(
-                        src_points, dst_points, config_panseg, prev_ind, ind_cache, flow
-                    )
-                else:
-                    ind_src, ind_dst = association(
-                        src_points, dst_points, config_panseg, prev_ind, ind_cache, flow
-                    )
-                ind_cache.max_id = int(max(ind_cache.max_id, ind_src.max(), ind_dst.max()))
-                prev_ind = ind_dst
-            else:
-                prev_ind = None
-                ind_cache.reset()
-            prev_points = dst_points
-            prev_scene = batch["scene"][dst_id]
-            prev_filename = batch["filename"][dst_id]
-            if args.flow:
-                prev_flow = scene_flow[dst_id, :, batch["upsample"][dst_id]].T
-            else:
-                prev_flow = None
-
-            if ind_src is not None and src_id not in predictions:
-                predictions[src_id] = src_pred.cpu().numpy().squeeze(1)
-                instances[src_id] = ind_src.cpu().numpy()
-            if ind_dst is not None:
-                predictions[dst_id] = dst_pred.cpu().numpy().squeeze(1)
-                instances[dst_id] = ind_dst.cpu().numpy()
-
-        # get ground truth and update evaluation
-        start_idx = 0
-        for batch_id in range(batch_size):
-            end_idx = start_idx + batch["upsample"][batch_id].shape[0]
-            if batch_id not in predictions:
-                start_idx = end_idx
-                continue
-
-            if not args.test:
-                lidarseg_labels = labels[start_idx:end_idx].cpu().numpy()
-                instance_labels = inst_lab[start_idx:end_idx].cpu().numpy()
-                start_idx = end_idx
 
-                evaluator.update(
-                    batch["scene"][batch_id]["token"],
-                    predictions[batch_id],
-                    instances[batch_id],
-                    lidarseg_labels,
-                    instance_labels,
-                )
+            # associate -- every scene is its own stream, whatever the batching
+            for frame, ind in engine.push(frames):
+                finish(frame, ind)
 
-            # save segmentation files
-            if args.save_path is not None:
-                if args.dataset == "semantic_kitti":
-                    predictions[batch_id] = mapper(predictions[batch_id] + 1)
-                save_data(
-                    args.save_path,
-                    batch["scene"][batch_id]["name"],
-                    batch["filename"][batch_id],
-                    predictions[batch_id],
-                    instances[batch_id],
+            if (i + 1) % 100 == 0 and args.verbose:
+                print("\n==========================")
+                print(
+                    f"Batch {i+1} done - {(i+1) * args.batch_size} samples processed"
                 )
+                LSTQ, AQ_ovr, _, _, _, _, iou_mean, _, _ = evaluator.compute()
+                print(f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\niou_mean: {iou_mean}")
 
-        if (i + 1) % 100 == 0 and args.verbose:
-            print("\n==========================")
-            print(f"Batch {i+1} done - {(i+1) * args.batch_size} samples processed")
-            LSTQ, AQ_ovr, _, _, _, _, iou_mean, _, _ = evaluator.compute()
-            print(f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\niou_mean: {iou_mean}")
+        for frame, ind in engine.flush():
+            finish(frame, ind)
+        if writer is not None:
+            writer.close()
+    finally:
+        if args.trace is not None:
+            tracing.dump(args.trace)
 
     print("\n==========================")
     print(f"Batch {i+1} done - {(i+1) * args.batch_size} samples processed")
-    LSTQ, AQ_ovr, AQ, AQ_p, AQ_r, iou, iou_mean, iou_p, iou_r = evaluator.compute()
-    print(f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\nAQ: {AQ},\nAQ_p: {AQ_p},\nAQ_r: {AQ_r}")
-    print(f"iou: {iou},\niou_mean: {iou_mean},\niou_p: {iou_p},\niou_r: {iou_r}")
-
-    if np.isnan(LSTQ):
-        exit()
-
-    with open(
-        time.strftime("results/Log_%Y-%m-%d_%H-%M-%S.out", time.gmtime()), "w"
-    ) as fh:
-        fh.write(f"Config:\n{config_msg}\n\n")
-        fh.write(
-            f"LSTQ: {LSTQ},\nAQ_ovr: {AQ_ovr},\nAQ: {AQ},\nAQ_p: {AQ_p},\nAQ_r: {AQ_r}\n"
-        )
-        fh.write(
-            f"iou: {iou},\niou_mean: {iou_mean},\niou_p: {iou_p},\niou_r: {iou_r}\n"
-        )
+    if args.eval_state is not None:
+        evaluator.save(args.eval_state)
+    if args.shard_id is None:
+        report(evaluator, config_msg)
@@ -1,5 +1,10 @@
 import os
+import sys
+import json
+import zipfile
 import argparse
+import tempfile
+import multiprocessing as mp
 from functools import reduce
 
 import torch
@@ -8,9 +13,17 @@ from pyquaternion import Quaternion
 from nuscenes.nuscenes import NuScenes
 from nuscenes.utils.geometry_utils import transform_matrix
 
-from utils.flow import flow_estimation_lif
+from utils import tracing
+from utils.flow import (
+    flow_estimation_lif,
+    flow_estimation_lif_batch,
+    flow_estimation_lif_multires,
+    kitti_frames,
+    load_frame,
+)
 from LetItFlow.let_it_flow import initial_clustering
-from utils.misc import load_config, transform_pointcloud
+from utils.misc import load_config
+from utils.flow_store import invalidate_store
 
 os.environ["OMP_NUM_THREADS"] = "4"
 os.environ["MKL_NUM_THREADS"] = "4"
@@ -31,7 +44,7 @@ def parse_args():
         "--gpu", default=None, type=int, help="Set to a number of gpu to use"
     )
     parser.add_argument(
-        "--restart", type=int, default=None, help="Restart from specified scene number"
+        "--restart", type=int, default=None, help="Skip scenes before this scene number"
     )
     parser.add_argument(
         "--frame",
@@ -39,6 +52,37 @@ def parse_args():
         type=int,
         help="Frame number to start from, only valid for semantic kitti",
     )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="Pairs to process, built and saved to this path if it does not exist",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Devices of the workers, assigned round-robin (e.g. cuda:0 cuda:1 cpu)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="Number of CPU threads per worker"
+    )
+    parser.add_argument(
+        "--batch_pairs",
+        type=int,
+        default=1,
+        help="Number of pairs optimized jointly by a worker",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Save a Chrome trace (JSON) of the run to this path",
+    )
 
     return parser.parse_args()
 
@@ -82,184 +126,287 @@ def get_ego_motion_nuscenes(nusc, sample):
     return ego_motion
 
 
+def build_manifest_nuscenes(args):
+    """List the (src, dst) pairs of consecutive keyframes of every scene."""
+    nusc = NuScenes(version="v1.0-trainval", dataroot=args.path_dataset, verbose=True)
+
+    def frame(sample):
+        panoptic_path = nusc.get("panoptic", sample["data"]["LIDAR_TOP"])["filename"]
+        return {
+            "points": nusc.get_sample_data_path(sample["data"]["LIDAR_TOP"]),
+            "labels": os.path.join(args.path_dataset, panoptic_path),
+            "ego": get_ego_motion_nuscenes(nusc, sample).tolist(),
+        }
+
+    pairs = []
+    for scene in nusc.scene:
+        src = nusc.get("sample", scene["first_sample_token"])
+        while src["next"]:
+            dst = nusc.get("sample", src["next"])
+            filename = f"{scene['name']}_{src['token']}_{dst['token']}.npz"
+            pairs.append(
+                {
+                    "scene": scene["name"],
+                    "output": os.path.join(args.savedir, "flow", filename),
+                    "src": frame(src),
+                    "dst": frame(dst),
+                }
+            )
+            src = dst
+
+    return pairs
+
+
+def build_manifest_kitti(args):
+    """List the (src, dst) pairs of consecutive frames of every sequence."""
+    pairs = []
+    for scene in range(22):
+        frames = kitti_frames(args.path_dataset, scene)
+        for i in range(len(frames) - 1):
+            filename = f"{scene:02d}_{i:06d}_{i+1:06}.npz"
+            pairs.append(
+                {
+                    "scene": f"{scene:02d}",
+                    "output": os.path.join(args.savedir, "dataset/flow", filename),
+                    "src": frames[i],
+                    "dst": frames[i + 1],
+                }
+            )
+
+    return pairs
+
+
+def filter_pairs(args, pairs):
+    """Drop the pairs of scenes before --restart and of frames before --frame."""
+    if args.restart is not None:
+        pairs = [
+            pair
+            for pair in pairs
+            if int(pair["scene"].split("-")[-1]) >= args.restart
+        ]
+    if args.frame > 0 and args.dataset == "semantic_kitti":
+        pairs = [
+            pair
+            for pair in pairs
+            if int(os.path.basename(pair["src"]["points"])[:-4]) >= args.frame
+        ]
+    return pairs
+
+
+def load_manifest(args):
+    """
+    Load the manifest of args.manifest, build (and save) it if missing. The
+    saved manifest lists all pairs, --restart and --frame filter the pairs
+    returned.
+    """
+    if args.manifest is not None and os.path.exists(args.manifest):
+        with open(args.manifest, "r") as f:
+            return filter_pairs(args, json.load(f))
+
+    if args.dataset == "nuscenes":
+        pairs = build_manifest_nuscenes(args)
+    elif args.dataset == "semantic_kitti":
+        pairs = build_manifest_kitti(args)
+    else:
+        raise ValueError(f"Dataset {args.dataset} not supported.")
+
+    if args.manifest is not None:
+        with open(args.manifest, "w") as f:
+            json.dump(pairs, f)
+    return filter_pairs(args, pairs)
+
+
+def is_done(path):
+    """Whether the flow file exists and can be read."""
+    if not os.path.exists(path):
+        return False
+    try:
+        with np.load(path) as data:
+            flow = data["flow"]
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return False
+    return flow.ndim == 2 and flow.shape[1] == 3
+
+
+def save_flow(path, flow, stats):
+    """Write the flow to a temporary file renamed to path, never a partial file."""
+    out_dir = os.path.dirname(path)
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(
+                f, flow=flow, iters=stats["iters"], loss=stats["loss"]
+            )
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_pair(pair, dataset, device):
+    src_points, src_labels = load_frame(pair["src"], dataset, device)
+    dst_points, dst_labels = load_frame(pair["dst"], dataset, device)
+    if src_labels is None:
+        src_points, dst_points, src_labels, dst_labels = initial_clustering(
+            src_points.cpu().numpy(),
+            dst_points.cpu().numpy(),
+            device=device,
+            eps=0.3,
+            min_samples=1,
+            z_scale=0.5,
+        )
+    return src_points, dst_points, src_labels, dst_labels
+
+
+def process_pairs(pairs, dataset, config, device):
+    """Estimate and save the flow of pairs, several pairs are optimized jointly."""
+    data = [load_pair(pair, dataset, device) for pair in pairs]
+    if config["multires"]:
+        # the levels of the pairs differ in size, pairs are optimized one by one
+        flows, stats = [], []
+        for src_points, dst_points, src_labels, dst_labels in data:
+            flow, pair_stats = flow_estimation_lif_multires(
+                config=config,
+                src_points=src_points,
+                dst_points=dst_points,
+                src_labels=src_labels,
+                dst_labels=dst_labels,
+                device=device,
+                return_stats=True,
+            )
+            flows.append(flow)
+            stats.append(pair_stats)
+    elif len(data) == 1:
+        src_points, dst_points, src_labels, dst_labels = data[0]
+        flow, stats = flow_estimation_lif(
+            config=config,
+            src_points=src_points,
+            dst_points=dst_points,
+            src_labels=src_labels,
+            dst_labels=dst_labels,
+            device=device,
+            return_stats=True,
+        )
+        flows, stats = [flow], [stats]
+    else:
+        src_points, dst_points, src_labels, dst_labels = map(list, zip(*data))
+        flows, stats = flow_estimation_lif_batch(
+            config=config,
+            src_points=src_points,
+            dst_points=dst_points,
+            src_labels=src_labels,
+            dst_labels=dst_labels,
+            device=device,
+            return_stats=True,
+        )
+
+    for pair, flow, pair_stats in zip(pairs, flows, stats):
+        with tracing.span("save_flow"):
+            save_flow(pair["output"], flow.cpu().numpy(), pair_stats)
+        # a converted store of the scene would shadow the new flow
+        flow_dir = os.path.dirname(pair["output"])
+        if invalidate_store(flow_dir, pair["scene"]):
+            print(f"Removed the flow store of {pair['scene']}, convert it again")
+    return stats
+
+
+# State of a worker process
+_worker = {}
+
+
+def _init_worker(devices, threads, dataset, config):
+    torch.set_num_threads(threads)
+    _worker["device"] = torch.device(devices.get())
+    _worker["dataset"] = dataset
+    _worker["config"] = config
+
+
+def _run_pairs(pairs):
+    try:
+        stats = process_pairs(
+            pairs, _worker["dataset"], _worker["config"], _worker["device"]
+        )
+    except Exception as e:
+        return [(pair["output"], None, f"{type(e).__name__}: {e}") for pair in pairs]
+    return [(pair["output"], s, None) for pair, s in zip(pairs, stats)]
+
+
 if __name__ == "__main__":
     args = parse_args()
     if args.savedir is None:
         args.savedir = args.path_dataset
+    if args.workers < 1:
+        raise ValueError("Number of workers must be greater than 0")
+    if args.batch_pairs < 1:
+        raise ValueError("Number of pairs per batch must be greater than 0")
 
     config = load_config("configs/let-it-flow.yaml")
-    device = "cpu"
-    if torch.cuda.is_available():
-        if args.gpu is not None:
-            device = f"cuda:{args.gpu}"
-        else:
-            device = "cuda"
-    device = torch.device(device)
-
-    if args.dataset == "nuscenes":
-        nusc = NuScenes(version="v1.0-trainval", dataroot=args.path_dataset, verbose=True)
-
-        for scene in nusc.scene:
-            if args.restart is not None:
-                scene_index = int(scene["name"].split("-")[-1])
-                if scene_index < args.restart:
-                    continue
-            print(f"Processing scene {scene['name']}")
-            src = nusc.get("sample", scene["first_sample_token"])
-            dst = nusc.get("sample", src["next"])
-            while True:
-                src_points = np.fromfile(
-                    nusc.get_sample_data(src["data"]["LIDAR_TOP"])[0], dtype=np.float32
-                )
-                src_points = torch.from_numpy(src_points.reshape(-1, 5)[:, :3]).to(
-                    device
-                )
-                dst_points = np.fromfile(
-                    nusc.get_sample_data(dst["data"]["LIDAR_TOP"])[0], dtype=np.float32
-                )
-                dst_points = torch.from_numpy(dst_points.reshape(-1, 5)[:, :3]).to(
-                    device
-                )
-
-                src_ego = get_ego_motion_nuscenes(nusc, src)
-                dst_ego = get_ego_motion_nuscenes(nusc, dst)
-
-                src_points = transform_pointcloud(src_points, src_ego)
-                dst_points = transform_pointcloud(dst_points, dst_ego)
-
-                panoptic_path = nusc.get("panoptic", src["data"]["LIDAR_TOP"])[
-                    "filename"
-                ]
-                src_labels = np.load(
-                    f"{args.path_dataset}/{panoptic_path}", allow_pickle=True
-                )["data"]
-                src_labels = (
-                    torch.from_numpy(src_labels.astype(np.int32) // 1000)
-                    .to(device)
-                    .long()
-                )
-
-                panoptic_path = nusc.get("panoptic", dst["data"]["LIDAR_TOP"])[
-                    "filename"
-                ]
-                dst_labels = np.load(
-                    f"{args.path_dataset}/{panoptic_path}", allow_pickle=True
-                )["data"]
-                dst_labels = (
-                    torch.from_numpy(dst_labels.astype(np.int32) // 1000)
-                    .to(device)
-                    .long()
-                )
-
-                flow = flow_estimation_lif(
-                    config=config,
-                    src_points=src_points,
-                    dst_points=dst_points,
-                    src_labels=src_labels,
-                    dst_labels=dst_labels,
-                    device=device,
-                )
-
-                # Save flow to disk or process it as needed
-                filename = f"{scene['name']}_{src['token']}_{dst['token']}.npz"
-                np.savez_compressed(
-                    os.path.join(args.savedir, "flow", filename),
-                    flow=flow.cpu().numpy(),
-                )
-
-                if not dst["next"]:
-                    break
-                src = dst
-                dst = nusc.get("sample", dst["next"])
-
-    elif args.dataset == "semantic_kitti":
-        for scene in range(22):
-            if args.restart is not None:
-                if scene < args.restart:
-                    continue
-            print(f"Processing scene {scene:02d}")
-            scene_dir = os.path.join(args.path_dataset, f"dataset/sequences/{scene:02d}")
-            poses = np.loadtxt(os.path.join(scene_dir, "poses.txt")).reshape(-1, 3, 4)
-            poses_h = np.zeros((poses.shape[0], 4, 4))
-            poses_h[:, :3, :] = poses
-            poses_h[:, 3, 3] = 1
-            poses_h = torch.from_numpy(poses_h).to(device).double()
-
-            pose_o = torch.linalg.inv(poses_h[0])
-
-            for i in range(len(os.listdir(os.path.join(scene_dir, "velodyne"))) - 1):
-                if args.frame > 0 and i < args.frame:
-                    continue
-
-                # Load source and destination point clouds
-                src_points = np.fromfile(
-                    os.path.join(scene_dir, "velodyne", f"{i:06d}.bin"),
-                    dtype=np.float32,
-                )
-                src_points = (
-                    torch.from_numpy(src_points.reshape(-1, 4)[:, :3])
-                    .to(device)
-                    .double()
-                )
-                dst_points = np.fromfile(
-                    os.path.join(scene_dir, "velodyne", f"{i+1:06d}.bin"),
-                    dtype=np.float32,
-                )
-                dst_points = (
-                    torch.from_numpy(dst_points.reshape(-1, 4)[:, :3])
-                    .to(device)
-                    .double()
-                )
-
-                src_ego = pose_o @ poses_h[i]
-                dst_ego = pose_o @ poses_h[i + 1]
-
-                src_points = transform_pointcloud(src_points, src_ego)
-                dst_points = transform_pointcloud(dst_points, dst_ego)
-
-                # Load labels
-                if scene < 11:
-                    src_labels = np.fromfile(
-                        os.path.join(scene_dir, "labels", f"{i:06d}.label"),
-                        dtype=np.uint32,
-                    )
-                    src_labels = src_labels & 0xFFFF
-                    src_labels = (
-                        torch.from_numpy(src_labels.astype(np.int32)).to(device).long()
-                    )
-                    dst_labels = np.fromfile(
-                        os.path.join(scene_dir, "labels", f"{i+1:06d}.label"),
-                        dtype=np.uint32,
-                    )
-                    dst_labels = dst_labels & 0xFFFF
-                    dst_labels = (
-                        torch.from_numpy(dst_labels.astype(np.int32)).to(device).long()
-                    )
+    devices = args.devices
+    if devices is None:
+        device = "cpu"
+        if torch.cuda.is_available():
+            if args.gpu is not None:
+                device = f"cuda:{args.gpu}"
+            else:
+                device = "cuda"
+        devices = [device]
+    if args.trace is not None:
+        tracing.enable(torch.cuda.synchronize if torch.cuda.is_available() else None)
+
+    pairs = load_manifest(args)
+    todo = [pair for pair in pairs if not is_done(pair["output"])]
+    print(f"{len(pairs) - len(todo)} of {len(pairs)} pairs already done")
+
+    chunks = [
+        todo[i : i + args.batch_pairs] for i in range(0, len(todo), args.batch_pairs)
+    ]
+    failed = []
+    iters = []
+    done = 0
+    if args.workers == 1:
+        # failures are recorded as in the worker processes
+        torch.set_num_threads(args.threads)
+        _worker.update(
+            device=torch.device(devices[0]), dataset=args.dataset, config=config
+        )
+        for chunk in chunks:
+            print(f"Processing scene {chunk[0]['scene']} ({done + 1}/{len(todo)})")
+            for output, stats, error in _run_pairs(chunk):
+                if error is not None:
+                    failed.append(output)
+                    print(f"Failed {output}: {error}")
                 else:
-                    src_points, dst_points, src_labels, dst_labels = initial_clustering(
-                        src_points.cpu().numpy(),
-                        dst_points.cpu().numpy(),
-                        device=device,
-                        eps=0.3,
-                        min_samples=1,
-                        z_scale=0.5,
-                    )
-
-                flow = flow_estimation_lif(
-                    config=config,
-                    src_points=src_points,
-                    dst_points=dst_points,
-                    src_labels=src_labels,
-                    dst_labels=dst_labels,
-                    device=device,
-                )
-
-                # Save flow to disk or process it as needed
-                filename = f"{scene:02d}_{i:06d}_{i+1:06}.npz"
-                np.savez_compressed(
-                    os.path.join(args.savedir, "dataset/flow", filename),
-                    flow=flow.cpu().numpy(),
-                )
-
+                    iters.append(stats["iters"])
+            done += len(chunk)
     else:
-        raise ValueError(f"Dataset {args.dataset} not supported.")
+        # CUDA cannot be used in forked processes
+        ctx = mp.get_context("spawn")
+        worker_devices = ctx.Queue()
+        for i in range(args.workers):
+            worker_devices.put(devices[i % len(devices)])
+        with ctx.Pool(
+            args.workers,
+            initializer=_init_worker,
+            initargs=(worker_devices, args.threads, args.dataset, config),
+        ) as pool:
+            for results in pool.imap_unordered(_run_pairs, chunks):
+                for output, stats, error in results:
+                    if error is not None:
+                        failed.append(output)
+                        print(f"Failed {output}: {error}")
+                    else:
+                        iters.append(stats["iters"])
+                done += len(results)
+                print(f"{done}/{len(todo)} pairs done")
+
+    if iters:
+        print(
+            f"Iterations per pair: mean {np.mean(iters):.0f}, "
+            f"median {np.median(iters):.0f}, max {np.max(iters)}"
+        )
+    if args.trace is not None:
+        tracing.dump(args.trace)
+    if failed:
+        print(f"{len(failed)} pairs failed, run again to retry them")
+        sys.exit(1)
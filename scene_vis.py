@@ -21,7 +21,7 @@ def parse_args():
         "--labels_dir",
         type=str,
         required=True,
-        help="Directory containing label files.",
+        help="Directory containing label files, or the scene directory of an archive.",
     )
     parser.add_argument(
         "--instances",
@@ -0,0 +1,214 @@
+import os
+import argparse
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from utils.misc import get_frame_name, get_save_file, pack_labels
+
+# Files of the archive in the directory of a scene
+ARCHIVE_DATA = "predictions.bin"
+ARCHIVE_INDEX = "predictions.index"
+
+
+def unpack_labels(packed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Split packed labels into semantic and instance labels."""
+    # int32 keeps the full 16-bit range of the packed ids
+    semantic = (packed & 0xFFFF).astype(np.int32)
+    instance = (packed >> 16).astype(np.int32)
+    return semantic, instance
+
+
+class Archive_writer:
+    """
+    Append the packed labels of every frame to a single file per scene.
+
+    <save_path>/<scene>/predictions.bin holds the packed labels of all frames
+    back to back, <save_path>/<scene>/predictions.index has one
+    "frame offset size" line per frame (byte range in the data file). The
+    index line is written after the data, so an interrupted run leaves a
+    readable archive. The archive of a scene is replaced the first time the
+    writer opens it. Writing a frame again within a run appends it, readers
+    use the last copy. Can be used as the sink of Prediction_writer, writes
+    are serialized.
+    """
+
+    def __init__(self, save_path: str, max_open: int = 8):
+        self.save_path = save_path
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        # scenes opened by this writer, reopened after eviction in append mode
+        self._opened = set()
+
+    def _open(self, scene_name: str):
+        if scene_name in self._files:
+            self._files.move_to_end(scene_name)
+            return self._files[scene_name]
+
+        scene_dir = os.path.join(self.save_path, scene_name)
+        os.makedirs(scene_dir, exist_ok=True)
+        mode = "a" if scene_name in self._opened else "w"
+        # the index first, never an index pointing past the truncated data
+        index_file = open(os.path.join(scene_dir, ARCHIVE_INDEX), mode)
+        files = (open(os.path.join(scene_dir, ARCHIVE_DATA), mode + "b"), index_file)
+        self._opened.add(scene_name)
+        self._files[scene_name] = files
+        # scenes are written one after another, keep only the recent ones open
+        if len(self._files) > self.max_open:
+            _, old = self._files.popitem(last=False)
+            for f in old:
+                f.close()
+        return files
+
+    def write(
+        self,
+        scene_name: str,
+        filename: str,
+        semantic: np.ndarray,
+        instance: np.ndarray,
+    ) -> None:
+        """
+        Append the predictions of a frame, same arguments as save_data.
+
+        Args:
+            scene_name (str): The name of the scene.
+            filename (str): The path to the original file.
+            semantic (np.ndarray): The semantic labels.
+            instance (np.ndarray): The instance labels.
+        """
+        data = pack_labels(semantic, instance).tobytes()
+        name = get_frame_name(filename)
+        with self._lock:
+            data_file, index_file = self._open(scene_name)
+            offset = data_file.seek(0, os.SEEK_END)
+            data_file.write(data)
+            data_file.flush()
+            index_file.write(f"{name} {offset} {len(data)}\n")
+            index_file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            for files in self._files.values():
+                for f in files:
+                    f.close()
+            self._files.clear()
+
+
+class Scene_archive:
+    """
+    Read the predictions of a scene written by Archive_writer.
+
+    The data file is memory-mapped, reading a frame returns a view.
+    """
+
+    def __init__(self, scene_dir: str):
+        self.scene_dir = scene_dir
+        self.index = {}
+        with open(os.path.join(scene_dir, ARCHIVE_INDEX), "r") as f:
+            for line in f:
+                name, offset, size = line.split()
+                self.index[name] = (int(offset), int(size))
+
+        data_file = os.path.join(scene_dir, ARCHIVE_DATA)
+        if os.path.getsize(data_file) > 0:
+            self._data = np.memmap(data_file, dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def names(self) -> List[str]:
+        """Frame names, sorted like the .label files of the scene."""
+        return sorted(self.index)
+
+    def read_packed(self, name: str) -> np.ndarray:
+        offset, size = self.index[name]
+        return self._data[offset : offset + size].view(np.uint32)
+
+    def read(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the semantic and instance labels of a frame."""
+        return unpack_labels(self.read_packed(name))
+
+
+class Label_dir:
+    """Read the .label files of a scene with the interface of Scene_archive."""
+
+    def __init__(self, labels_dir: str):
+        self.scene_dir = labels_dir
+        self.files = {
+            f.split(".")[0]: f for f in os.listdir(labels_dir) if f.endswith(".label")
+        }
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.files
+
+    def names(self) -> List[str]:
+        return sorted(self.files)
+
+    def read_packed(self, name: str) -> np.ndarray:
+        return np.fromfile(
+            os.path.join(self.scene_dir, self.files[name]), dtype=np.uint32
+        )
+
+    def read(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        return unpack_labels(self.read_packed(name))
+
+
+def open_predictions(path: str) -> Union[Scene_archive, Label_dir]:
+    """
+    Open the predictions of a scene, whatever the output format.
+
+    Args:
+        path (str): Directory of the scene, or its predictions/ directory.
+
+    Returns:
+        Union[Scene_archive, Label_dir]: Reader of the frames of the scene.
+    """
+    path = os.path.normpath(path)
+    for scene_dir in (path, os.path.dirname(path)):
+        if os.path.exists(os.path.join(scene_dir, ARCHIVE_INDEX)):
+            return Scene_archive(scene_dir)
+    if os.path.basename(path) != "predictions" and os.path.isdir(
+        os.path.join(path, "predictions")
+    ):
+        path = os.path.join(path, "predictions")
+    return Label_dir(path)
+
+
+def export_labels(save_path: str, scene_name: str) -> None:
+    """Write the archive of a scene as .label files, the layout of save_data."""
+    archive = Scene_archive(os.path.join(save_path, scene_name))
+    for name in archive.names():
+        save_dir, save_file = get_save_file(save_path, scene_name, name)
+        os.makedirs(save_dir, exist_ok=True)
+        archive.read_packed(name).tofile(save_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export archives to .label files")
+    parser.add_argument("save_path", type=str, help="Save path of the predictions")
+    parser.add_argument(
+        "--scenes", type=str, nargs="+", default=None, help="Scenes, all by default"
+    )
+    args = parser.parse_args()
+
+    scenes = args.scenes
+    if scenes is None:
+        scenes = sorted(
+            d
+            for d in os.listdir(args.save_path)
+            if os.path.exists(os.path.join(args.save_path, d, ARCHIVE_INDEX))
+        )
+    for scene_name in scenes:
+        export_labels(args.save_path, scene_name)
+        print(f"Exported {scene_name}")
@@ -3,9 +3,35 @@ from typing import Optional, Tuple
 import torch
 from scipy.optimize import linear_sum_assignment
 
-from utils.misc import Obj_cache, Instance_data, get_centers_for_class
+from utils.tracing import span, traced
+from utils.misc import Obj_cache, get_cluster_stats
 
 
+def _new_ids(curr_id: int, num: int, device: torch.device) -> torch.Tensor:
+    """Consecutive new instance ids starting from curr_id."""
+    return torch.arange(curr_id, curr_id + num, dtype=torch.int32, device=device)
+
+
+def _unused(used: torch.Tensor, num: int) -> torch.Tensor:
+    """Indices in range(num) not present in used, in increasing order."""
+    mask = torch.ones(num, dtype=torch.bool, device=used.device)
+    mask[used] = False
+    return torch.nonzero(mask).squeeze(1)
+
+
+def _write_last(target: torch.Tensor, index: torch.Tensor, values: torch.Tensor):
+    """target[index] = values, for repeated indices the last value is kept."""
+    if index.numel() == 0:
+        return
+    pos = torch.arange(index.numel(), device=index.device)
+    last = torch.full_like(target, -1, dtype=torch.long).scatter_reduce_(
+        0, index, pos, reduce="amax"
+    )
+    keep = last[index] == pos
+    target[index[keep]] = values[keep].to(target.dtype)
+
+
+@traced("association")
 def association(
     points_t1: torch.Tensor,
     points_t2: torch.Tensor,
@@ -30,62 +56,65 @@ def association(
     Returns:
         Tuple[torch.Tensor, torch.Tensor]: The updated indices for points in both sets.
     """
-    indices_t1 = torch.zeros(
-        points_t1.shape[0], dtype=torch.int32, device=points_t1.device
-    )
-    indices_t2 = torch.zeros(
-        points_t2.shape[0], dtype=torch.int32, device=points_t2.device
-    )
-
     curr_id = 1 if obj_cache is None else obj_cache.max_id + 1
 
     if flow is not None:
         points_t1[:, :3] += flow[:, :3]
 
+    # Get the centers (and features) of clusters for all classes at once
+    use_feat = config["association"]["use_feat"]
+    stats_t1 = get_cluster_stats(
+        points_t1, config["fore_classes"], feat=points_t1[:, 3:-2] if use_feat else None
+    )
+    stats_t2 = get_cluster_stats(
+        points_t2, config["fore_classes"], feat=points_t2[:, 3:-2] if use_feat else None
+    )
+
+    # Instance id of each cluster, written to the points at the end
+    inst_t1 = torch.zeros(
+        stats_t1.clusters.shape[0], dtype=torch.int32, device=points_t1.device
+    )
+    inst_t2 = torch.zeros(
+        stats_t2.clusters.shape[0], dtype=torch.int32, device=points_t2.device
+    )
+    # Instance id of each cluster in t1 from the previous association
+    prev_t1 = None if prev_ind is None else prev_ind[stats_t1.first_point].int()
+
     for class_id in config["fore_classes"]:
         # Get the centers of clusters for the current class
-        centers_t1, clusters_t1 = get_centers_for_class(points_t1, class_id)
-        centers_t2, clusters_t2 = get_centers_for_class(points_t2, class_id)
+        sl_t1, sl_t2 = stats_t1.class_slice(class_id), stats_t2.class_slice(class_id)
+        centers_t1, clusters_t1 = stats_t1.centers[sl_t1], stats_t1.clusters[sl_t1]
+        centers_t2, clusters_t2 = stats_t2.centers[sl_t2], stats_t2.clusters[sl_t2]
+        n_t1, n_t2 = clusters_t1.numel(), clusters_t2.numel()
 
-        if config["association"]["use_feat"]:
-            features_t1, _ = get_centers_for_class(
-                points_t1, class_id, points_t1[:, 3:-2]
-            )
-            features_t2, _ = get_centers_for_class(
-                points_t2, class_id, points_t2[:, 3:-2]
-            )
+        if use_feat:
+            features_t1 = stats_t1.features[sl_t1]
+            features_t2 = stats_t2.features[sl_t2]
 
         # If no clusters are found, continue to the next class
-        if clusters_t1.numel() == 0 and clusters_t2.numel() == 0:
+        if n_t1 == 0 and n_t2 == 0:
             continue
 
-        class_mask_t1 = points_t1[:, -2] == class_id
-        class_mask_t2 = points_t2[:, -2] == class_id
-
         # If no clusters are found in t1, assign new ids to t2
-        if clusters_t1.numel() == 0:
-            for cluster_id in clusters_t2:
-                mask = class_mask_t2 & (points_t2[:, -1] == cluster_id)
-                indices_t2[mask] = curr_id
-                curr_id += 1
+        if n_t1 == 0:
+            inst_t2[sl_t2] = _new_ids(curr_id, n_t2, inst_t2.device)
+            curr_id += n_t2
             continue
 
         # If no clusters are found in t2, assign ids to t1
-        if clusters_t2.numel() == 0:
-            for cluster_id in clusters_t1:
-                mask = class_mask_t1 & (points_t1[:, -1] == cluster_id)
-                if prev_ind is None:  # if prev_ind is not provided, assign new ids
-                    indices_t1[mask] = curr_id
-                    curr_id += 1
-                else:  # if prev_ind is provided, assign previous ids
-                    indices_t1[mask] = prev_ind[mask][0]
+        if n_t2 == 0:
+            if prev_ind is None:  # if prev_ind is not provided, assign new ids
+                inst_t1[sl_t1] = _new_ids(curr_id, n_t1, inst_t1.device)
+                curr_id += n_t1
+            else:  # if prev_ind is provided, assign previous ids
+                inst_t1[sl_t1] = prev_t1[sl_t1]
             continue
 
         # Calculate the association cost
         cost_dists = torch.cdist(centers_t1, centers_t2)
         cost_dists[cost_dists > config["association"]["max_dist"]] = 1e8
 
-        if config["association"]["use_feat"]:
+        if use_feat:
             features_t1_n = features_t1 / (
                 torch.norm(features_t1, dim=1, keepdim=True) + 1e-6
             )
@@ -102,46 +131,54 @@ def association(
         assoc_cost = cost_dists + cost_features
 
         # associate using hungarian matching
-        row_ind, col_ind = linear_sum_assignment(assoc_cost.cpu().numpy())
-        used_row, used_col = set(row_ind), set(col_ind)
-        for i, j in zip(row_ind, col_ind):
-            mask_t1 = class_mask_t1 & (points_t1[:, -1] == clusters_t1[i])
-            mask_t2 = class_mask_t2 & (points_t2[:, -1] == clusters_t2[j])
-            if assoc_cost[i, j] > 1e8:  # threshold for association
-                indices_t1[mask_t1] = (
-                    curr_id if prev_ind is None else prev_ind[mask_t1][0]
+        with span("hungarian"):
+            row_ind, col_ind = linear_sum_assignment(assoc_cost.cpu().numpy())
+        rows = torch.as_tensor(row_ind, device=inst_t1.device)
+        cols = torch.as_tensor(col_ind, device=inst_t2.device)
+        # threshold for association
+        failed = (assoc_cost[rows, cols] > 1e8).int()
+
+        # Matched pairs share the id, failed pairs get a new id for t2. Without
+        # prev_ind, t1 also takes a new id, in the order of the pairs.
+        if prev_ind is None:
+            step = 1 + failed
+            ids_t1 = curr_id + torch.cumsum(step, dim=0).int() - step
+            ids_t2 = ids_t1 + failed
+        else:
+            step = failed
+            ids_t1 = prev_t1[sl_t1][rows]
+            ids_t2 = torch.where(
+                failed.bool(), curr_id + torch.cumsum(step, dim=0).int() - step, ids_t1
+            )
+        curr_id += int(step.sum())
+        inst_t1[sl_t1.start + rows] = ids_t1
+        inst_t2[sl_t2.start + cols] = ids_t2
+
+        # Handle the case where the number of clusters in t1 and t2 are different
+        if n_t1 > n_t2:
+            unused = _unused(rows, n_t1)
+            if prev_ind is None:
+                inst_t1[sl_t1.start + unused] = _new_ids(
+                    curr_id, unused.numel(), inst_t1.device
                 )
-                curr_id += 1 if prev_ind is None else 0
-                indices_t2[mask_t2] = curr_id
-                curr_id += 1
+                curr_id += unused.numel()
             else:
-                id_val = curr_id if prev_ind is None else prev_ind[mask_t1][0]
-                indices_t1[mask_t1] = id_val
-                indices_t2[mask_t2] = id_val
-                curr_id += 1 if prev_ind is None else 0
+                inst_t1[sl_t1.start + unused] = prev_t1[sl_t1][unused]
+        elif n_t1 < n_t2:
+            unused = _unused(cols, n_t2)
+            inst_t2[sl_t2.start + unused] = _new_ids(
+                curr_id, unused.numel(), inst_t2.device
+            )
+            curr_id += unused.numel()
 
-        # Handle the case where the number of clusters in t1 and t2 are different
-        if centers_t1.shape[0] > centers_t2.shape[0]:
-            for i, cluster_id in enumerate(clusters_t1):
-                if i in used_row:
-                    continue
-                mask = class_mask_t1 & (points_t1[:, -1] == cluster_id)
-                if prev_ind is None:
-                    indices_t1[mask] = curr_id
-                    curr_id += 1
-                else:
-                    indices_t1[mask] = prev_ind[mask][0]
-        elif centers_t1.shape[0] < centers_t2.shape[0]:
-            for j, cluster_id in enumerate(clusters_t2):
-                if j in used_col:
-                    continue
-                mask = class_mask_t2 & (points_t2[:, -1] == cluster_id)
-                indices_t2[mask] = curr_id
-                curr_id += 1
+    # Write the instance ids to all points with a single gather
+    indices_t1 = stats_t1.gather_points(inst_t1)
+    indices_t2 = stats_t2.gather_points(inst_t2)
 
     return indices_t1, indices_t2
 
 
+@traced("long_association")
 def long_association(
     points_t1: torch.Tensor,
     points_t2: torch.Tensor,
@@ -173,113 +210,93 @@ def long_association(
     # Update object cache -> remove old instances
     obj_cache.update_step()
     curr_id = obj_cache.max_id + 1
+    life = config["association"]["life"]
+
+    # Get the centers, flow and features of clusters for all classes at once
+    stats_t1 = get_cluster_stats(
+        points_t1, config["fore_classes"], flow=flow, feat=points_t1[:, 3:-2]
+    )
+    stats_t2 = get_cluster_stats(
+        points_t2, config["fore_classes"], feat=points_t2[:, 3:-2]
+    )
 
-    # Initialize indices for t1 and t2
-    indices_t1 = torch.zeros(
-        points_t1.shape[0], dtype=torch.int32, device=points_t1.device
+    # Instance id of each cluster, written to the points at the end. The extra last
+    # element of inst_t1 absorbs writes for cached clusters not present in t1.
+    inst_t1 = torch.zeros(
+        stats_t1.clusters.shape[0] + 1, dtype=torch.int32, device=points_t1.device
     )
-    indices_t2 = torch.zeros(
-        points_t2.shape[0], dtype=torch.int32, device=points_t2.device
+    inst_t2 = torch.zeros(
+        stats_t2.clusters.shape[0], dtype=torch.int32, device=points_t2.device
     )
 
     for class_id in config["fore_classes"]:
         # Get the centers of clusters for the current class
-        centers_t1, clusters_t1 = get_centers_for_class(points_t1, class_id)
-        centers_t2, clusters_t2 = get_centers_for_class(points_t2, class_id)
+        sl_t1, sl_t2 = stats_t1.class_slice(class_id), stats_t2.class_slice(class_id)
+        centers_t1, clusters_t1 = stats_t1.centers[sl_t1], stats_t1.clusters[sl_t1]
+        centers_t2, clusters_t2 = stats_t2.centers[sl_t2], stats_t2.clusters[sl_t2]
+        n_t1, n_t2 = clusters_t1.numel(), clusters_t2.numel()
 
         # If no clusters are found, continue to the next class
-        if clusters_t1.numel() == 0 and clusters_t2.numel() == 0:
+        if n_t1 == 0 and n_t2 == 0:
             continue
 
         # If flow is provided, adjust the centers of t1
         if flow is not None:
-            flow_t1, _ = get_centers_for_class(points_t1, class_id, flow)
+            flow_t1 = stats_t1.flow[sl_t1]
             centers_t1 = centers_t1 + flow_t1
         else:
             flow_t1 = torch.zeros_like(centers_t1)
 
         # Get the features for the current class
-        features_t1, _ = get_centers_for_class(points_t1, class_id, points_t1[:, 3:-2])
-        features_t2, _ = get_centers_for_class(points_t2, class_id, points_t2[:, 3:-2])
+        features_t1 = stats_t1.features[sl_t1]
+        features_t2 = stats_t2.features[sl_t2]
 
-        class_mask_t1 = points_t1[:, -2] == class_id
-        class_mask_t2 = points_t2[:, -2] == class_id
+        tracks = obj_cache.tracks[class_id]
 
         # If no clusters are found in t1, assign new ids to t2
-        if clusters_t1.numel() == 0:
-            for i, cluster_id in enumerate(clusters_t2):
-                mask = class_mask_t2 & (points_t2[:, -1] == cluster_id)
-                indices_t2[mask] = curr_id
-                obj_cache.add_instance(
-                    class_id,
-                    Instance_data(
-                        id=curr_id,
-                        cl_id=cluster_id,
-                        life=config["association"]["life"],
-                        center=centers_t2[i],
-                        feature=features_t2[i],
-                    ),
-                )
-                curr_id += 1
+        if n_t1 == 0:
+            new_ids = _new_ids(curr_id, n_t2, inst_t2.device)
+            inst_t2[sl_t2] = new_ids
+            tracks.insert(new_ids, clusters_t2, life, centers_t2, features_t2)
+            curr_id += n_t2
             continue
 
-        prev_insts = obj_cache.prev_instances[class_id]
-        centers_t1_o = centers_t1.clone()
-        if not prev_insts:
-            for i, cluster_id in enumerate(clusters_t1):
-                obj_cache.add_instance(
-                    class_id,
-                    Instance_data(
-                        id=curr_id,
-                        cl_id=cluster_id,
-                        life=config["association"]["life"] - 1,
-                        center=centers_t1[i],
-                        feature=features_t1[i],
-                    ),
-                )
-                curr_id += 1
-        else:
-            features_t1 = torch.stack(
-                [prev_insts[cluster_id].feature for cluster_id in prev_insts.keys()]
-            )
-            centers_t1 = torch.stack(
-                [prev_insts[cluster_id].center for cluster_id in prev_insts.keys()]
-            )
-        prev_insts_keys = list(prev_insts.keys())
+        # Without cached instances, the clusters of t1 start new tracks
+        if len(tracks) == 0:
+            new_ids = _new_ids(curr_id, n_t1, inst_t1.device)
+            tracks.insert(new_ids, clusters_t1, life - 1, centers_t1, features_t1)
+            curr_id += n_t1
+
+        # Index of the cluster in t1 each cached instance was last seen as
+        track_segs = stats_t1.find(class_id, tracks.cl_ids)
+        track_segs[track_segs < 0] = inst_t1.shape[0] - 1
+        track_ids = tracks.ids.int()
+        seen_t1 = tracks.life == life - 1
 
         # If no clusters are found in t2, assign ids to t1
-        if clusters_t2.numel() == 0:
-            life_mask = torch.tensor(
-                [
-                    prev_insts[k].life == config["association"]["life"] - 1
-                    for k in prev_insts_keys
-                ],
-                device=centers_t1.device,
-            )
-            if life_mask.any():
-                dists = torch.cdist(centers_t1_o.double(), centers_t1[life_mask].double(), p=2)
+        if n_t2 == 0:
+            if seen_t1.any():
+                dists = torch.cdist(
+                    centers_t1.double(), tracks.centers[seen_t1].double(), p=2
+                )
                 flow_dist = torch.norm(flow_t1, dim=1)
-                for i in range(len(centers_t1_o)):
-                    min_dist_idx = dists[i].argmin()
-                    if dists[i, min_dist_idx] < (flow_dist[i] + 1e-4):
-                        prev_inst = prev_insts[prev_insts_keys[min_dist_idx]]
-                        mask = class_mask_t1 & (points_t1[:, -1] == prev_inst.cl_id)
-                        indices_t1[mask] = prev_inst.id
-                    else:
-                        raise RuntimeError("Cluster in t1 not found")
+                min_dist, min_dist_idx = dists.min(dim=1)
+                if (min_dist >= flow_dist + 1e-4).any():
+                    raise RuntimeError("Cluster in t1 not found")
+                _write_last(inst_t1, track_segs[min_dist_idx], track_ids[min_dist_idx])
             continue
 
         # Calculate the association cost
-        cost_dists = torch.cdist(centers_t1, centers_t2)
+        cost_dists = torch.cdist(tracks.centers, centers_t2)
 
-        features_t1_n = features_t1 / (
-            torch.norm(features_t1, dim=1, keepdim=True) + 1e-6
+        features_tr_n = tracks.features / (
+            torch.norm(tracks.features, dim=1, keepdim=True) + 1e-6
         )
         features_t2_n = features_t2 / (
             torch.norm(features_t2, dim=1, keepdim=True) + 1e-6
         )
         cost_features = 1 - torch.matmul(
-            features_t1_n, features_t2_n.T
+            features_tr_n, features_t2_n.T
         )  # cosine similarity
 
         assoc_cost = config["association"]["alpha"] * cost_dists + \
@@ -288,71 +305,55 @@ def long_association(
         assoc_cost[cost_dists > config["association"]["max_dist"]] = 1e8
 
         # associate using hungarian matching
-        row_ind, col_ind = linear_sum_assignment(assoc_cost.cpu().numpy())
-        used_row, used_col = set(row_ind), set(col_ind)
-        add_instances = []
-
-        for row, col in zip(row_ind, col_ind):
-            prev_inst = prev_insts[prev_insts_keys[row]]
-            mask_t1 = class_mask_t1 & (points_t1[:, -1] == prev_inst.cl_id)
-            mask_t2 = class_mask_t2 & (points_t2[:, -1] == clusters_t2[col])
-            if assoc_cost[row, col] < 1e8:
-                if prev_inst.life == config["association"]["life"] - 1:
-                    indices_t1[mask_t1] = prev_inst.id
-                indices_t2[mask_t2] = prev_inst.id
-                add_instances.append(
-                    Instance_data(
-                        id=prev_inst.id,
-                        cl_id=clusters_t2[col],
-                        life=config["association"]["life"],
-                        center=centers_t2[col],
-                        feature=(features_t2[col] + features_t1[row]) / 2,
-                    )
-                )
-            else:
-                if prev_inst.life == config["association"]["life"] - 1:
-                    indices_t1[mask_t1] = prev_inst.id
-                indices_t2[mask_t2] = curr_id
-                add_instances.append(
-                    Instance_data(
-                        id=curr_id,
-                        cl_id=clusters_t2[col],
-                        life=config["association"]["life"],
-                        center=centers_t2[col],
-                        feature=features_t2[col],
-                    )
-                )
-                curr_id += 1
-
-        # Handle the case where the number of clusters in t1 and t2 are different
-        if centers_t1.shape[0] > centers_t2.shape[0]:
-            for i in range(len(centers_t1)):
-                if i in used_row:
-                    continue
-                instance = prev_insts[prev_insts_keys[i]]
-                if not instance.life == config["association"]["life"] - 1:
-                    continue
-                mask = (class_mask_t1) & (points_t1[:, -1] == instance.cl_id)
-                indices_t1[mask] = instance.id
-        elif centers_t1.shape[0] < centers_t2.shape[0]:
-            for j, cluster_id in enumerate(clusters_t2):
-                if j in used_col:
-                    continue
-                mask = class_mask_t2 & (points_t2[:, -1] == cluster_id)
-                indices_t2[mask] = curr_id
-                add_instances.append(
-                    Instance_data(
-                        id=curr_id,
-                        cl_id=cluster_id,
-                        life=config["association"]["life"],
-                        center=centers_t2[j],
-                        feature=features_t2[j],
-                    )
-                )
-                curr_id += 1
+        with span("hungarian"):
+            row_ind, col_ind = linear_sum_assignment(assoc_cost.cpu().numpy())
+        rows = torch.as_tensor(row_ind, device=inst_t1.device)
+        cols = torch.as_tensor(col_ind, device=inst_t2.device)
+        matched = assoc_cost[rows, cols] < 1e8
+
+        # Matched clusters in t2 continue the track, the others start a new one
+        failed = (~matched).int()
+        new_ids = curr_id + torch.cumsum(failed, dim=0).int() - failed
+        ids_t2 = torch.where(matched, track_ids[rows], new_ids)
+        curr_id += int(failed.sum())
+        inst_t2[sl_t2.start + cols] = ids_t2
+        add_ids, add_cols = [ids_t2], [cols]
+        add_features = [
+            torch.where(
+                matched[:, None],
+                (features_t2[cols] + tracks.features[rows]) / 2,
+                features_t2[cols],
+            )
+        ]
+
+        # Tracks seen in t1 keep their id there, whether matched or not
+        unused_rows = _unused(rows, len(tracks))
+        rows_t1 = torch.cat((rows, unused_rows))
+        rows_t1 = rows_t1[seen_t1[rows_t1]]
+        _write_last(inst_t1, track_segs[rows_t1], track_ids[rows_t1])
+
+        # Unmatched clusters in t2 start new tracks
+        unused_cols = _unused(cols, n_t2)
+        if unused_cols.numel() > 0:
+            new_ids = _new_ids(curr_id, unused_cols.numel(), inst_t2.device)
+            inst_t2[sl_t2.start + unused_cols] = new_ids
+            curr_id += unused_cols.numel()
+            add_ids.append(new_ids)
+            add_cols.append(unused_cols)
+            add_features.append(features_t2[unused_cols])
 
         # Update the object cache with new instances
-        for inst in add_instances:
-            obj_cache.add_instance(class_id, inst)
+        add_cols = torch.cat(add_cols)
+        tracks.insert(
+            torch.cat(add_ids),
+            clusters_t2[add_cols],
+            life,
+            centers_t2[add_cols],
+            torch.cat(add_features),
+        )
+
+    # Write the instance ids to all points with a single gather
+    indices_t1 = stats_t1.gather_points(inst_t1[:-1])
+    indices_t2 = stats_t2.gather_points(inst_t2)
 
     return indices_t1, indices_t2
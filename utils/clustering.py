@@ -1,3 +1,6 @@
+import itertools
+from typing import Iterator, Optional, Tuple
+
 import torch
 import hdbscan
 import numpy as np
@@ -5,6 +8,188 @@ from sklearn.cluster import DBSCAN
 
 from alpine import Alpine
 
+from utils.tracing import traced
+
+
+def _connect(parent: torch.Tensor, i: torch.Tensor, j: torch.Tensor) -> torch.Tensor:
+    """
+    Merge the connected components of nodes i and j. Parent has to point directly to
+    the root of each component (the smallest node), which holds after the call.
+    """
+    while True:
+        root_i, root_j = parent[i], parent[j]
+        diff = root_i != root_j
+        if not diff.any():
+            return parent
+        i, j, root_i, root_j = i[diff], j[diff], root_i[diff], root_j[diff]
+
+        # hook the larger root under the smaller one
+        parent = parent.scatter_reduce(
+            0, torch.maximum(root_i, root_j), torch.minimum(root_i, root_j), "amin"
+        )
+        # pointer jumping until every node points to its root
+        while True:
+            grand_parent = parent[parent]
+            if torch.equal(grand_parent, parent):
+                break
+            parent = grand_parent
+
+
+class TorchDBSCAN:
+    """
+    DBSCAN implemented in torch, it runs on the device of the input points.
+
+    Neighbors within epsilon are searched in a voxel hash grid with voxel size equal
+    to epsilon, core points are joined into clusters by connected components label
+    propagation and border points take the smallest label of their core neighbors.
+    Point pairs are processed in chunks of at most max_pairs candidate pairs.
+    """
+
+    # forward half of the 3x3x3 cell neighborhood, each pair of cells is visited once
+    OFFSETS = [
+        (dx, dy, dz)
+        for dx in (-1, 0, 1)
+        for dy in (-1, 0, 1)
+        for dz in (-1, 0, 1)
+        if (dx, dy, dz) >= (0, 0, 0)
+    ]
+
+    def __init__(self, eps: float, min_samples: int, max_pairs: int = 2**24):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.max_pairs = max_pairs
+
+    def _cell_pairs(
+        self, xyz: torch.Tensor, classes: torch.Tensor
+    ) -> Tuple[torch.Tensor, ...]:
+        """Sort points by voxel cell and list the pairs of neighboring cells."""
+        coords = torch.floor((xyz - xyz.min(dim=0).values) / self.eps).long()
+        dims = coords.max(dim=0).values + 1
+
+        def cell_key(cls, c):
+            return ((cls * dims[0] + c[:, 0]) * dims[1] + c[:, 1]) * dims[2] + c[:, 2]
+
+        # points of different classes never share a cell
+        keys = cell_key(classes, coords)
+        order = torch.argsort(keys)
+        cells, counts = torch.unique_consecutive(keys[order], return_counts=True)
+        starts = torch.cumsum(counts, dim=0) - counts
+        cell_coords, cell_classes = coords[order[starts]], classes[order[starts]]
+
+        pair_a, pair_b = [], []
+        for offset in self.OFFSETS:
+            neighbor = cell_coords + torch.tensor(offset, device=xyz.device)
+            valid = ((neighbor >= 0) & (neighbor < dims)).all(dim=1)
+            neighbor_key = cell_key(cell_classes, neighbor)
+            idx = torch.searchsorted(cells, neighbor_key).clamp(max=cells.numel() - 1)
+            found = torch.nonzero(valid & (cells[idx] == neighbor_key)).squeeze(1)
+            pair_a.append(found)
+            pair_b.append(idx[found])
+
+        return order, starts, counts, torch.cat(pair_a), torch.cat(pair_b)
+
+    def _neighbor_pairs(
+        self,
+        xyz: torch.Tensor,
+        order: torch.Tensor,
+        starts: torch.Tensor,
+        counts: torch.Tensor,
+        pair_a: torch.Tensor,
+        pair_b: torch.Tensor,
+    ) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        """Yield chunks of point pairs (i, j) within epsilon, each pair once."""
+        sizes = counts[pair_a] * counts[pair_b]
+        offsets = torch.cumsum(sizes, dim=0) - sizes
+        chunk_ids = offsets // self.max_pairs
+        bounds = torch.searchsorted(
+            chunk_ids,
+            torch.arange(int(chunk_ids[-1]) + 2, device=xyz.device),
+        ).tolist()
+
+        for c_start, c_end in zip(bounds[:-1], bounds[1:]):
+            if c_start == c_end:
+                continue
+            a, b, size = pair_a[c_start:c_end], pair_b[c_start:c_end], sizes[c_start:c_end]
+
+            # enumerate all point pairs of the cell pairs in the chunk
+            local = torch.repeat_interleave(
+                torch.arange(size.numel(), device=xyz.device), size
+            )
+            k = torch.arange(local.numel(), device=xyz.device) - (
+                torch.cumsum(size, dim=0) - size
+            )[local]
+            a, b = a[local], b[local]
+            idx_a, idx_b = k // counts[b], k % counts[b]
+            keep = (a != b) | (idx_a < idx_b)
+            i = order[starts[a[keep]] + idx_a[keep]]
+            j = order[starts[b[keep]] + idx_b[keep]]
+
+            close = ((xyz[i] - xyz[j]) ** 2).sum(dim=1) <= self.eps**2
+            yield i[close], j[close]
+
+    def fit_predict(
+        self, points: torch.Tensor, classes: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Cluster points, optionally separately for each class.
+
+        Args:
+            points (torch.Tensor): Tensor of shape (N, 3) with xyz coordinates.
+            classes (Optional[torch.Tensor]): Class of each point of shape (N,), points
+                                              of different classes are never joined.
+
+        Returns:
+            torch.Tensor: Cluster labels of shape (N,), outliers are labeled as -1.
+        """
+        n = points.shape[0]
+        device = points.device
+        labels = torch.full((n,), -1, dtype=torch.int64, device=device)
+        if n == 0:
+            return labels
+
+        xyz = points[:, :3]
+        if classes is None:
+            classes = torch.zeros(n, dtype=torch.int64, device=device)
+        else:
+            classes = classes.long() - classes.long().min()
+
+        cells = self._cell_pairs(xyz, classes)
+        # a single chunk is kept instead of being enumerated again for every pass
+        cached = list(itertools.islice(self._neighbor_pairs(xyz, *cells), 2))
+        if len(cached) > 1:
+            cached = None
+
+        def chunks():
+            if cached is not None:
+                return iter(cached)
+            return self._neighbor_pairs(xyz, *cells)
+
+        # core points -- at least min_samples neighbors including the point itself
+        num_neighbors = torch.ones(n, dtype=torch.int64, device=device)
+        for i, j in chunks():
+            num_neighbors += torch.bincount(i, minlength=n) + torch.bincount(j, minlength=n)
+        core = num_neighbors >= self.min_samples
+
+        # connected components of core points
+        parent = torch.arange(n, device=device)
+        for i, j in chunks():
+            both = core[i] & core[j]
+            parent = _connect(parent, i[both], j[both])
+
+        # border points join the neighboring core point with the smallest label
+        border = torch.full((n,), n, dtype=torch.int64, device=device)
+        for i, j in chunks():
+            to_j = core[i] & ~core[j]
+            to_i = core[j] & ~core[i]
+            border.scatter_reduce_(0, j[to_j], parent[i[to_j]], "amin")
+            border.scatter_reduce_(0, i[to_i], parent[j[to_i]], "amin")
+
+        roots = torch.where(core, parent, border)
+        clustered = roots < n
+        labels[clustered] = torch.unique(roots[clustered], return_inverse=True)[1]
+
+        return labels
+
 
 class Clusterer:
     def __init__(self, config):
@@ -36,11 +221,17 @@ class Clusterer:
                 eps=config["clustering"]["epsilon"],
                 min_samples=config["clustering"]["min_cluster_size"],
             )
+        elif config["clustering"]["clustering_method"] == "torch_dbscan":
+            self.clusterer = TorchDBSCAN(
+                eps=config["clustering"]["epsilon"],
+                min_samples=config["clustering"]["min_cluster_size"],
+            )
         else:
             raise ValueError(
                 f"Unsupported clustering method: {self.config['clustering_method']}"
             )
 
+    @traced("clustering")
     def get_semantic_clustering(self, points: torch.Tensor) -> torch.Tensor:
         """
         Perform semantic clustering on input points using DBSCAN.
@@ -52,6 +243,11 @@ class Clusterer:
         Returns:
             torch.Tensor: Cluster labels of shape (N,).
         """
+        if self.config["clustering"]["clustering_method"] == "torch_dbscan":
+            # runs on the device of the points, classes are clustered separately
+            labels = self.clusterer.fit_predict(points[:, :3], points[:, -1])
+            return self._keep_top_clusters(labels)
+
         points_np = points.cpu().numpy()
         labels = np.full(points.shape[0], -1, dtype=np.int64)
 
@@ -81,9 +277,12 @@ class Clusterer:
                     else len(unique_labels)
                 )
 
-        # keep only the top clusters
         labels = torch.tensor(labels, dtype=torch.int64, device=points.device)
 
+        return self._keep_top_clusters(labels)
+
+    def _keep_top_clusters(self, labels: torch.Tensor) -> torch.Tensor:
+        """Keep only the num_clusters largest clusters, others are set to -1."""
         lbls, counts = torch.unique(labels, return_counts=True)
         valid_mask = lbls != -1
         cluster_info = torch.stack((lbls[valid_mask], counts[valid_mask]), dim=1)
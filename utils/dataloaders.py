@@ -1,4 +1,5 @@
 import argparse
+from typing import List
 
 import torch
 
@@ -21,6 +22,7 @@ def get_datasets(config: dict, args: argparse.Namespace) -> torch.utils.data.Dat
         "grids_shape": config["waffleiron"]["grids_size"],
         "fov_xyz": config["waffleiron"]["fov_xyz"],
         "verbose": args.verbose,
+        "cache_dir": args.cache_dir,
     }
 
     # Get phase
@@ -39,9 +41,59 @@ def get_datasets(config: dict, args: argparse.Namespace) -> torch.utils.data.Dat
     return dataset
 
 
+def shard_indices(
+    dataset: torch.utils.data.Dataset, num_shards: int, shard_id: int
+) -> List[int]:
+    """
+    Frame indices of one shard of the dataset.
+
+    Shards are contiguous runs of whole scenes in the dataset order, balanced
+    by number of frames. Tracking restarts at every scene, so shards are
+    independent, and merging their evaluation states in shard order gives the
+    same metrics as a single run.
+
+    Args:
+        dataset (torch.utils.data.Dataset): Dataset implementing get_scene_id.
+        num_shards (int): Number of shards.
+        shard_id (int): Shard to return, in [0, num_shards).
+
+    Returns:
+        List[int]: Frame indices of the shard, in the dataset order.
+    """
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"Shard {shard_id} out of range for {num_shards} shards")
+
+    indices = []
+    num_frames = len(dataset)
+    prev_scene, scene_shard = None, 0
+    for index in range(num_frames):
+        scene = dataset.get_scene_id(index)
+        if scene != prev_scene:
+            # a scene belongs to the shard of its first frame
+            scene_shard = index * num_shards // num_frames
+            prev_scene = scene
+        if scene_shard == shard_id:
+            indices.append(index)
+
+    return indices
+
+
+def _init_worker(worker_id: int) -> None:
+    # workers preprocess single frames, avoid oversubscribing the CPU
+    torch.set_num_threads(1)
+
+
 def get_dataloader(
     dataset: torch.utils.data.Dataset, args: argparse.Namespace
 ) -> torch.utils.data.DataLoader:
+    """
+    Build a dataloader yielding the frames in the dataset order.
+
+    With args.workers > 0, frames are preprocessed in parallel and up to
+    args.prefetch batches per worker are prepared ahead. The dataloader
+    reassembles the batches in the sampler order, so consecutive batches
+    still hold consecutive frames of a scene.
+    """
     pin_memory = torch.cuda.is_available()
 
     dataloader = torch.utils.data.DataLoader(
@@ -53,6 +105,8 @@ def get_dataloader(
         sampler=None,
         drop_last=not args.eval and not args.test,
         collate_fn=Collate(),
+        prefetch_factor=args.prefetch if args.workers > 0 else None,
+        worker_init_fn=_init_worker if args.workers > 0 else None,
     )
 
     return dataloader
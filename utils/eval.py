@@ -1,6 +1,76 @@
+import copy
+import pickle
+
 import numpy as np
 
 
+def lookup(ids, query):
+    """Position of each query in the sorted ids and whether it is present"""
+    pos = np.searchsorted(ids, query)
+    pos[pos == len(ids)] = 0
+    if len(ids) == 0:
+        return pos, np.zeros(len(query), dtype=bool)
+    return pos, ids[pos] == query
+
+
+def count_keys(keys):
+    """
+    Unique integer keys and their counts.
+
+    Keys are counted with np.bincount when their range is small compared to
+    their number, which is the usual case for class and instance ids.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Sorted unique keys and their counts.
+    """
+    keys = keys.astype(np.int64, copy=False)
+    if keys.size == 0:
+        return keys, np.zeros(0, dtype=np.int64)
+
+    low = keys.min()
+    span = keys.max() - low + 1
+    if span > max(4 * keys.size, 1 << 20):
+        return np.unique(keys, return_counts=True)
+
+    counts = np.bincount(keys - low, minlength=span)
+    ids = np.flatnonzero(counts)
+    return ids + low, counts[ids]
+
+
+class Id_counts:
+    """
+    Number of points per id, kept as arrays sorted by id.
+
+    Attributes:
+        ids (np.ndarray): Sorted ids.
+        counts (np.ndarray): Number of points of each id.
+    """
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, counts):
+        """
+        Add counts, new ids are inserted at their sorted position.
+
+        Args:
+            ids (np.ndarray): Sorted unique ids.
+            counts (np.ndarray): Counts of the ids.
+        """
+        pos, found = lookup(self.ids, ids)
+        self.counts[pos[found]] += counts[found]
+
+        new = ~found
+        if new.any():
+            insert = np.searchsorted(self.ids, ids[new])
+            self.ids = np.insert(self.ids, insert, ids[new])
+            self.counts = np.insert(self.counts, insert, counts[new])
+
+
 class EvalPQ4D:
     def __init__(self, num_classes, ignore=None, offset=2**32, min_points=30):
         self.num_classes = num_classes
@@ -28,14 +98,70 @@ class EvalPQ4D:
 
         self.pan_aq = np.zeros(self.num_classes, dtype=np.float32)
 
-    def update_dict(self, stat_dict, unique_ids, unique_counts):
-        for idx, count in zip(unique_ids, unique_counts):
-            if idx == 1:
+    def add_sequence(self, seq):
+        self.sequences.append(seq)
+        self.preds[seq] = Id_counts()
+        self.gts[seq] = [Id_counts() for _ in range(self.num_classes)]
+        self.intersects[seq] = [Id_counts() for _ in range(self.num_classes)]
+
+    ### STATE
+    def state_dict(self):
+        """Partial statistics, mergeable with the statistics of other scenes"""
+        return {
+            "num_classes": self.num_classes,
+            "conf_matrix": self.conf_matrix,
+            "sequences": self.sequences,
+            "preds": self.preds,
+            "gts": self.gts,
+            "intersects": self.intersects,
+        }
+
+    def load_state_dict(self, state):
+        self.reset()
+        self.merge(state)
+
+    def merge(self, state):
+        """
+        Add the statistics of another evaluator.
+
+        Sequences are appended in the order of the merged state, merging the
+        shards of a run in order gives the same metrics as a single run. A
+        sequence present in both is summed.
+
+        Args:
+            state (dict): Output of state_dict of the other evaluator.
+        """
+        if state["num_classes"] != self.num_classes:
+            raise ValueError(
+                f"Cannot merge {state['num_classes']} classes into {self.num_classes}"
+            )
+
+        self.conf_matrix += state["conf_matrix"]
+        for seq in state["sequences"]:
+            if seq not in self.sequences:
+                self.sequences.append(seq)
+                self.preds[seq] = copy.deepcopy(state["preds"][seq])
+                self.gts[seq] = copy.deepcopy(state["gts"][seq])
+                self.intersects[seq] = copy.deepcopy(state["intersects"][seq])
                 continue
-            if idx in stat_dict:
-                stat_dict[idx] += count
-            else:
-                stat_dict[idx] = count
+
+            other = state["preds"][seq]
+            self.preds[seq].add(other.ids, other.counts)
+            for class_id in range(self.num_classes):
+                other = state["gts"][seq][class_id]
+                self.gts[seq][class_id].add(other.ids, other.counts)
+                other = state["intersects"][seq][class_id]
+                self.intersects[seq][class_id].add(other.ids, other.counts)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.state_dict(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """Load a state saved by save, to be passed to merge"""
+        with open(path, "rb") as f:
+            return pickle.load(f)
 
     def update(self, seq, pred_sem, pred_inst, gt_sem, gt_inst):
         mask = gt_sem < self.num_classes
@@ -49,9 +175,10 @@ class EvalPQ4D:
 
     ### IoU
     def update_iou(self, pred_sem, gt_sem):
-        idxs = np.stack([pred_sem, gt_sem], axis=0)
+        idxs = pred_sem.astype(np.int64) * self.num_classes + gt_sem
+        conf = np.bincount(idxs, minlength=self.num_classes**2)
 
-        np.add.at(self.conf_matrix, tuple(idxs), 1)
+        self.conf_matrix += conf.reshape(self.num_classes, self.num_classes)
 
     def get_iou_vals(self):
         conf_matrix = self.conf_matrix.copy()
@@ -87,92 +214,88 @@ class EvalPQ4D:
     ### Panoptic
     def update_pan(self, seq, pred_sem, pred_inst, gt_sem, gt_inst):
         if seq not in self.sequences:
-            self.sequences.append(seq)
-            self.preds[seq] = {}
-            self.gts[seq] = [{} for _ in range(self.num_classes)]
-            self.intersects[seq] = [{} for _ in range(self.num_classes)]
-
-        pred_inst += 1
-        gt_inst += 1
-
-        for class_id in self.ignore:
-            gt_mask = gt_sem != class_id
-
-            pred_sem = pred_sem[gt_mask]
-            pred_inst = pred_inst[gt_mask]
-            gt_sem = gt_sem[gt_mask]
-            gt_inst = gt_inst[gt_mask]
-
-        cl_preds = self.preds[seq]
-        for class_id in self.include:
-            cl_gts = self.gts[seq][class_id]
-            cl_intersects = self.intersects[seq][class_id]
-
-            pred_inst_in_cl = pred_inst * (pred_sem == class_id)
-            gt_inst_in_cl = gt_inst * (gt_sem == class_id)
-
-            unique_gt, counts_gt = np.unique(
-                gt_inst_in_cl[gt_inst_in_cl > 0], return_counts=True
-            )
-            self.update_dict(
-                cl_gts,
-                unique_gt[counts_gt > self.min_points],
-                counts_gt[counts_gt > self.min_points],
-            )
-
-            mask = np.zeros_like(gt_inst_in_cl)
-            for valid_id in unique_gt[counts_gt > self.min_points]:
-                mask = np.logical_or(mask, gt_inst_in_cl == valid_id)
-            gt_inst_in_cl = gt_inst_in_cl * mask
+            self.add_sequence(seq)
+
+        # id 1 is the point without instance, it has no tube of its own
+        pred_inst = pred_inst.astype(np.int64) + 1
+        gt_inst = gt_inst.astype(np.int64) + 1
+
+        keep = ~np.isin(gt_sem, self.ignore)
+        pred_sem = pred_sem[keep]
+        pred_inst = pred_inst[keep]
+        gt_sem = gt_sem[keep]
+        gt_inst = gt_inst[keep]
+
+        # predicted ids, counted over the included classes
+        pred_in_cl = np.logical_and(np.isin(pred_sem, self.include), pred_inst > 0)
+        ids, counts = count_keys(pred_inst[pred_in_cl])
+        self.preds[seq].add(ids[ids != 1], counts[ids != 1])
+
+        # gt tubes, keyed by class and id, with more than min_points points
+        gt_in_cl = np.logical_and(np.isin(gt_sem, self.include), gt_inst > 0)
+        num_ids = int(gt_inst.max()) + 1 if gt_inst.size > 0 else 1
+        gt_keys = gt_sem.astype(np.int64) * num_ids + gt_inst
+        tubes, sizes = count_keys(gt_keys[gt_in_cl])
+        tubes = tubes[sizes > self.min_points]
+        sizes = sizes[sizes > self.min_points]
+        tube_cls, tube_ids = np.divmod(tubes, num_ids)
+
+        # intersections of the valid gt tubes with any predicted id
+        tube_pos, in_tube = lookup(tubes, gt_keys)
+        valid_combos = np.logical_and.reduce((gt_in_cl, in_tube, pred_inst > 0))
+        num_preds = int(pred_inst.max()) + 1 if pred_inst.size > 0 else 1
+        combos, combo_counts = count_keys(
+            tube_pos[valid_combos] * num_preds + pred_inst[valid_combos]
+        )
+        combo_tubes, combo_preds = np.divmod(combos, num_preds)
+        combo_keys = combo_preds + self.offset * tube_ids[combo_tubes]
+        combo_cls = tube_cls[combo_tubes]
 
-            unique_pred, counts_pred = np.unique(
-                pred_inst_in_cl[pred_inst_in_cl > 0], return_counts=True
-            )
-            self.update_dict(cl_preds, unique_pred, counts_pred)
+        for class_id in np.unique(tube_cls):
+            in_cl = tube_cls == class_id
+            valid = np.logical_and(in_cl, tube_ids != 1)
+            self.gts[seq][class_id].add(tube_ids[valid], sizes[valid])
 
-            valid_combos = np.logical_and(pred_inst > 0, gt_inst_in_cl > 0)
-            offset_combos = (
-                pred_inst[valid_combos] + self.offset * gt_inst_in_cl[valid_combos]
-            )
-            unique_combos, counts_combos = np.unique(offset_combos, return_counts=True)
-            self.update_dict(cl_intersects, unique_combos, counts_combos)
+            in_cl = combo_cls == class_id
+            self.intersects[seq][class_id].add(combo_keys[in_cl], combo_counts[in_cl])
 
     ### PQ4D
     def compute(self):
         precs = []
         recalls = []
-        num_tubes = [0] * self.num_classes
+        num_tubes = np.zeros(self.num_classes, dtype=np.int64)
         self.pan_aq = np.zeros(self.num_classes, dtype=np.float32)
 
         for seq in self.sequences:
-            cl_preds = self.preds[seq]
+            pr_ids, pr_sizes = self.preds[seq].ids, self.preds[seq].counts
             for class_id in self.include:
-                cl_gts = self.gts[seq][class_id]
-                cl_intersects = self.intersects[seq][class_id]
-                outer_sum_iou = 0.0
-                num_tubes[class_id] += len(cl_gts)
-
-                for gt_id, gt_size in cl_gts.items():
-                    inner_sum_iou = 0.0
-                    for pr_id, pr_size in cl_preds.items():
-                        TPA_key = pr_id + self.offset * gt_id
-                        if TPA_key in cl_intersects:
-                            TPA = cl_intersects[TPA_key]
-                            prec = TPA / float(pr_size)
-                            recall = TPA / float(gt_size)
-                            inner_sum_iou += TPA * (TPA / (gt_size + pr_size - TPA))
-                            precs.append(prec)
-                            recalls.append(recall)
-                    outer_sum_iou += float(inner_sum_iou) / float(gt_size)
-                self.pan_aq[class_id] += outer_sum_iou
+                gts = self.gts[seq][class_id]
+                gt_ids, gt_sizes = gts.ids, gts.counts
+                keys = self.intersects[seq][class_id].ids
+                tpa = self.intersects[seq][class_id].counts
+                num_tubes[class_id] += len(gt_ids)
+
+                # only visit the (gt, pred) pairs that intersect
+                gt_of_key, pr_of_key = np.divmod(keys, self.offset)
+                gt_pos, gt_found = lookup(gt_ids, gt_of_key)
+                pr_pos, pr_found = lookup(pr_ids, pr_of_key)
+                valid = np.logical_and(gt_found, pr_found)
+
+                tpa = tpa[valid].astype(np.float64)
+                gt_size = gt_sizes[gt_pos[valid]]
+                pr_size = pr_sizes[pr_pos[valid]]
+                precs.append(tpa / pr_size)
+                recalls.append(tpa / gt_size)
+                iou = tpa / (gt_size + pr_size - tpa)
+                self.pan_aq[class_id] += np.sum(tpa * iou / gt_size)
 
         AQ_overall = np.sum(self.pan_aq) / np.sum(num_tubes)
         AQ = self.pan_aq / np.maximum(num_tubes, self.eps)
 
         iou, iou_mean, iou_p, iou_r = self.get_iou()
 
-        AQ_p = np.mean(precs)
-        AQ_r = np.mean(recalls)
+        AQ_p = np.mean(np.concatenate(precs)) if precs else np.mean([])
+        AQ_r = np.mean(np.concatenate(recalls)) if recalls else np.mean([])
 
         PQ4D = np.sqrt(AQ_overall * iou_mean)
 
@@ -1,22 +1,129 @@
 import os
+from typing import List, Optional, Tuple
 
 import torch
 import numpy as np
+from torch_scatter import scatter
 from pytorch3d.ops.knn import knn_points
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.checkpoint import checkpoint
 
-from LetItFlow import let_it_flow
+from LetItFlow import let_it_flow, sc_utils
+from utils.tracing import traced
+from utils.misc import transform_pointcloud
+from utils.flow_store import Flow_reader
 
 
-def flow_estimation_lif(config, src_points, dst_points, src_labels, dst_labels, device):
+class Convergence_monitor:
+    """
+    Stop the optimization of each pair once its loss plateaus.
+
+    The monitored loss (weighted truncated chamfer + rigidity) is read back
+    every config["stop_check"] iterations only, to limit host syncs. A pair
+    stops when its best loss did not improve by more than config["stop_tol"]
+    (relative) for config["stop_patience"] iterations, after at least
+    config["stop_min_iters"] iterations. Disabled with config["early_stop"].
+
+    Attributes:
+        iters (np.ndarray): Number of optimizer steps of each pair, -1 while running.
+        loss (np.ndarray): Monitored loss of each pair when it stopped.
+    """
+
+    def __init__(self, num_pairs: int, config: dict):
+        self.enabled = config["early_stop"]
+        self.tol = config["stop_tol"]
+        self.patience = config["stop_patience"]
+        self.min_iters = config["stop_min_iters"]
+        self.check = config["stop_check"]
+
+        self.best = np.full(num_pairs, np.inf)
+        self.best_iter = np.zeros(num_pairs, dtype=np.int64)
+        self.iters = np.full(num_pairs, -1, dtype=np.int64)
+        self.loss = np.full(num_pairs, np.nan)
+        self._last = None
+
+    @property
+    def done(self) -> bool:
+        return bool((self.iters >= 0).all())
+
+    def update(self, steps: int, loss: torch.Tensor) -> np.ndarray:
+        """
+        Monitor the loss of every pair after steps optimizer steps.
+
+        Args:
+            steps (int): Number of optimizer steps done so far.
+            loss (torch.Tensor): Monitored loss of each pair (B,).
+
+        Returns:
+            np.ndarray: Indices of the pairs that stop now.
+        """
+        self._last = loss.detach()
+        if not self.enabled or steps % self.check != 0:
+            return np.zeros(0, dtype=np.int64)
+
+        values = self._last.cpu().numpy().astype(np.float64)
+        # the first check always improves, inf - tol * inf would be nan
+        with np.errstate(invalid="ignore"):
+            threshold = self.best - self.tol * np.abs(self.best)
+        improved = ~np.isfinite(self.best) | (values < threshold)
+        self.best[improved] = values[improved]
+        self.best_iter[improved] = steps
+
+        stop = (
+            (self.iters < 0)
+            & (steps >= self.min_iters)
+            & (steps - self.best_iter >= self.patience)
+        )
+        self.iters[stop] = steps
+        self.loss[stop] = values[stop]
+        return np.flatnonzero(stop)
+
+    def finish(self, steps: int) -> None:
+        """Record the pairs still running after the last of steps iterations."""
+        running = self.iters < 0
+        self.iters[running] = steps
+        if self._last is not None:
+            self.loss[running] = self._last.cpu().numpy()[running]
+
+    def stats(self) -> List[dict]:
+        """Iterations used and final monitored loss of each pair."""
+        return [
+            {"iters": int(n), "loss": float(l)} for n, l in zip(self.iters, self.loss)
+        ]
+
+
+@traced("flow_estimation")
+def flow_estimation_lif(
+    config,
+    src_points,
+    dst_points,
+    src_labels,
+    dst_labels,
+    device,
+    return_stats=False,
+    init_flow=None,
+):
     p1, p2 = src_points.unsqueeze(0), dst_points.unsqueeze(0)
     c1, c2 = src_labels, dst_labels
-    f1 = torch.zeros(p1.shape, device=device, requires_grad=True)
+    if init_flow is None:
+        f1 = torch.zeros(p1.shape, device=device, requires_grad=True)
+    else:
+        f1 = init_flow.detach().float().to(device).unsqueeze(0).clone()
+        f1.requires_grad_(True)
 
     optimizer = torch.optim.Adam([f1], lr=config["lr"])
-    RigidLoss = let_it_flow.SC2_KNN_cluster_aware(
-        p1, K=config["K"], d_thre=config["d_thre"]
+    RigidLoss = SC2_KNN_batch(
+        p1,
+        torch.tensor([p1.shape[1]], device=p1.device),
+        torch.ones(p1.shape[:2], dtype=torch.bool, device=p1.device),
+        K=config["K"],
+        d_thre=config["d_thre"],
+        power_iters=config["sc_power_iters"],
+        memory_mb=config["sc_memory_mb"],
     )
 
+    monitor = Convergence_monitor(1, config)
+    steps = 0
     for i in range(config["iters"]):
         loss = 0
 
@@ -26,12 +133,16 @@ def flow_estimation_lif(config, src_points, dst_points, src_labels, dst_labels,
         dist_b, _, _ = knn_points(
             p2, p1 + f1, lengths1=None, lengths2=None, K=1, return_nn=True
         )
-        loss += config["dist_w"] * (
+        chamfer = config["dist_w"] * (
             dist[dist < config["trunc_dist"]].mean()
             + dist_b[dist_b < config["trunc_dist"]].mean()
         )
+        loss += chamfer
+
+        sc_loss = RigidLoss(f1)[0]
 
-        sc_loss = RigidLoss(f1, c1)
+        if monitor.update(i, (chamfer + config["sc_w"] * sc_loss).reshape(1)).size:
+            break
 
         if config["sc_w"] > 0:
             loss += config["sc_w"] * sc_loss
@@ -48,24 +159,452 @@ def flow_estimation_lif(config, src_points, dst_points, src_labels, dst_labels,
 
         optimizer.step()
         optimizer.zero_grad()
+        steps += 1
 
+    monitor.finish(steps)
+    if return_stats:
+        return f1.detach().squeeze(), monitor.stats()[0]
     return f1.detach().squeeze()
 
 
-def load_flow(args, scene, src_info, dst_info):
-    filename = (
-        scene["name"]
-        + "_"
-        + str(src_info["token"])
-        + "_"
-        + str(dst_info["token"])
-        + ".npz"
+def pad_points(
+    points: List[torch.Tensor], dtype: torch.dtype
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Zero-pad point clouds of different sizes into one batch.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Points (B, N, 3),
+            number of points (B,) and mask of the real points (B, N).
+    """
+    padded = pad_sequence([p.to(dtype) for p in points], batch_first=True)
+    lengths = torch.tensor([p.shape[0] for p in points], device=padded.device)
+    mask = torch.arange(padded.shape[1], device=padded.device) < lengths[:, None]
+    return padded, lengths, mask
+
+
+def pair_mean(values: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mean of the masked (B, N) values of each pair."""
+    return (values * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+def power_iteration_fixed(M: torch.Tensor, num_iterations: int = 10) -> torch.Tensor:
+    """
+    sc_utils.power_iteration with a fixed number of iterations, without the
+    convergence test that syncs with the host at every iteration.
+    """
+    leading_eig = torch.ones_like(M[:, :, 0:1])
+    for _ in range(num_iterations):
+        leading_eig = torch.bmm(M, leading_eig)
+        norm = torch.norm(leading_eig, dim=1, keepdim=True)
+        leading_eig = leading_eig / (norm + 1e-6)
+    return leading_eig.squeeze(-1)
+
+
+class SC2_KNN_batch(torch.nn.Module):
+    """
+    SC2_KNN_cluster_aware of LetItFlow for padded batches of point clouds,
+    the neighborhoods only contain real points of the same cloud.
+
+    The distances between the source neighbors are computed once. The loss is
+    evaluated on chunks of points whose K x K matrices fit in memory_mb, and
+    each chunk is recomputed in the backward pass, so the memory does not grow
+    with the number of points beyond the (M, K, K) source distances.
+    """
+
+    def __init__(
+        self, pc1, lengths, mask, K=16, d_thre=0.03, power_iters=10, memory_mb=256
+    ):
+        super().__init__()
+        self.d_thre = d_thre
+        self.power_iters = power_iters
+        self.mask = mask
+        _, kNN, _ = knn_points(pc1, pc1, lengths1=lengths, lengths2=lengths, K=K)
+        batch_idx = torch.arange(pc1.shape[0], device=pc1.device)[:, None, None]
+        # neighborhoods of the real points only, (M, K)
+        self.batch_idx = batch_idx.expand_as(kNN)[mask]
+        self.kNN = kNN[mask]
+        self.src_keypts = pc1[self.batch_idx, self.kNN]
+
+        # about 8 K x K matrices per point are alive in a chunk
+        point_bytes = 8 * K * K * self.src_keypts.element_size()
+        self.chunk_size = max(1, memory_mb * 2**20 // point_bytes)
+        with torch.no_grad():
+            self.src_dist = torch.cat(
+                [
+                    self.pairwise_dist(self.src_keypts[i : i + self.chunk_size])
+                    for i in range(0, len(self.src_keypts), self.chunk_size)
+                ]
+            )
+
+    @staticmethod
+    def pairwise_dist(keypts):
+        return (keypts[:, :, None, :] - keypts[:, None, :, :]).norm(dim=-1)
+
+    def chunk_loss(self, src_keypts, src_dist, flow_keypts):
+        target_dist = self.pairwise_dist(src_keypts + flow_keypts)
+        cross_dist = (src_dist - target_dist).abs()
+        A = torch.clamp(1.0 - cross_dist**2 / self.d_thre**2, min=0)
+
+        leading_eig = power_iteration_fixed(A, self.power_iters)
+        sc2_rigidity = sc_utils.spatial_consistency_score(A, leading_eig)
+        return -torch.log(sc2_rigidity[:, 0])
+
+    def forward(self, flow):
+        flow_keypts = flow[self.batch_idx, self.kNN]
+
+        losses = []
+        for i in range(0, len(self.src_keypts), self.chunk_size):
+            chunk = (
+                self.src_keypts[i : i + self.chunk_size],
+                self.src_dist[i : i + self.chunk_size],
+                flow_keypts[i : i + self.chunk_size],
+            )
+            if torch.is_grad_enabled():
+                losses.append(checkpoint(self.chunk_loss, *chunk, use_reentrant=False))
+            else:
+                losses.append(self.chunk_loss(*chunk))
+
+        # mean over the points of each pair
+        loss = torch.zeros(self.mask.shape, dtype=losses[0].dtype, device=flow.device)
+        loss[self.mask] = torch.cat(losses)
+        return pair_mean(loss, self.mask)
+
+
+def center_rigidity_loss_batch(pc1, flow, cluster_ids, mask):
+    """
+    center_rigidity_loss of LetItFlow for padded batches.
+
+    Args:
+        pc1 (torch.Tensor): Points (B, N, 3).
+        flow (torch.Tensor): Flow (B, N, 3).
+        cluster_ids (List[torch.Tensor]): Cluster id of the real points of each
+            pair, -1 for noise.
+        mask (torch.Tensor): Mask of the real points (B, N).
+
+    Returns:
+        torch.Tensor: Loss of each pair (B,).
+    """
+    # cluster ids unique over the batch
+    num_ids = torch.stack([c.max() + 2 for c in cluster_ids])
+    offsets = torch.cumsum(num_ids, dim=0) - num_ids
+    ids = torch.cat([c + 1 + o for c, o in zip(cluster_ids, offsets)])
+
+    pts = pc1[mask]
+    pts_flow = pts + flow[mask]
+    pts_centers = scatter(pts, ids, dim=0, reduce="mean")
+    flow_centers = scatter(pts_flow, ids, dim=0, reduce="mean")
+
+    center_displacement = (pts - pts_centers[ids]) - (pts_flow - flow_centers[ids])
+    loss = torch.zeros(mask.shape, dtype=pts.dtype, device=pts.device)
+    loss[mask] = center_displacement.norm(dim=-1)
+    return pair_mean(loss, mask)
+
+
+@traced("flow_estimation_batch")
+def flow_estimation_lif_batch(
+    config: dict,
+    src_points: List[torch.Tensor],
+    dst_points: List[torch.Tensor],
+    src_labels: List[torch.Tensor],
+    dst_labels: List[torch.Tensor],
+    device: torch.device,
+    return_stats: bool = False,
+) -> List[torch.Tensor]:
+    """
+    Jointly optimize the flow of independent frame pairs.
+
+    The point clouds are zero-padded and padded points are masked out of all
+    losses. The optimized loss is the sum of the losses of the pairs and Adam
+    updates every element independently, so each pair follows the optimization
+    of flow_estimation_lif.
+
+    Args:
+        config (dict): Let It Flow config.
+        src_points (List[torch.Tensor]): Source points (N_b, 3) of each pair.
+        dst_points (List[torch.Tensor]): Destination points (M_b, 3) of each pair.
+        src_labels (List[torch.Tensor]): Source cluster ids (N_b,) of each pair.
+        dst_labels (List[torch.Tensor]): Destination cluster ids (M_b,) of each pair.
+        device (torch.device): Device of the optimization.
+        return_stats (bool): Also return the iterations used and the final loss
+            of each pair.
+
+    Returns:
+        List[torch.Tensor]: Flow (N_b, 3) of each pair, and the statistics of
+            Convergence_monitor when return_stats is set. The flow of a pair is
+            kept when it converges, the batch stops when all pairs converged.
+    """
+    dtype = src_points[0].dtype
+    p1, len1, mask1 = pad_points(src_points, dtype)
+    p2, len2, mask2 = pad_points(dst_points, dtype)
+    c1 = [c.clone() for c in src_labels]
+    c2 = [c.clone() for c in dst_labels]
+    f1 = torch.zeros(p1.shape, device=device, requires_grad=True)
+
+    optimizer = torch.optim.Adam([f1], lr=config["lr"])
+    RigidLoss = SC2_KNN_batch(
+        p1,
+        len1,
+        mask1,
+        K=config["K"],
+        d_thre=config["d_thre"],
+        power_iters=config["sc_power_iters"],
+        memory_mb=config["sc_memory_mb"],
+    )
+
+    lengths = len1.tolist()
+    flows = [None] * len(lengths)
+    monitor = Convergence_monitor(len(lengths), config)
+    steps = 0
+    for i in range(config["iters"]):
+        dist, nn, _ = knn_points(
+            p1 + f1, p2, lengths1=len1, lengths2=len2, K=1, return_nn=True
+        )
+        dist_b, _, _ = knn_points(
+            p2, p1 + f1, lengths1=len2, lengths2=len1, K=1, return_nn=True
+        )
+        dist, dist_b = dist[..., 0], dist_b[..., 0]
+        loss = config["dist_w"] * (
+            pair_mean(dist, mask1 & (dist < config["trunc_dist"]))
+            + pair_mean(dist_b, mask2 & (dist_b < config["trunc_dist"]))
+        )
+
+        sc_loss = RigidLoss(f1)
+
+        # keep the flow of converged pairs
+        for b in monitor.update(i, loss + config["sc_w"] * sc_loss):
+            flows[b] = f1[b, : lengths[b]].detach().clone()
+        if monitor.done:
+            break
+
+        if config["sc_w"] > 0:
+            loss = loss + config["sc_w"] * sc_loss
+            loss = loss + config["sc_w"] + center_rigidity_loss_batch(
+                p1, f1, c1, mask1
+            )
+
+        loss = loss + torch.linalg.vector_norm(f1[..., 2] * mask1, dim=1)
+
+        if i % 10 == 0 and config["passing_ids"]:
+            for b in range(len(c1)):
+                c1[b] = let_it_flow.pass_id_clusters(
+                    c1[b], c2[b], nn[b : b + 1, : len1[b]]
+                )
+
+        loss.sum().backward()
+
+        optimizer.step()
+        optimizer.zero_grad()
+        steps += 1
+
+    monitor.finish(steps)
+    f1 = f1.detach()
+    flows = [
+        f1[b, :n] if flow is None else flow
+        for b, (flow, n) in enumerate(zip(flows, lengths))
+    ]
+    if return_stats:
+        return flows, monitor.stats()
+    return flows
+
+
+def voxel_downsample(
+    points: torch.Tensor, labels: torch.Tensor, voxel_size: float
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Replace the points of each occupied voxel by their centroid.
+
+    Args:
+        points (torch.Tensor): Points (N, 3).
+        labels (torch.Tensor): Cluster id of each point (N,).
+        voxel_size (float): Edge of the voxels in meters.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Centroids (V, 3), cluster
+            id of the first point of each voxel (V,) and voxel of each point (N,).
+    """
+    coords = torch.floor(points / voxel_size).long()
+    _, inverse = torch.unique(coords, dim=0, return_inverse=True)
+    centroids = scatter(points, inverse, dim=0, reduce="mean")
+    index = torch.arange(len(points), device=points.device)
+    first = scatter(index, inverse, dim=0, reduce="min")
+    return centroids, labels[first].clone(), inverse
+
+
+@traced("flow_estimation_multires")
+def flow_estimation_lif_multires(
+    config: dict,
+    src_points: torch.Tensor,
+    dst_points: torch.Tensor,
+    src_labels: torch.Tensor,
+    dst_labels: torch.Tensor,
+    device: torch.device,
+    return_stats: bool = False,
+):
+    """
+    Coarse-to-fine flow_estimation_lif.
+
+    The flow is first optimized on voxel-downsampled clouds, one level per voxel
+    size of config["voxel_sizes"] (coarse to fine). The flow of a voxel is
+    given to all its points and initializes the next level, the last level
+    initializes config["refine_iters"] iterations on the full clouds.
+
+    Args:
+        config (dict): Let It Flow config.
+        src_points (torch.Tensor): Source points (N, 3).
+        dst_points (torch.Tensor): Destination points (M, 3).
+        src_labels (torch.Tensor): Source cluster ids (N,).
+        dst_labels (torch.Tensor): Destination cluster ids (M,).
+        device (torch.device): Device of the optimization.
+        return_stats (bool): Also return the iterations of every level and the
+            final loss.
+
+    Returns:
+        torch.Tensor: Flow (N, 3), and the statistics when return_stats is set.
+            "iters" sums the iterations of all levels.
+    """
+    flow = None
+    levels = []
+    for voxel_size in config["voxel_sizes"]:
+        src, src_lab, inverse = voxel_downsample(src_points, src_labels, voxel_size)
+        dst, dst_lab, _ = voxel_downsample(dst_points, dst_labels, voxel_size)
+        init = None
+        if flow is not None:
+            init = scatter(flow, inverse, dim=0, reduce="mean")
+        level_flow, stats = flow_estimation_lif(
+            config,
+            src,
+            dst,
+            src_lab,
+            dst_lab,
+            device,
+            return_stats=True,
+            init_flow=init,
+        )
+        flow = level_flow.reshape(-1, 3)[inverse]
+        levels.append(stats)
+
+    refine_config = dict(config, iters=config["refine_iters"])
+    flow, stats = flow_estimation_lif(
+        refine_config,
+        src_points,
+        dst_points,
+        src_labels.clone(),
+        dst_labels.clone(),
+        device,
+        return_stats=True,
+        init_flow=flow,
     )
+    levels.append(stats)
+
+    if return_stats:
+        stats = {
+            "iters": sum(level["iters"] for level in levels),
+            "loss": stats["loss"],
+            "levels": levels,
+        }
+        return flow, stats
+    return flow
+
+
+def kitti_frames(path_dataset: str, sequence: int) -> List[dict]:
+    """
+    Frames of a SemanticKITTI sequence, in the layout of the precompute_flow.py
+    manifest.
+
+    Args:
+        path_dataset (str): Path to SemanticKITTI.
+        sequence (int): Number of the sequence.
+
+    Returns:
+        List[dict]: Point cloud and label files (None for the test sequences)
+            and ego motion to the first frame of every frame.
+    """
+    scene_dir = os.path.join(path_dataset, f"dataset/sequences/{sequence:02d}")
+    poses = np.loadtxt(os.path.join(scene_dir, "poses.txt")).reshape(-1, 3, 4)
+    poses_h = np.zeros((poses.shape[0], 4, 4))
+    poses_h[:, :3, :] = poses
+    poses_h[:, 3, 3] = 1
+    pose_o = np.linalg.inv(poses_h[0])
+
+    num_frames = len(os.listdir(os.path.join(scene_dir, "velodyne")))
+    return [
+        {
+            "points": os.path.join(scene_dir, "velodyne", f"{i:06d}.bin"),
+            # test sequences have no labels, pairs are clustered instead
+            "labels": (
+                os.path.join(scene_dir, "labels", f"{i:06d}.label")
+                if sequence < 11
+                else None
+            ),
+            "ego": (pose_o @ poses_h[i]).tolist(),
+        }
+        for i in range(num_frames)
+    ]
+
+
+def load_frame(
+    frame: dict, dataset: str, device: torch.device
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """Load the ego compensated points and the semantic labels of a frame."""
+    if dataset == "nuscenes":
+        points = np.fromfile(frame["points"], dtype=np.float32).reshape(-1, 5)
+        points = torch.from_numpy(points[:, :3]).to(device)
+    else:
+        points = np.fromfile(frame["points"], dtype=np.float32).reshape(-1, 4)
+        points = torch.from_numpy(points[:, :3]).to(device).double()
+    points = transform_pointcloud(points, np.array(frame["ego"]))
+
+    if frame["labels"] is None:
+        labels = None
+    elif dataset == "nuscenes":
+        labels = np.load(frame["labels"], allow_pickle=True)["data"]
+        labels = torch.from_numpy(labels.astype(np.int32) // 1000).to(device).long()
+    else:
+        labels = np.fromfile(frame["labels"], dtype=np.uint32) & 0xFFFF
+        labels = torch.from_numpy(labels.astype(np.int32)).to(device).long()
+
+    return points, labels
+
+
+# Flow reader of each flow directory
+_flow_readers = {}
+
+
+@traced("load_flow")
+def load_flow(args, scene, src_info, dst_info):
     if args.dataset == "nuscenes":
-        file_path = os.path.join(args.path_dataset, "flow", filename)
+        flow_dir = os.path.join(args.path_dataset, "flow")
     elif args.dataset == "semantic_kitti":
-        file_path = os.path.join(args.path_dataset, "dataset/flow", filename)
+        flow_dir = os.path.join(args.path_dataset, "dataset/flow")
+
+    if flow_dir not in _flow_readers:
+        _flow_readers[flow_dir] = Flow_reader(flow_dir)
+    flow = _flow_readers[flow_dir].read(
+        scene["name"], src_info["token"], dst_info["token"]
+    )
+    if flow is None:
+        raise FileNotFoundError(
+            f"No flow of {scene['name']} {src_info['token']} {dst_info['token']}"
+        )
+
+    # copy, views of the store are read-only
+    return torch.from_numpy(flow.astype(np.float32))
+
 
-    flow = np.load(file_path, allow_pickle=True)["flow"]
+if __name__ == "__main__":
+    config = {
+        "early_stop": True,
+        "stop_check": 10,
+        "stop_min_iters": 100,
+        "stop_patience": 50,
+        "stop_tol": 0.001,
+    }
 
-    return torch.from_numpy(flow).float()
+    # pair 0 keeps decreasing, pair 1 is flat from the start
+    monitor = Convergence_monitor(2, config)
+    for steps in range(1000):
+        loss = torch.tensor([np.exp(-0.01 * steps), 1.0])
+        monitor.update(steps, loss)
+    monitor.finish(1000)
+    np.testing.assert_equal(monitor.iters, [1000, 100])
@@ -0,0 +1,202 @@
+import os
+import argparse
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Files of the store of a scene, next to the .npz files of the flow directory
+STORE_DATA = "{}.flow.bin"
+STORE_INDEX = "{}.flow.index"
+STORE_DTYPE = np.float16
+
+
+def pair_key(src, dst) -> str:
+    """Key of a pair, the tokens (nuScenes) or frames (SemanticKITTI) of the frames."""
+    return f"{src}_{dst}"
+
+
+class Flow_store:
+    """
+    Read the scene flow of the pairs of a scene written by convert_scene.
+
+    <flow_dir>/<scene>.flow.bin holds the float16 flow (N, 3) of every pair back
+    to back, <flow_dir>/<scene>.flow.index has one "src_dst offset num_points"
+    line per pair. The data file is memory-mapped, reading a pair returns a view.
+    """
+
+    def __init__(self, flow_dir: str, scene_name: str):
+        self.index = {}
+        with open(os.path.join(flow_dir, STORE_INDEX.format(scene_name)), "r") as f:
+            for line in f:
+                key, offset, num_points = line.split()
+                self.index[key] = (int(offset), int(num_points))
+
+        data_file = os.path.join(flow_dir, STORE_DATA.format(scene_name))
+        if os.path.getsize(data_file) > 0:
+            self._data = np.memmap(data_file, dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def read(self, src, dst) -> Optional[np.ndarray]:
+        """Return the read-only flow (N, 3) of the pair, None if not stored."""
+        key = pair_key(src, dst)
+        if key not in self.index:
+            return None
+        offset, num_points = self.index[key]
+        size = num_points * 3 * np.dtype(STORE_DTYPE).itemsize
+        return self._data[offset : offset + size].view(STORE_DTYPE).reshape(-1, 3)
+
+
+class Flow_reader:
+    """
+    Read the scene flow of a flow directory, from the stores of the converted
+    scenes and from the .npz files (<scene>_<src>_<dst>.npz) otherwise.
+    precompute_flow.py invalidates the store of a scene it writes flow for.
+
+    Stores are opened on first use and kept open. They are not pickled, so
+    dataloader workers map the files themselves instead of copying them.
+    """
+
+    def __init__(self, flow_dir: str):
+        self.flow_dir = flow_dir
+        self.stores: Dict[str, Optional[Flow_store]] = {}
+
+    def __getstate__(self):
+        return {"flow_dir": self.flow_dir, "stores": {}}
+
+    def _store(self, scene_name: str) -> Optional[Flow_store]:
+        if scene_name not in self.stores:
+            index = os.path.join(self.flow_dir, STORE_INDEX.format(scene_name))
+            self.stores[scene_name] = (
+                Flow_store(self.flow_dir, scene_name) if os.path.exists(index) else None
+            )
+        return self.stores[scene_name]
+
+    def read(self, scene_name: str, src, dst) -> Optional[np.ndarray]:
+        """
+        Return the flow of a pair.
+
+        Args:
+            scene_name (str): The name of the scene.
+            src: Token or frame of the source frame.
+            dst: Token or frame of the destination frame.
+
+        Returns:
+            Optional[np.ndarray]: Flow (N, 3), a float16 view of the store or the
+                float32 array of the .npz file. None if the pair has no flow.
+        """
+        store = self._store(scene_name)
+        if store is not None:
+            flow = store.read(src, dst)
+            if flow is not None:
+                return flow
+
+        filename = f"{scene_name}_{pair_key(src, dst)}.npz"
+        try:
+            return np.load(os.path.join(self.flow_dir, filename))["flow"]
+        except FileNotFoundError:
+            return None
+
+
+def invalidate_store(flow_dir: str, scene_name: str) -> bool:
+    """
+    Remove the store of a scene, its pairs are read from the .npz files again.
+    Used when new flow of the scene is written, the store would be stale.
+
+    Returns:
+        bool: Whether the scene had a store.
+    """
+    removed = False
+    # the index first, a store without index is never opened
+    for name in (STORE_INDEX, STORE_DATA):
+        path = os.path.join(flow_dir, name.format(scene_name))
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    return removed
+
+
+def list_pairs(flow_dir: str) -> Dict[str, List[Tuple[str, str, str]]]:
+    """Group the .npz files of a flow directory by scene, as (src, dst, path)."""
+    scenes = defaultdict(list)
+    for filename in sorted(os.listdir(flow_dir)):
+        if not filename.endswith(".npz"):
+            continue
+        # scene names may contain "_", tokens and frames do not
+        scene_name, src, dst = filename[:-4].rsplit("_", 2)
+        scenes[scene_name].append((src, dst, os.path.join(flow_dir, filename)))
+    return scenes
+
+
+def convert_scene(
+    flow_dir: str, scene_name: str, pairs: List[Tuple[str, str, str]]
+) -> float:
+    """
+    Write the store of a scene from its .npz files.
+
+    The data and index are written to temporary files renamed when complete,
+    the .npz files are kept.
+
+    Args:
+        flow_dir (str): The flow directory.
+        scene_name (str): The name of the scene.
+        pairs (List[Tuple[str, str, str]]): Source, destination and .npz file of
+            each pair, see list_pairs.
+
+    Returns:
+        float: Largest absolute error of the float16 conversion in meters.
+    """
+    max_error = 0.0
+    data_fd, data_tmp = tempfile.mkstemp(dir=flow_dir, suffix=".tmp")
+    index_fd, index_tmp = tempfile.mkstemp(dir=flow_dir, suffix=".tmp")
+    try:
+        with os.fdopen(data_fd, "wb") as data_file, os.fdopen(
+            index_fd, "w"
+        ) as index_file:
+            for src, dst, path in pairs:
+                with np.load(path) as data:
+                    flow = data["flow"].reshape(-1, 3)
+                packed = flow.astype(STORE_DTYPE)
+                if len(flow) > 0:
+                    error = np.abs(packed.astype(np.float32) - flow).max()
+                    max_error = max(max_error, float(error))
+                offset = data_file.tell()
+                data_file.write(packed.tobytes())
+                index_file.write(f"{pair_key(src, dst)} {offset} {len(flow)}\n")
+        os.replace(data_tmp, os.path.join(flow_dir, STORE_DATA.format(scene_name)))
+        os.replace(index_tmp, os.path.join(flow_dir, STORE_INDEX.format(scene_name)))
+    except BaseException:
+        for tmp in (data_tmp, index_tmp):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    return max_error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert .npz flow to flow stores")
+    parser.add_argument(
+        "flow_dir",
+        type=str,
+        help="Directory of the .npz files (<nuscenes>/flow, <kitti>/dataset/flow)",
+    )
+    parser.add_argument(
+        "--scenes", type=str, nargs="+", default=None, help="Scenes, all by default"
+    )
+    args = parser.parse_args()
+
+    scenes = list_pairs(args.flow_dir)
+    for scene_name in args.scenes or sorted(scenes):
+        max_error = convert_scene(args.flow_dir, scene_name, scenes[scene_name])
+        print(
+            f"Converted {scene_name}: {len(scenes[scene_name])} pairs, "
+            f"max error {max_error:.4f} m"
+        )
@@ -1,13 +1,16 @@
 import os
-import copy
 import argparse
-from dataclasses import dataclass
-from typing import Union, Tuple, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Union, Tuple, Optional, List
 
 import yaml
 import torch
 import numpy as np
 
+from utils.tracing import traced
+
 
 ###############################
 # IO functions
@@ -27,6 +30,7 @@ def load_config(file: str) -> dict:
     return config
 
 
+@traced("save_data")
 def save_data(
     save_path: str,
     scene_name: str,
@@ -43,15 +47,128 @@ def save_data(
         semantic (torch.Tensor): The semantic labels.
         instance (torch.Tensor): The instance labels.
     """
-    save_dir = os.path.join(save_path, scene_name, "predictions")
+    save_dir, save_file = get_save_file(save_path, scene_name, filename)
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    filename = filename.split("/")[-1].split(".")[0] + ".label"
-    save_file = os.path.join(save_dir, filename)
-    save_data = (instance.astype(np.uint32) << 16) | semantic.astype(np.uint32)
+    pack_labels(semantic, instance).tofile(save_file)
+
+
+def get_save_file(save_path: str, scene_name: str, filename: str) -> Tuple[str, str]:
+    """Return the directory and the path of the prediction file of a frame."""
+    save_dir = os.path.join(save_path, scene_name, "predictions")
+    return save_dir, os.path.join(save_dir, get_frame_name(filename) + ".label")
+
+
+def get_frame_name(filename: str) -> str:
+    """Return the name of a frame, the original file name without extension."""
+    return filename.split("/")[-1].split(".")[0]
+
+
+def pack_labels(semantic: np.ndarray, instance: np.ndarray) -> np.ndarray:
+    """Pack instance (upper 16 bits) and semantic (lower 16 bits) labels."""
+    return (instance.astype(np.uint32) << 16) | semantic.astype(np.uint32)
 
-    save_data.tofile(save_file)
+
+class Prediction_writer:
+    """
+    Save predictions like save_data, in background threads.
+
+    write() only queues the frame, at most queue_size frames wait to be written
+    and write() blocks when the queue is full. Created directories are cached.
+    The first failed write is raised by the next call of write, flush or close.
+
+    Frames are written as .label files, or given to sink when set, an object
+    with the write and close methods of Prediction_writer (e.g.
+    utils.archive.Archive_writer).
+    """
+
+    def __init__(
+        self, save_path: str, workers: int = 2, queue_size: int = 16, sink=None
+    ):
+        self.save_path = save_path
+        self.sink = sink
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="prediction_writer"
+        )
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._dirs = set()
+        self._error = None
+
+    def write(
+        self,
+        scene_name: str,
+        filename: str,
+        semantic: np.ndarray,
+        instance: np.ndarray,
+    ) -> None:
+        """
+        Queue the predictions of a frame, the arrays must not be modified after.
+
+        Args:
+            scene_name (str): The name of the scene.
+            filename (str): The path to the original file.
+            semantic (np.ndarray): The semantic labels.
+            instance (np.ndarray): The instance labels.
+        """
+        self._raise_error()
+        self._slots.acquire()
+        future = self._pool.submit(
+            self._write, scene_name, filename, semantic, instance
+        )
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    @traced("save_data")
+    def _write(self, scene_name, filename, semantic, instance):
+        if self.sink is not None:
+            self.sink.write(scene_name, filename, semantic, instance)
+            return
+
+        save_dir, save_file = get_save_file(self.save_path, scene_name, filename)
+        if save_dir not in self._dirs:
+            os.makedirs(save_dir, exist_ok=True)
+            self._dirs.add(save_dir)
+
+        pack_labels(semantic, instance).tofile(save_file)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None and self._error is None:
+                self._error = future.exception()
+        self._slots.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self) -> None:
+        """Wait until all queued frames are written."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._raise_error()
+
+    def close(self) -> None:
+        """Write the queued frames and stop the threads."""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+            if self.sink is not None:
+                self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
 
 ###############################
@@ -95,7 +212,7 @@ def print_config(args: argparse.Namespace, config: dict) -> str:
     msg += f"  max number of clusters: {config['clustering']['num_clusters']}\n"
     if clustering_method == "hdbscan":
         msg += f"  min_samples: {config['clustering']['min_cluster_size']}\n"
-    elif clustering_method == "dbscan":
+    elif clustering_method in ("dbscan", "torch_dbscan"):
         msg += f"  epsilon: {config['clustering']['epsilon']}\n"
         msg += f"  min_samples: {config['clustering']['min_cluster_size']}\n"
     elif clustering_method == "alpine":
@@ -144,7 +261,7 @@ def print_config_cont(args: argparse.Namespace, config: dict) -> str:
     msg += f"  max number of clusters: {config['clustering']['num_clusters']}\n"
     if clustering_method == "hdbscan":
         msg += f"  min_samples: {config['clustering']['min_cluster_size']}\n"
-    elif clustering_method == "dbscan":
+    elif clustering_method in ("dbscan", "torch_dbscan"):
         msg += f"  epsilon: {config['clustering']['epsilon']}\n"
         msg += f"  min_samples: {config['clustering']['min_cluster_size']}\n"
     elif clustering_method == "alpine":
@@ -316,41 +433,127 @@ def get_centers_for_class(
             - Tensor of shape (num_clusters, 3 or M) containing computed median.
             - Tensor of unique cluster IDs.
     """
-    class_mask = points[:, -2] == class_id
-    clusters = torch.unique(points[class_mask, -1]).long()
-    clusters = clusters[clusters != -1].sort()[0]
+    if feat is None:
+        stats = get_cluster_stats(points, [class_id])
+        centers = stats.centers
+    elif feat.shape[1] == 3:
+        stats = get_cluster_stats(points, [class_id], flow=feat)
+        centers = stats.flow
+    else:
+        stats = get_cluster_stats(points, [class_id], feat=feat)
+        centers = stats.features
 
-    if clusters.numel() == 0:
-        return torch.empty(0, 3), clusters
+    if stats.clusters.numel() == 0:
+        return torch.empty(0, 3), stats.clusters
 
-    if feat is None:
-        centers = torch.stack(
-            [
-                points[(class_mask) & (points[:, -1] == cluster_id), :3]
-                .median(dim=0)
-                .values
-                for cluster_id in clusters
-            ]
+    return centers, stats.clusters
+
+
+def _segment_median(
+    values: torch.Tensor, segments: torch.Tensor, median_pos: torch.Tensor
+) -> torch.Tensor:
+    """
+    Computes the per-segment median of each column of values. The median is the lower
+    one for segments with an even number of elements, same as torch.median.
+
+    Args:
+        values (torch.Tensor): Values of shape (V, D).
+        segments (torch.Tensor): Segment index of each value of shape (V,).
+        median_pos (torch.Tensor): Position of the median of each segment in the array
+                                   sorted by segment, shape (S,).
+
+    Returns:
+        torch.Tensor: Medians of shape (S, D).
+    """
+    medians = torch.empty(
+        (median_pos.shape[0], values.shape[1]), dtype=values.dtype, device=values.device
+    )
+    for d in range(values.shape[1]):
+        # sort by value, then stable sort by segment -> values sorted within segments
+        order = torch.argsort(values[:, d], stable=True)
+        order = order[torch.argsort(segments[order], stable=True)]
+        medians[:, d] = values[order[median_pos], d]
+    return medians
+
+
+@traced("cluster_stats")
+def get_cluster_stats(
+    points: torch.Tensor,
+    class_ids: List[int],
+    flow: Optional[torch.Tensor] = None,
+    feat: Optional[torch.Tensor] = None,
+) -> "Cluster_stats":
+    """
+    Computes statistics of all clusters of the given classes in a single pass. Points
+    are grouped by (class, cluster) with one sort and all clusters are reduced at once.
+
+    Args:
+        points (torch.Tensor): Input tensor of shape (N, D), where first three columns
+                               are xyz and last two columns represent class ID and
+                               cluster ID.
+        class_ids (List[int]): The class IDs to compute the clusters for.
+        flow (Optional[torch.Tensor]): Optional flow tensor of shape (N, 3), median of
+                                       flow is computed for each cluster.
+        feat (Optional[torch.Tensor]): Optional feature tensor of shape (N, M), mean of
+                                       features is computed for each cluster.
+
+    Returns:
+        Cluster_stats: Statistics of the clusters sorted by class ID and cluster ID.
+    """
+    device = points.device
+    sem = points[:, -2].long()
+    clu = points[:, -1].long()
+    class_ids = torch.as_tensor(class_ids, dtype=torch.long, device=device)
+
+    valid_idx = torch.nonzero((clu != -1) & torch.isin(sem, class_ids)).squeeze(1)
+    point_seg = torch.full((points.shape[0],), -1, dtype=torch.long, device=device)
+
+    if valid_idx.numel() == 0:
+        empty = torch.empty(0, dtype=torch.long, device=device)
+        return Cluster_stats(
+            classes=empty,
+            clusters=empty,
+            point_seg=point_seg,
+            first_point=empty,
+            centers=points.new_empty((0, 3)),
+            flow=None if flow is None else flow.new_empty((0, 3)),
+            features=None if feat is None else feat.new_empty((0, feat.shape[1])),
         )
-    else:
-        if feat.shape[1] == 3:
-            centers = torch.stack(
-                [
-                    feat[(class_mask) & (points[:, -1] == cluster_id)]
-                    .median(dim=0)
-                    .values
-                    for cluster_id in clusters
-                ]
-            )
-        else:
-            centers = torch.stack(
-                [
-                    feat[(class_mask) & (points[:, -1] == cluster_id)].mean(dim=0)
-                    for cluster_id in clusters
-                ]
-            )
-
-    return centers, clusters
+
+    # group points by (class, cluster) -- sorted by class first, then by cluster
+    num_clu = clu[valid_idx].max() + 1
+    keys = sem[valid_idx] * num_clu + clu[valid_idx]
+    seg_keys, seg_inv, counts = torch.unique(
+        keys, sorted=True, return_inverse=True, return_counts=True
+    )
+    point_seg[valid_idx] = seg_inv
+
+    starts = torch.cumsum(counts, dim=0) - counts
+    median_pos = starts + (counts - 1) // 2
+    first_point = torch.full_like(seg_keys, points.shape[0]).scatter_reduce_(
+        0, seg_inv, valid_idx, reduce="amin"
+    )
+
+    centers = _segment_median(points[valid_idx, :3], seg_inv, median_pos)
+    flow_med = None
+    if flow is not None:
+        flow_med = _segment_median(flow[valid_idx, :3], seg_inv, median_pos)
+    feat_mean = None
+    if feat is not None:
+        feat_mean = torch.zeros(
+            (seg_keys.shape[0], feat.shape[1]), dtype=feat.dtype, device=device
+        ).index_add_(0, seg_inv, feat[valid_idx])
+        feat_mean = feat_mean / counts.unsqueeze(1).to(feat.dtype)
+
+    return Cluster_stats(
+        classes=seg_keys // num_clu,
+        clusters=seg_keys % num_clu,
+        point_seg=point_seg,
+        first_point=first_point,
+        centers=centers,
+        flow=flow_med,
+        features=feat_mean,
+    )
 
 
 def get_ego_vehicle_mask(points: torch.Tensor, config: dict) -> torch.Tensor:
@@ -383,6 +586,125 @@ def get_ego_vehicle_mask(points: torch.Tensor, config: dict) -> torch.Tensor:
 
 
 @dataclass
+class Cluster_stats:
+    classes: torch.Tensor
+    clusters: torch.Tensor
+    point_seg: torch.Tensor
+    first_point: torch.Tensor
+    centers: torch.Tensor
+    flow: Optional[torch.Tensor] = None
+    features: Optional[torch.Tensor] = None
+
+    def __post_init__(self):
+        # classes are sorted, so each class occupies a contiguous range of clusters
+        class_ids, counts = torch.unique_consecutive(self.classes, return_counts=True)
+        ends = torch.cumsum(counts, dim=0)
+        self._ranges = {
+            c: slice(e - n, e)
+            for c, n, e in zip(class_ids.tolist(), counts.tolist(), ends.tolist())
+        }
+
+    def class_slice(self, class_id: int) -> slice:
+        """Range of clusters belonging to the given class."""
+        return self._ranges.get(int(class_id), slice(0, 0))
+
+    def find(self, class_id: int, cluster_ids: torch.Tensor) -> torch.Tensor:
+        """Index of the given clusters of the given class, -1 if not found."""
+        sl = self.class_slice(class_id)
+        clusters = self.clusters[sl]
+        cluster_ids = torch.as_tensor(cluster_ids, device=clusters.device)
+        cluster_ids = cluster_ids.long().reshape(-1)
+        if clusters.numel() == 0:
+            return torch.full_like(cluster_ids, -1)
+        pos = torch.searchsorted(clusters, cluster_ids).clamp(max=clusters.numel() - 1)
+        return torch.where(clusters[pos] == cluster_ids, pos + sl.start, -1)
+
+    def gather_points(self, values: torch.Tensor) -> torch.Tensor:
+        """Per-point values from per-cluster values, zero for points without cluster."""
+        values = torch.cat((values.new_zeros(1), values))
+        return values[self.point_seg + 1]
+
+    def __repr__(self):
+        return f"Cluster_stats(num_clusters={self.clusters.numel()})"
+
+
+@dataclass
+class Track_table:
+    """
+    Tracked instances of a single class stored as struct of arrays, one row per
+    instance. Rows keep their insertion order.
+    """
+
+    ids: torch.Tensor = field(default_factory=lambda: torch.empty(0, dtype=torch.long))
+    cl_ids: torch.Tensor = field(
+        default_factory=lambda: torch.empty(0, dtype=torch.long)
+    )
+    life: torch.Tensor = field(default_factory=lambda: torch.empty(0, dtype=torch.long))
+    centers: torch.Tensor = field(default_factory=lambda: torch.empty(0, 3))
+    features: torch.Tensor = field(default_factory=lambda: torch.empty(0, 0))
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    @traced("track_insert")
+    def insert(
+        self,
+        ids: torch.Tensor,
+        cl_ids: torch.Tensor,
+        life: Union[int, torch.Tensor],
+        centers: torch.Tensor,
+        features: torch.Tensor,
+    ) -> None:
+        """
+        Insert instances to the table. Instances with an id already present in the
+        table overwrite the existing row, new instances are appended.
+
+        Args:
+            ids (torch.Tensor): Instance ids of shape (n,), unique.
+            cl_ids (torch.Tensor): Cluster ids of shape (n,).
+            life (Union[int, torch.Tensor]): Remaining life, scalar or of shape (n,).
+            centers (torch.Tensor): Centers of shape (n, 3).
+            features (torch.Tensor): Features of shape (n, M).
+        """
+        ids = ids.long().reshape(-1)
+        if ids.numel() == 0:
+            return
+        cl_ids = cl_ids.long().reshape(-1).to(ids.device)
+        life = torch.as_tensor(life, dtype=torch.long, device=ids.device).expand_as(ids)
+
+        if len(self) == 0:
+            self.ids, self.cl_ids, self.life = ids.clone(), cl_ids.clone(), life.clone()
+            self.centers, self.features = centers.clone(), features.clone()
+            return
+
+        match = ids[:, None] == self.ids[None, :]
+        found = match.any(dim=1)
+        rows = match.int().argmax(dim=1)[found]
+        self.cl_ids[rows] = cl_ids[found]
+        self.life[rows] = life[found]
+        self.centers[rows] = centers[found]
+        self.features[rows] = features[found]
+
+        new = ~found
+        self.ids = torch.cat((self.ids, ids[new]))
+        self.cl_ids = torch.cat((self.cl_ids, cl_ids[new]))
+        self.life = torch.cat((self.life, life[new]))
+        self.centers = torch.cat((self.centers, centers[new]))
+        self.features = torch.cat((self.features, features[new]))
+
+    def age(self) -> None:
+        """Decrease life of all instances and remove the expired ones."""
+        self.life -= 1
+        keep = self.life >= 0
+        if not keep.all():
+            self.ids, self.cl_ids = self.ids[keep], self.cl_ids[keep]
+            self.life = self.life[keep]
+            self.centers, self.features = self.centers[keep], self.features[keep]
+
+    def __repr__(self):
+        return f"Track_table(ids={self.ids.tolist()}, life={self.life.tolist()})"
+
+
 class Obj_cache:
     def __init__(self, num_classes):
         self.num_classes = num_classes
@@ -390,35 +712,9 @@ class Obj_cache:
 
     def reset(self):
         self.max_id = 0
-        self.prev_instances = [dict() for _ in range(self.num_classes)]
-
-    def add_instance(self, class_id, instance):
-        self.prev_instances[class_id][instance.id] = copy.deepcopy(instance)
-
-    def del_instance(self, class_id, instance_id):
-        if instance_id in self.prev_instances[class_id].keys():
-            del self.prev_instances[class_id][instance_id]
-        else:
-            print(f"Instance {instance_id} not found in class {class_id}.")
+        self.tracks = [Track_table() for _ in range(self.num_classes)]
 
+    @traced("track_update")
     def update_step(self):
-        for i, instance_dict in enumerate(self.prev_instances):
-            keys_to_delete = []
-            for key, obj in instance_dict.items():
-                obj.life -= 1
-                if obj.life < 0:
-                    keys_to_delete.append(key)
-            for key in keys_to_delete:
-                self.del_instance(i, key)
-
-
-@dataclass
-class Instance_data:
-    id: int
-    cl_id: int
-    life: int
-    center: torch.Tensor
-    feature: torch.Tensor
-
-    def __repr__(self):
-        return f"Instance_data(id={self.id}, center={self.center}, life={self.life})"
+        for table in self.tracks:
+            table.age()
@@ -0,0 +1,163 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List
+
+_END = object()
+
+
+class _Failure:
+    """Exception raised in a stage, forwarded to the consumer."""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event) -> Any:
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _source(items: Iterator, out_q: queue.Queue, stop: threading.Event):
+    try:
+        for item in items:
+            if not _put(out_q, item, stop):
+                return
+    except BaseException as e:
+        _put(out_q, _Failure(e), stop)
+        return
+    finally:
+        # stop upstream pipelines when the items are a generator
+        if hasattr(items, "close"):
+            items.close()
+    _put(out_q, _END, stop)
+
+
+def _worker(
+    stage: Callable, in_q: queue.Queue, out_q: queue.Queue, stop: threading.Event
+):
+    while True:
+        item = _get(in_q, stop)
+        if item is _END or isinstance(item, _Failure):
+            _put(out_q, item, stop)
+            return
+        try:
+            item = stage(item)
+        except BaseException as e:
+            _put(out_q, _Failure(e), stop)
+            return
+        if not _put(out_q, item, stop):
+            return
+
+
+def pipeline(
+    items: Iterable, stages: List[Callable], queue_size: int = 2
+) -> Iterator:
+    """
+    Run stages over items with one thread per stage, connected by bounded queues.
+
+    Every stage processes items one by one in the input order, so outputs are
+    yielded in the input order and stateful stages see a sequential stream.
+    Item i+1 can be in stage k while item i is in stage k+1. An exception raised
+    by a stage (or by the iteration of items) is re-raised by the generator,
+    closing the generator stops all threads.
+
+    Args:
+        items (Iterable): Input items, iterated in a separate thread.
+        stages (List[Callable]): Functions applied in sequence to every item.
+        queue_size (int): Maximum number of items waiting between two stages.
+
+    Yields:
+        Any: Output of the last stage for every item.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [
+        threading.Thread(
+            target=_source, args=(iter(items), queues[0], stop), daemon=True
+        )
+    ]
+    for stage, in_q, out_q in zip(stages, queues[:-1], queues[1:]):
+        threads.append(
+            threading.Thread(
+                target=_worker, args=(stage, in_q, out_q, stop), daemon=True
+            )
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def micro_batches(
+    items: Iterable, batch_size: int, queue_size: int = 2
+) -> Iterator[List]:
+    """
+    Group items into batches of the items that are already available.
+
+    Items are iterated in a separate thread. A batch is yielded as soon as at
+    least one item is available, it contains up to batch_size items in the
+    input order, i.e. the consumer never waits for a batch to fill up.
+
+    Args:
+        items (Iterable): Input items, iterated in a separate thread.
+        batch_size (int): Maximum number of items in a batch.
+        queue_size (int): Maximum number of items waiting for the consumer.
+
+    Yields:
+        List: Batch of consecutive items.
+    """
+    stop = threading.Event()
+    q = queue.Queue(maxsize=max(queue_size, batch_size))
+    thread = threading.Thread(
+        target=_source, args=(iter(items), q, stop), daemon=True
+    )
+    thread.start()
+
+    try:
+        done = False
+        while not done:
+            batch = []
+            item = q.get()
+            while True:
+                if item is _END:
+                    done = True
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                batch.append(item)
+                if len(batch) == batch_size:
+                    break
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                yield batch
+    finally:
+        stop.set()
+        thread.join()
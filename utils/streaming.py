@@ -0,0 +1,213 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+import numpy as np
+
+from utils.clustering import Clusterer
+from utils.association import association, long_association
+from utils.misc import Obj_cache, transform_pointcloud
+
+
+@dataclass
+class Frame:
+    """
+    Single frame ready for association.
+
+    Attributes:
+        scene (dict): Scene of the frame, with "name" and "token".
+        filename (str): Path of the original point cloud.
+        points (torch.Tensor): Ego compensated xyz + features + semantic class +
+            cluster id of each point.
+        pred (torch.Tensor): Semantic class of each point.
+        flow (Optional[torch.Tensor]): Scene flow of each point.
+        labels (Optional[np.ndarray]): Ground truth semantic labels.
+        instance_labels (Optional[np.ndarray]): Ground truth instance labels.
+    """
+
+    scene: dict
+    filename: str
+    points: torch.Tensor
+    pred: torch.Tensor
+    flow: Optional[torch.Tensor] = None
+    labels: Optional[np.ndarray] = None
+    instance_labels: Optional[np.ndarray] = None
+
+
+def split_batch(
+    batch: dict,
+    out: torch.Tensor,
+    tokens: torch.Tensor,
+    clusterer: Clusterer,
+    device: torch.device,
+    use_flow: bool = False,
+    use_gt: bool = False,
+) -> List[Frame]:
+    """
+    Split the network output of a collated batch into frames, upsampled to the
+    original resolution and clustered.
+
+    Args:
+        batch (dict): Batch from the dataloader, with "feat", "scene_flow" and
+            "upsample" already on the device.
+        out (torch.Tensor): Semantic logits of shape (B, C, N).
+        tokens (torch.Tensor): Point features of shape (B, F, N).
+        clusterer (Clusterer): Clustering of the foreground points.
+        device (torch.device): Device of the network outputs.
+        use_flow (bool): Keep the scene flow of the frames.
+        use_gt (bool): Use ground truth semantic labels instead of predictions.
+
+    Returns:
+        List[Frame]: Frames of the batch, in the batch order.
+    """
+    labels = batch["labels_orig"]
+    inst_lab = batch["instance_labels"]
+    has_inst = isinstance(inst_lab, torch.Tensor)
+
+    frames = []
+    start = 0
+    for b, upsample in enumerate(batch["upsample"]):
+        end = start + upsample.shape[0]
+        xyz = batch["feat"][b, 1:4, upsample].T
+        features = tokens[b, :, upsample].T
+
+        # get semantic class
+        if use_gt:
+            pred = labels[start:end].to(device).clone()
+            pred[pred == 255] = -1
+        else:
+            pred = out[b, :, upsample].argmax(dim=0)
+
+        # clustering
+        cluster = clusterer.get_semantic_clustering(
+            torch.cat((xyz, pred.unsqueeze(1)), axis=1)
+        )
+
+        # ego motion compensation
+        xyz_ego = transform_pointcloud(xyz, batch["ego"][b].to(device))
+
+        frames.append(
+            Frame(
+                scene=batch["scene"][b],
+                filename=batch["filename"][b],
+                points=torch.cat(
+                    (xyz_ego, features, pred.unsqueeze(1), cluster.unsqueeze(1)),
+                    axis=1,
+                ),
+                pred=pred,
+                flow=batch["scene_flow"][b, :, upsample].T if use_flow else None,
+                labels=labels[start:end].numpy(),
+                instance_labels=inst_lab[start:end].numpy() if has_inst else None,
+            )
+        )
+        start = end
+
+    return frames
+
+
+class Scene_stream:
+    """
+    Association consumer of a single scene, fed with its frames in time order.
+
+    Each pair of consecutive frames is associated once. The first pair gives
+    the instance ids of the first frame, every later frame gets its ids from
+    the pair with its predecessor.
+    """
+
+    def __init__(self, config: dict, num_classes: int):
+        self.config = config
+        self.obj_cache = Obj_cache(num_classes)
+        self.prev = None
+        self.prev_ind = None
+
+    def _associate(
+        self, points_t1: torch.Tensor, points_t2: torch.Tensor, flow
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.config["association"]["use_long"]:
+            assoc = long_association
+        else:
+            assoc = association
+        ind_t1, ind_t2 = assoc(
+            points_t1, points_t2, self.config, self.prev_ind, self.obj_cache, flow
+        )
+        self.obj_cache.max_id = int(
+            max(self.obj_cache.max_id, ind_t1.max(), ind_t2.max())
+        )
+        return ind_t1, ind_t2
+
+    def push(self, frame: Frame) -> List[Tuple[Frame, torch.Tensor]]:
+        """
+        Add the next frame of the scene.
+
+        Returns:
+            List[Tuple[Frame, torch.Tensor]]: Frames whose instance ids are
+                final, with their ids, in time order.
+        """
+        if self.prev is None:
+            self.prev = frame
+            return []
+
+        ind_prev, ind = self._associate(self.prev.points, frame.points, self.prev.flow)
+        done = []
+        if self.prev_ind is None:
+            done.append((self.prev, ind_prev))
+        done.append((frame, ind))
+        self.prev, self.prev_ind = frame, ind
+        return done
+
+    def close(self) -> List[Tuple[Frame, torch.Tensor]]:
+        """
+        End the scene.
+
+        Returns:
+            List[Tuple[Frame, torch.Tensor]]: The first frame of a single-frame
+                scene, associated with an empty frame.
+        """
+        done = []
+        if self.prev is not None and self.prev_ind is None:
+            points = self.prev.points
+            _, ind = self._associate(torch.zeros_like(points), points, None)
+            done.append((self.prev, ind))
+        self.prev, self.prev_ind = None, None
+        return done
+
+
+class Stream_engine:
+    """
+    Route frames to the association consumer of their scene.
+
+    Inference may batch frames of any scenes, the engine restores the per-scene
+    streams. Frames of a scene are expected to be contiguous, as listed by the
+    datasets, so the open scenes are closed when a new scene starts.
+    """
+
+    def __init__(self, config: dict, num_classes: int):
+        self.config = config
+        self.num_classes = num_classes
+        self.streams: Dict[str, Scene_stream] = {}
+
+    def push(self, frames: Iterable[Frame]) -> Iterator[Tuple[Frame, torch.Tensor]]:
+        """
+        Add frames in time order.
+
+        Yields:
+            Tuple[Frame, torch.Tensor]: Frames whose instance ids are final, with
+                their ids.
+        """
+        for frame in frames:
+            token = frame.scene["token"]
+            if token not in self.streams:
+                yield from self.flush()
+                self.streams[token] = Scene_stream(self.config, self.num_classes)
+            yield from self.streams[token].push(frame)
+
+    def flush(self) -> Iterator[Tuple[Frame, torch.Tensor]]:
+        """
+        Close all open scenes.
+
+        Yields:
+            Tuple[Frame, torch.Tensor]: Remaining frames with their ids.
+        """
+        for stream in self.streams.values():
+            yield from stream.close()
+        self.streams = {}
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+from typing import Callable, Optional
+
+# Tracing state, spans are only recorded when enabled
+_enabled = False
+_sync = None
+_events = []
+_thread_names = {}
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: Optional[dict]):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if _sync is not None:
+            _sync()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if _sync is not None:
+            _sync()
+        end = time.perf_counter_ns()
+        # list.append is atomic, spans of several threads can be recorded
+        tid = threading.get_ident()
+        _events.append((self.name, self.start, end - self.start, tid, self.args))
+        if tid not in _thread_names:
+            _thread_names[tid] = threading.current_thread().name
+        return False
+
+
+def enable(sync: Optional[Callable] = None) -> None:
+    """
+    Start recording spans.
+
+    Args:
+        sync (Callable, optional): Called at the start and end of every span, e.g.
+            torch.cuda.synchronize to attribute asynchronous GPU work to its span.
+    """
+    global _enabled, _sync
+    _enabled = True
+    _sync = sync
+
+
+def disable() -> None:
+    """Stop recording spans, already recorded spans are kept."""
+    global _enabled, _sync
+    _enabled = False
+    _sync = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **args):
+    """
+    Context manager recording the duration of its block.
+
+    Args:
+        name (str): Name of the span in the trace.
+        **args: Values shown with the span in the trace viewer.
+
+    Returns:
+        Context manager, a shared no-op one when tracing is disabled.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args or None)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """
+    Decorator recording every call of the function as a span.
+
+    Args:
+        name (str, optional): Name of the span, the function name by default.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(label, None):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def dump(path: str) -> None:
+    """
+    Write recorded spans as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+
+    Args:
+        path (str): Path of the output JSON file.
+    """
+    pid = os.getpid()
+    events = []
+    for tid, thread_name in _thread_names.items():
+        events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": thread_name},
+            }
+        )
+    for name, start, duration, tid, args in _events:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start / 1e3,
+            "dur": duration / 1e3,
+            "pid": pid,
+            "tid": tid,
+        }
+        if args is not None:
+            event["args"] = {k: str(v) for k, v in args.items()}
+        events.append(event)
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def clear() -> None:
+    """Drop recorded spans."""
+    _events.clear()
+    _thread_names.clear()
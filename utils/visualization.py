@@ -8,13 +8,15 @@ import open3d as o3d
 import matplotlib.pyplot as plt
 
 from utils.misc import load_config
+from utils.archive import open_predictions
 
 MAX_INST = 23
 
 
 def visualize_scene(config: dict, pcd_dir: str, labels_dir: str) -> None:
     pcd_files = sorted(os.listdir(pcd_dir))
-    lab_files = sorted(os.listdir(labels_dir))
+    predictions = open_predictions(labels_dir)
+    lab_files = predictions.names()
     if len(pcd_files) != len(lab_files):
         print(
             f"Mismatch between point cloud (num: {len(pcd_files)}) and label files (num: {len(lab_files)})."
@@ -43,16 +45,10 @@ def visualize_scene(config: dict, pcd_dir: str, labels_dir: str) -> None:
 
         # Load labels
         if config["instances"]:
-            labels = (
-                np.fromfile(os.path.join(labels_dir, lab_file), dtype=np.uint32)
-                & 0xFFFF0000
-            )
+            labels = predictions.read_packed(lab_file) & 0xFFFF0000
             labels = (labels >> 16).astype(np.int16)
         else:
-            labels = (
-                np.fromfile(os.path.join(labels_dir, lab_file), dtype=np.uint32)
-                & 0xFFFF
-            ).astype(np.int16)
+            labels = (predictions.read_packed(lab_file) & 0xFFFF).astype(np.int16)
             if config["dataset"] == "semantic_kitti":
                 labels = mapper(labels) - 1
 
@@ -81,7 +77,8 @@ def visualize_scene(config: dict, pcd_dir: str, labels_dir: str) -> None:
 
 def visualize_frame(config: dict, pcd_dir: str, labels_dir: str, frame: int) -> None:
     pcd_files = sorted(os.listdir(pcd_dir))
-    lab_files = sorted(os.listdir(labels_dir))
+    predictions = open_predictions(labels_dir)
+    lab_files = predictions.names()
     if len(pcd_files) != len(lab_files):
         print(
             f"Mismatch between point cloud (num: {len(pcd_files)}) and label files (num: {len(lab_files)})."
@@ -112,16 +109,10 @@ def visualize_frame(config: dict, pcd_dir: str, labels_dir: str, frame: int) ->
 
         # Load labels
         if config["instances"]:
-            labels = (
-                np.fromfile(os.path.join(labels_dir, lab_file), dtype=np.uint32)
-                & 0xFFFF0000
-            )
+            labels = predictions.read_packed(lab_file) & 0xFFFF0000
             labels = (labels >> 16).astype(np.int16)
         else:
-            labels = (
-                np.fromfile(os.path.join(labels_dir, lab_file), dtype=np.uint32)
-                & 0xFFFF
-            ).astype(np.int16)
+            labels = (predictions.read_packed(lab_file) & 0xFFFF).astype(np.int16)
             if config["dataset"] == "semantic_kitti":
                 labels = mapper(labels) - 1
 